@@ -22,6 +22,8 @@ import configparser
 import tools.database_tools as db
 import tools.glider_tools as gt
 import tools.download_tools as dlt
+import tools.metrics_tools as mt
+import tools.profiling_tools as pf
 from ppglider_acquire_eo_config import tra_config
 
 #-messages----------------------------------------------------------------------
@@ -50,6 +52,7 @@ PARSER.add_argument('-l', '--log_path', type=str,
                     default=DEFAULT_LOG_PATH,
                     help='log file output path')
 
+pf.add_profiling_arguments(PARSER)
 ARGS = PARSER.parse_args()
 
 #-main--------------------------------------------------------------------------
@@ -79,6 +82,9 @@ if __name__ == "__main__":
         print("Failed to set logger")
         sys.exit()
 
+    # opt-in profiling (--profile, --trace-memory, --sample)
+    pf.start_profiling(ARGS, LOGFILE, logging=logging)
+
     # read processing config file
     module_config = configparser.ConfigParser(allow_no_value=True)
     module_config.read(ARGS.config_file)
@@ -87,6 +93,11 @@ if __name__ == "__main__":
     database_name = os.path.join(os.path.abspath(module_config['DIRECTORIES']['database_dir']),
       module_config['DATABASE']['database_name'])
 
+    mt.configure(database_name, 'acquire_eo', logging=logging)
+
+    profile_table = db.profile_table(module_config)
+    db.create_profile_table(database_name, profile_table)
+
     all_keys = [item for item in module_config['DATABASE_columns'].keys()]
 
     # get database statuses
@@ -265,6 +276,8 @@ if __name__ == "__main__":
 
             if get_cube:
                 print('Running cube generation for: '+variable)
+                cube_span = mt.span('eo_acquire', glider=glider_tag,
+                                    target=variable).start()
 
                 #get whole or partial new cube according to limits
                 db.shout('Sourcing '+variable, logging=logging, verbose=verbose)
@@ -330,11 +343,22 @@ if __name__ == "__main__":
                             dlt.concat_files(tra_config, variable, VAR_dir, 
                               var_file, match_files, COORDS_LIST, logging=logging, 
                               verbose=verbose)
+                cube_span.stop()
             else:
                 print('Data cube already present for '+variable)
                 db.shout('Data cube already present for '+variable,
                          logging=logging, verbose=verbose)
 
+        # profiles staged since the glider was last flown; a variable whose
+        # _traj file exists only needs these (the first N with --sample)
+        all_pending = db.profiles_for_stage(database_name, profile_table,
+                                            'eo_acquire', glider_tag=glider_tag)
+        pending = pf.sample(all_pending)
+        pf.sampled(len(pending))
+        pending_trajectory = None
+        flown = []
+        not_flown = []
+
         # now fly through and update database if successful
         for variable in variables:
 
@@ -357,6 +381,21 @@ if __name__ == "__main__":
             # blo late edit; may want to remove this; or do a date compare
             if not os.path.exists(nc_outfile):
                 print('Cube flying for: '+variable)
+            elif pending:
+                print('Cube flying '+str(len(pending))+' new profiles for: '+
+                      variable)
+                if pending_trajectory is None:
+                    pending_trajectory = gt.read_trajectory_files(GLIDER_CONFIG,
+                        [profile['staged_file'] for profile in pending])
+                _, _, missing = gt.fly_profiles(EO_dir, GLIDER_CONFIG,
+                                    pending_trajectory, module_config,
+                                    tra_config, variables=[variable],
+                                    logging=logging, verbose=verbose)
+                if missing:
+                    not_flown.append(variable)
+                else:
+                    flown.append(variable)
+                continue
             else:
                 print('Skipping cube flying for: '+variable)
                 continue
@@ -377,31 +416,37 @@ if __name__ == "__main__":
                         logging=logging, verbose=verbose)
 
             if success:
-                # update database for entire record processed
+                flown.append(variable)
                 db.shout(glider_tag+
                          ' now has trajectory for '+variable, 
                          logging=logging, verbose=verbose)
-
-                today = "'"+datetime.datetime.now().strftime('%Y%m%d_%H%M')+"'"
-                print(database)
-                conn, c = db.connectDB(database)
-                for glider_dir in glider_dirs:
-                    c.execute("UPDATE {tn} SET {sn} = 1 WHERE {fn} = {fm}".
-                              format(tn=module_config['table_name'],
-                                     sn=module_config['EO_column'],
-                                     fn=module_config['stage_dir_column'],
-                                     fm='"'+glider_dir+'"'))
-
-                    c.execute("UPDATE {tn} SET {sn} = {val} WHERE {fn} = {fm}".
-                              format(tn=module_config['table_name'],
-                                     sn=module_config['EO_column']+'_date',
-                                     val=today,
-                                     fn=module_config['stage_dir_column'],
-                                     fm='"'+glider_dir+'"'))
-                    conn.commit()
-                conn.close()
             else:
+                not_flown.append(variable)
                 db.shout(glider_tag+
                          ' failed to generate trajectory for '+variable, 
                          logging=logging, verbose=verbose)
+
+        # update database for the profiles flown; they stay pending until
+        # every included variable is flown
+        if flown:
+            state = None
+            if not_flown:
+                state = 'missing: '+','.join(not_flown)
+            db.set_profile_stage(database_name, profile_table, 'eo_acquire',
+                                 glider_tag, [profile['profile_number']
+                                 for profile in pending],
+                                 done=not not_flown, state=state)
+            if len(pending) < len(all_pending):
+                # a sampled run leaves the files of the rest pending
+                continue
+
+            today = datetime.datetime.now().strftime('%Y%m%d_%H%M')
+            conn, c = db.connectDB(database_name)
+            c.execute(f"UPDATE {module_config['DATABASE']['table_name']} SET"
+                      " eo_acquire = ?, eo_acquire_state = ?, eo_acquire_date"
+                      " = ?, eo_acquire_dir = ? WHERE staged_dir = ?",
+                      (0 if not_flown else 1, state, today, EO_dir,
+                       glider_dir))
+            conn.commit()
+            conn.close()
 #--EOF
@@ -15,117 +15,12 @@ import datetime
 import logging
 import argparse
 import fnmatch
-from stat import S_ISDIR
-import paramiko
 import tools.database_tools as db
+import tools.metrics_tools as mt
+import tools.profiling_tools as pf
+import tools.sftp_tools as sft
 import configparser
 
-#-functions---------------------------------------------------------------------
-def check_files(config):
-    '''
-     Using paramiko as it supports SFTP. Checks for files matching supplied
-     pattern on remote sftp server; and downloads if they differ from what we
-     have locally.
-    '''
-    matches = config['DOWNLOADING']['fmatch'].split(',')
-    excludes = config['DOWNLOADING']['fexclude'].split(',')
-
-    db.shout("Connecting to: " + config['DOWNLOADING']['ftp_host'], logging=logging,
-      verbose=verbose)
-
-    transport = paramiko.Transport((config['DOWNLOADING']['ftp_host'],
-      int(config['DOWNLOADING']['ftp_port'])))
-    transport.connect(username=config['DOWNLOADING']['ftp_user'],\
-                      password=config['DOWNLOADING']['ftp_pwrd'])
-    sftp = paramiko.SFTPClient.from_transport(transport)
-
-    mirror_dir(config, os.path.abspath(config['DOWNLOADING']['ftp_path']),\
-                 os.path.abspath(config['DIRECTORIES']['download_dir']), sftp, 
-                 matches, excludes)
-
-    sftp.close()
-    transport.close()
-
-    db.shout("Transfers completed", logging=logging, verbose=verbose)
-
-def mirror_dir(config, remote_dir, local_dir, sftp, matches,\
-                 excludes):
-    '''
-     loops through directories and downloads files on single connection.
-    '''
-
-    local_dir = os.path.abspath(remote_dir.replace(config['DOWNLOADING']['ftp_path'],\
-                                   config['DIRECTORIES']['download_dir']))
-    
-    if not os.path.exists(local_dir):
-        os.makedirs(local_dir)
-
-    dir_items = sftp.listdir_attr(remote_dir)
-
-    for item in dir_items:
-        remote_path = os.path.join(remote_dir, item.filename)
-        local_path = os.path.join(local_dir, item.filename)
-        if S_ISDIR(item.st_mode):
-            mirror_dir(config, remote_path, local_path, sftp, matches,\
-                         excludes)
-        else:
-            for match in matches:
-                if str(match) in remote_path:
-                    for exclude in excludes:
-                        if str(exclude) in remote_path:
-                            continue
-
-                    if not os.path.exists(local_path):
-                        # get file if no corresponding local target
-                        # update DB
-                        db.shout("Transferring: "+\
-                                 os.path.basename(remote_path),\
-                                 logging=logging, verbose=verbose)
-
-                        sftp.get(remote_path, local_path)
-                        timestamp  = os.stat(local_path).st_mtime
-                        db.add_new_file_row(database_name,\
-                                            "file_downloaded",\
-                                            config,\
-                                            local_path,\
-                                            timestamp,\
-                                            logging=logging,\
-                                            verbose=verbose)
-
-                    else:
-                        # update DB if local path is correct size
-                        # but target is missing from DB
-                        local_file_info = os.stat(local_path)
-                        if local_file_info.st_size == item.st_size:
-                            timestamp  = os.stat(local_path).st_mtime
-                            db.shout("Present, correct size, checking DB(s): "\
-                                     +os.path.basename(local_path),\
-                                     logging=logging, verbose=verbose)
-
-                            db.add_new_file_row(database_name,\
-                                                "file_downloaded",\
-                                                config,\
-                                                local_path,\
-                                                timestamp,\
-                                                logging=logging,\
-                                                verbose=verbose)
-                        else:
-                            # get file if local target is wrong size
-                            # update DB
-                            db.shout("Incorrect size, transferring: "\
-                                     +os.path.basename(remote_path),\
-                                     logging=logging, verbose=verbose)
-                            sftp.get(remote_path, local_path)
-                            timestamp  = os.stat(local_path).st_mtime
-
-                            db.add_new_file_row(database_name,\
-                                                "file_downloaded",\
-                                                config,\
-                                                local_path,\
-                                                timestamp,\
-                                                logging=logging,\
-                                                verbose=verbose)
-
 #-default parameters------------------------------------------------------------
 OUT_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 DEFAULT_LOG_PATH = os.path.join(OUT_ROOT, 'logs')
@@ -142,6 +37,7 @@ PARSER.add_argument('-v', '--verbose',\
 PARSER.add_argument('-l', '--log_path', type=str,\
                     default=DEFAULT_LOG_PATH,\
                     help='log file output path')
+pf.add_profiling_arguments(PARSER)
 ARGS = PARSER.parse_args()
 
 #-main--------------------------------------------------------------------------
@@ -166,6 +62,9 @@ if __name__ == "__main__":
         print(error)
         print("Failed to set logger")
 
+    # opt-in profiling (--profile, --trace-memory, --sample)
+    pf.start_profiling(ARGS, LOGFILE, logging=logging)
+
     # read processing config file
     module_config = configparser.ConfigParser(allow_no_value=True)
     module_config.read(ARGS.config_file)
@@ -178,9 +77,13 @@ if __name__ == "__main__":
     database_name = os.path.join(os.path.abspath(module_config['DIRECTORIES']['database_dir']),
       module_config['DATABASE']['database_name'])
 
+    mt.configure(database_name, 'autodownload', logging=logging)
+
     # Get new files
     try:
-        check_files(module_config)
+        with mt.span('autodownload'):
+            sft.check_files(module_config, database_name,\
+                            logging=logging, verbose=verbose)
     except ConnectionError as error:
         print(error)
         db.shout("Failed to contact server!!", verbose=verbose,
@@ -197,16 +100,18 @@ if __name__ == "__main__":
 
     db.shout("Updating database with pre-existing files if required...")
 
-    for existing_file in existing_files:
-        base_fname = os.path.basename(existing_file)
-        tstamp  = os.stat(existing_file).st_mtime
-
-        db.add_new_file_row(database_name,\
-                            "file_downloaded",\
-                            module_config,\
-                            existing_file,\
-                            tstamp,\
-                            logging=logging,\
-                            verbose=verbose)
+    with mt.span('register', target=module_config['DIRECTORIES']['download_dir']):
+        for existing_file in existing_files:
+            base_fname = os.path.basename(existing_file)
+            tstamp  = os.stat(existing_file).st_mtime
+
+            db.add_new_file_row(database_name,\
+                                "file_downloaded",\
+                                module_config,\
+                                existing_file,\
+                                tstamp,\
+                                logging=logging,\
+                                verbose=verbose)
+            mt.count('files')
 
 #--EOF
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+'''
+Purpose:    Benchmarks the processing hot spots (dive splitting, staging,
+            trajectory coordinates, EO cube fly-through, MLD, preprocessing
+            and quenching corrections) on synthetic Seaglider and EGO
+            missions of increasing size, reporting wall/CPU time and peak
+            memory per case.
+
+License:    See LICENCE.txt
+'''
+#-imports-----------------------------------------------------------------------
+import os
+import datetime
+import logging
+import argparse
+import warnings
+import sys
+import csv
+import time
+import shutil
+import tempfile
+
+# add paths/tools
+import tools.database_tools as db
+import tools.benchmark_tools as bt
+import tools.profiling_tools as pf
+
+#-messages----------------------------------------------------------------------
+print('RUNNING: WARNINGS ARE SUPPRESSED')
+warnings.filterwarnings('ignore')
+
+#-functions---------------------------------------------------------------------
+def print_results(results):
+    print(f"{'layout':<11}{'benchmark':<21}{'profiles':>9}{'items':>7}"
+          f"{'wall s':>10}{'ms/item':>9}{'cpu s':>9}{'peak MB':>9}  status")
+    for result in results:
+        per_item = 1000*result['wall']/result['items'] if result['items'] \
+                   else float('nan')
+        print(f"{result['layout']:<11}{result['benchmark']:<21}"
+              f"{result['profiles']:>9}{result['items']:>7}"
+              f"{result['wall']:>10.3f}{per_item:>9.2f}{result['cpu']:>9.2f}"
+              f"{result['peak_mb']:>9.1f}  {result['status'][:60]}")
+
+#-default parameters------------------------------------------------------------
+OUT_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_LOG_PATH = os.path.join(OUT_ROOT, 'logs')
+DEFAULT_CFG_DIR = os.path.join(OUT_ROOT, 'configs')
+
+#-arguments---------------------------------------------------------------------
+
+PARSER = argparse.ArgumentParser()
+PARSER.add_argument('-n', '--profiles', type=str,\
+                    default='100,1000,10000',\
+                    help='Comma separated mission sizes (profiles)')
+PARSER.add_argument('-r', '--records', type=int,\
+                    default=200,\
+                    help='Records per profile')
+PARSER.add_argument('-d', '--max_depth', type=float,\
+                    default=1000.,\
+                    help='Deepest dive (m)')
+PARSER.add_argument('-L', '--layouts', type=str,\
+                    default='seaglider,ego',\
+                    help='Comma separated file layouts: '+','.join(bt.LAYOUTS))
+PARSER.add_argument('-b', '--benchmarks', type=str,\
+                    default='all',\
+                    help='Comma separated benchmarks (or prefixes): '+\
+                         ','.join(bt.BENCHMARKS))
+PARSER.add_argument('-s', '--seed', type=int,\
+                    default=0,\
+                    help='Random seed of the synthetic missions')
+PARSER.add_argument('-cd', '--config_dir', type=str,\
+                    default=DEFAULT_CFG_DIR,\
+                    help='Directory of the glider config templates')
+PARSER.add_argument('-w', '--work_dir', type=str,\
+                    default=None,\
+                    help='Directory for the synthetic files (default: temporary)')
+PARSER.add_argument('-k', '--keep',\
+                    action='store_true',\
+                    help='Keep the synthetic files')
+PARSER.add_argument('-v', '--verbose',\
+                    action='store_true')
+PARSER.add_argument('-l', '--log_path', type=str,\
+                    default=DEFAULT_LOG_PATH,\
+                    help='log file output path')
+pf.add_profiling_arguments(PARSER)
+ARGS = PARSER.parse_args()
+
+#-main--------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    verbose = ARGS.verbose
+
+    # preliminary stuff
+    LOGFILE = os.path.join(ARGS.log_path,"PPglider_benchmark_"+\
+              datetime.datetime.now().strftime('%Y%m%d_%H%M')+".log")
+
+    # make required log directory if it does not exist
+    if not os.path.exists(os.path.abspath(ARGS.log_path)):
+        os.makedirs(ARGS.log_path)
+
+    # set file logger
+    try:
+        if os.path.exists(LOGFILE):
+            os.remove(LOGFILE)
+        print("logging to: "+LOGFILE)
+        logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
+    except:
+        print("Failed to set logger")
+        sys.exit()
+
+    # opt-in profiling (--profile, --trace-memory)
+    pf.start_profiling(ARGS, LOGFILE, logging=logging)
+
+    sizes = [int(size) for size in ARGS.profiles.split(',') if size.strip()]
+    layouts = [layout.strip() for layout in ARGS.layouts.split(',') \
+               if layout.strip() in bt.LAYOUTS]
+    benchmarks = bt.select_benchmarks(ARGS.benchmarks)
+    if not sizes or not layouts or not benchmarks:
+        print("Nothing to run; check --profiles, --layouts and --benchmarks")
+        sys.exit()
+
+    work_dir = ARGS.work_dir or tempfile.mkdtemp(prefix='ppglider_benchmark_')
+    db.shout(f"Synthetic missions in {work_dir}", logging=logging, verbose=True)
+
+    results = []
+    try:
+        for n_profiles in sizes:
+            mission = bt.synthetic_mission(n_profiles, records=ARGS.records,\
+                                           max_depth=ARGS.max_depth,\
+                                           seed=ARGS.seed)
+            for layout in layouts:
+                t0 = time.perf_counter()
+                case = bt.generate_case(mission, layout, ARGS.config_dir,\
+                           os.path.join(work_dir, f"{layout}_{n_profiles}"))
+                case['logging'] = logging
+                db.shout(f"{layout}, {n_profiles} profiles: generated in "
+                         f"{time.perf_counter()-t0:.1f}s", logging=logging,\
+                         verbose=True)
+
+                for name in benchmarks:
+                    result = bt.run_case(name, case)
+                    results.append(result)
+                    db.shout(f"{layout} {name} {n_profiles}: {result['status']}, "
+                             f"{result['wall']:.3f}s wall, {result['cpu']:.2f}s "
+                             f"cpu, {result['peak_mb']:.1f}MB peak",\
+                             logging=logging, verbose=verbose)
+
+                if not ARGS.keep:
+                    shutil.rmtree(case['dir'], ignore_errors=True)
+    finally:
+        if not ARGS.keep and not ARGS.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print('')
+    print_results(results)
+
+    results_file = os.path.splitext(LOGFILE)[0]+'.csv'
+    with open(results_file, 'w', newline='') as csv_fid:
+        writer = csv.DictWriter(csv_fid, fieldnames=['layout', 'benchmark',\
+                     'profiles', 'records', 'items', 'wall', 'cpu', 'peak_mb',\
+                     'status'])
+        writer.writeheader()
+        writer.writerows(results)
+    print("results written to: "+results_file)
+#--EOF
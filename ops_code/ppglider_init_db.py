@@ -18,6 +18,7 @@ import logging
 import argparse
 import configparser
 import tools.database_tools as db
+import tools.profiling_tools as pf
 
 #-default parameters------------------------------------------------------------
 OUT_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
@@ -42,6 +43,7 @@ PARSER.add_argument('-l', '--log_path', type=str,\
                     help='log file output path')
 PARSER.add_argument('-v', '--verbose',\
                     action='store_true')
+pf.add_profiling_arguments(PARSER)
 ARGS = PARSER.parse_args()
 
 #-main--------------------------------------------------------------------------
@@ -66,6 +68,9 @@ if __name__ == "__main__":
         print(error)
         print("Failed to set logger")
 
+    # opt-in profiling (--profile, --trace-memory, --sample)
+    pf.start_profiling(ARGS, LOGFILE, logging=logging)
+
     # read processing config file
     module_config = configparser.ConfigParser(allow_no_value=True)
     module_config.read(ARGS.config_file)
@@ -121,6 +126,9 @@ if __name__ == "__main__":
             conn.close()
 
             db.shout("New database initialised",verbose=verbose)
+
+        # per-profile table, also for databases made before it existed
+        db.create_profile_table(database_name, db.profile_table(module_config))
     except OSError as error :
         print(error)
         db.shout("Database initialisation or backup failed", verbose=verbose,
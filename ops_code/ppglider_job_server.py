@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+'''
+Purpose:    Serves the job queue of the processing database over HTTP, so
+            that ppglider_worker processes on other machines (sharing the
+            data directories) can claim and complete jobs without opening
+            the SQLite file themselves.
+
+License:    See LICENCE.txt
+'''
+#-imports-----------------------------------------------------------------------
+import os
+import datetime
+import logging
+import argparse
+import sys
+import configparser
+
+# add paths/tools
+import tools.database_tools as db
+import tools.job_tools as jt
+import tools.profiling_tools as pf
+
+#-default parameters------------------------------------------------------------
+OUT_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_LOG_PATH = os.path.join(OUT_ROOT, 'logs')
+DEFAULT_CFG_DIR = os.path.join(OUT_ROOT, 'configs')
+DEFAULT_CFG_FILE = os.path.join(DEFAULT_CFG_DIR, 'config_main.ini')
+
+#-arguments---------------------------------------------------------------------
+
+PARSER = argparse.ArgumentParser()
+PARSER.add_argument('-cfg', '--config_file', type=str,\
+                    default=DEFAULT_CFG_FILE,\
+                    help='Config file')
+PARSER.add_argument('-H', '--host', type=str,\
+                    default=None,\
+                    help='Address to listen on (default: [JOBS] server_host)')
+PARSER.add_argument('-p', '--port', type=int,\
+                    default=None,\
+                    help='Port to listen on (default: [JOBS] server_port)')
+PARSER.add_argument('-v', '--verbose',\
+                    action='store_true')
+PARSER.add_argument('-l', '--log_path', type=str,\
+                    default=DEFAULT_LOG_PATH,\
+                    help='log file output path')
+pf.add_profiling_arguments(PARSER)
+ARGS = PARSER.parse_args()
+
+#-main--------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    verbose = ARGS.verbose
+
+    # preliminary stuff
+    LOGFILE = os.path.join(ARGS.log_path,"PPglider_job_server_"+\
+              datetime.datetime.now().strftime('%Y%m%d_%H%M')+".log")
+
+    # make required log directory if it does not exist
+    if not os.path.exists(os.path.abspath(ARGS.log_path)):
+        os.makedirs(ARGS.log_path)
+
+    # set file logger
+    try:
+        if os.path.exists(LOGFILE):
+            os.remove(LOGFILE)
+        print("logging to: "+LOGFILE)
+        logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
+    except:
+        print("Failed to set logger")
+        sys.exit()
+
+    # opt-in profiling (--profile, --trace-memory, --sample)
+    pf.start_profiling(ARGS, LOGFILE, logging=logging)
+
+    # read processing config file
+    module_config = configparser.ConfigParser(allow_no_value=True)
+    module_config.read(ARGS.config_file)
+    jobs_config = {'server_host': '127.0.0.1', 'server_port': '8765',\
+                   'max_attempts': '3'}
+    if module_config.has_section('JOBS'):
+        jobs_config.update(dict(module_config['JOBS']))
+
+    # set database names
+    database_name = os.path.join(os.path.abspath(module_config['DIRECTORIES']['database_dir']),
+      module_config['DATABASE']['database_name'])
+    if not os.path.exists(os.path.dirname(database_name)):
+        os.makedirs(os.path.dirname(database_name))
+    db.create_table(database_name, module_config)
+
+    jobs = jt.LocalJobs(database_name, module_config['DATABASE']['table_name'],\
+                        max_attempts=int(jobs_config['max_attempts']),\
+                        profile_table=db.profile_table(module_config))
+    jt.serve_jobs(jobs, host=ARGS.host or jobs_config['server_host'],\
+                  port=ARGS.port or int(jobs_config['server_port']),\
+                  logging=logging, verbose=verbose)
+#--EOF
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+'''
+Purpose:    Reports the stage metrics recorded by the processing scripts:
+            the slowest stages (per glider) over recent runs and how each
+            stage's time has changed from run to run.
+
+License:    See LICENCE.txt
+'''
+#-imports-----------------------------------------------------------------------
+import os
+import datetime
+import argparse
+import sys
+import configparser
+
+# add paths/tools
+import tools.metrics_tools as mt
+import tools.profiling_tools as pf
+
+#-functions---------------------------------------------------------------------
+def size(n_bytes):
+    n_bytes = float(n_bytes or 0)
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if n_bytes < 1024 or unit == 'GB':
+            return f"{n_bytes:.0f}{unit}" if unit == 'B' else f"{n_bytes:.1f}{unit}"
+        n_bytes = n_bytes/1024
+
+def print_slowest(rows):
+    print(f"{'stage':<22}{'glider':<22}{'spans':>6}{'total s':>10}{'mean s':>9}"
+          f"{'max s':>9}{'cpu s':>9}{'read':>9}{'written':>9}{'subproc':>8}"
+          f"{'peak RSS':>10}{'failed':>7}")
+    for row in rows:
+        print(f"{row['stage']:<22}{str(row['glider'] or '-'):<22}"
+              f"{row['spans']:>6}{row['total_wall']:>10.2f}"
+              f"{row['mean_wall']:>9.3f}{row['max_wall']:>9.3f}"
+              f"{row['cpu']:>9.2f}{size(row['bytes_read']):>9}"
+              f"{size(row['bytes_written']):>9}{row['subprocesses'] or 0:>8}"
+              f"{size((row['peak_rss_kb'] or 0)*1024):>10}{row['failed']:>7}")
+
+def print_trends(rows):
+    stages = sorted(set([row['stage'] for row in rows]))
+    runs = []
+    for row in rows:
+        if row['run_id'] not in [run[0] for run in runs]:
+            runs.append((row['run_id'], row['started']))
+    totals = dict([((row['run_id'], row['stage']), row['total_wall']) \
+                   for row in rows])
+
+    print(f"{'run started':<18}{'run':<40}"+\
+          ''.join([f"{stage[:14]:>15}" for stage in stages]))
+    for run_id, started in runs:
+        when = datetime.datetime.fromtimestamp(started).strftime('%Y-%m-%d %H:%M')
+        print(f"{when:<18}{run_id[:39]:<40}"+''.join(\
+              [f"{totals[(run_id, stage)]:>15.2f}" if (run_id, stage) in totals \
+               else f"{'-':>15}" for stage in stages]))
+
+#-default parameters------------------------------------------------------------
+OUT_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_LOG_PATH = os.path.join(OUT_ROOT, 'logs')
+DEFAULT_CFG_DIR = os.path.join(OUT_ROOT, 'configs')
+DEFAULT_CFG_FILE = os.path.join(DEFAULT_CFG_DIR, 'config_main.ini')
+
+#-arguments---------------------------------------------------------------------
+
+PARSER = argparse.ArgumentParser()
+PARSER.add_argument('-cfg', '--config_file', type=str,\
+                    default=DEFAULT_CFG_FILE,\
+                    help='Config file')
+PARSER.add_argument('-r', '--runs', type=int,\
+                    default=10,\
+                    help='Number of most recent runs to report on')
+PARSER.add_argument('-n', '--top', type=int,\
+                    default=15,\
+                    help='Number of slowest stages to list')
+PARSER.add_argument('-s', '--stage', type=str,\
+                    default=None,\
+                    help='Only this stage')
+PARSER.add_argument('-g', '--glider', type=str,\
+                    default=None,\
+                    help='Only this glider tag')
+PARSER.add_argument('-l', '--log_path', type=str,\
+                    default=DEFAULT_LOG_PATH,\
+                    help='profiling output path')
+pf.add_profiling_arguments(PARSER)
+ARGS = PARSER.parse_args()
+
+#-main--------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    # the report has no log; profiling output goes where it would be
+    if ARGS.profile or ARGS.trace_memory:
+        if not os.path.exists(os.path.abspath(ARGS.log_path)):
+            os.makedirs(ARGS.log_path)
+        pf.start_profiling(ARGS, os.path.join(ARGS.log_path,\
+            "PPglider_metrics_"+datetime.datetime.now().strftime('%Y%m%d_%H%M')+\
+            ".log"))
+
+    # read processing config file
+    module_config = configparser.ConfigParser(allow_no_value=True)
+    module_config.read(ARGS.config_file)
+
+    # set database names
+    database_name = os.path.join(os.path.abspath(module_config['DIRECTORIES']['database_dir']),
+      module_config['DATABASE']['database_name'])
+    if not os.path.exists(database_name):
+        print(f"No database {database_name}")
+        sys.exit()
+    mt.create_metrics_table(database_name)
+
+    slowest = mt.slowest_stages(database_name, runs=ARGS.runs,\
+                                stage=ARGS.stage, glider=ARGS.glider,\
+                                limit=ARGS.top)
+    if not slowest:
+        print("No metrics recorded yet")
+        sys.exit()
+
+    print(f"Slowest stages over the last {ARGS.runs} runs")
+    print_slowest(slowest)
+    print('')
+    print("Total wall time (s) per stage and run")
+    print_trends(mt.stage_trends(database_name, runs=ARGS.runs,\
+                                 stage=ARGS.stage, glider=ARGS.glider))
+#--EOF
@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+'''
+Purpose:    Runs the database initialisation, download (with --download),
+            registration of downloaded files, staging, trajectory, mission
+            hydrography and EO boundary stages in a single process. EO
+            acquisition is left to ppglider_acquire_eo. Staged
+            trajectories are passed to the trajectory stage in memory and
+            only the stages whose inputs changed since the last run are
+            re-run (see tools/pipeline_tools.py).
+
+License:    See LICENCE.txt
+'''
+#-imports-----------------------------------------------------------------------
+import os
+import datetime
+import logging
+import argparse
+import warnings
+import sys
+import glob
+import fnmatch
+import configparser
+
+# add paths/tools
+import tools.database_tools as db
+import tools.glider_tools as gt
+import tools.pipeline_tools as pt
+import tools.metrics_tools as mt
+import tools.profiling_tools as pf
+import tools.sftp_tools as sft
+
+#-messages----------------------------------------------------------------------
+print('RUNNING: WARNINGS ARE SUPPRESSED')
+warnings.filterwarnings('ignore')
+
+#-functions---------------------------------------------------------------------
+def glider_config(glider_tag):
+    return os.path.join(DEFAULT_CFG_DIR, f"config_{glider_tag}.ini")
+
+def config_files(context):
+    return sorted(glob.glob(os.path.join(DEFAULT_CFG_DIR, 'config_*.ini')))
+
+def download_signature(download_file):
+    '''
+     Size and modification time of a downloaded file; a re-delivery that
+     changed it (e.g. a growing mission file) is staged again
+    '''
+    try:
+        stat = os.stat(download_file)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+def staged_outputs(split_files):
+    '''
+     Staged files of a row staged outside the pipeline, from its split files
+    '''
+    staged_files = []
+    for split_file in split_files.split(','):
+        for suffix in ['_st_fin.nc', '_st_bad.nc', '_st_int_fin.nc',\
+                       '_st_int_bad.nc']:
+            if os.path.exists(split_file.replace('.nc', suffix)):
+                staged_files.append(split_file.replace('.nc', suffix))
+    return staged_files
+
+def init_db_stage(context, inputs, last):
+    '''
+     Creates the working directories and the database table if required
+    '''
+    module_config = context['module_config']
+    for key in ['backup_dir', 'database_dir', 'download_dir', 'staged_dir',\
+                'eo_dir']:
+        if not os.path.exists(os.path.abspath(module_config['DIRECTORIES'][key])):
+            os.makedirs(os.path.abspath(module_config['DIRECTORIES'][key]))
+    db.create_table(context['database_name'], module_config)
+    mt.configure(context['database_name'], 'pipeline', logging=logging)
+    return {}, []
+
+def download_stage(context, inputs, last):
+    '''
+     Mirrors the sftp source into the download directory; an unreachable
+     server does not stop the stages that follow
+    '''
+    try:
+        transferred = sft.check_files(context['module_config'],\
+                                      context['database_name'],\
+                                      logging=logging,\
+                                      verbose=context['verbose'])
+    except:
+        db.shout("Failed to contact server!!", logging=logging, verbose=True,\
+                 level='warning')
+        transferred = []
+    return {}, transferred
+
+def register_stage(context, inputs, last):
+    '''
+     Adds downloaded files missing from the database
+    '''
+    module_config = context['module_config']
+    download_files = []
+    for root, _, filenames in os.walk(os.path.abspath(\
+                              module_config['DIRECTORIES']['download_dir'])):
+        for filename in fnmatch.filter(filenames, '*.nc'):
+            download_files.append(os.path.join(root, filename))
+    download_files = sorted(download_files)
+
+    _, db_dict = db.get_status(context['database_name'],\
+                   context['table_name'], ['file_downloaded'],\
+                   logging=logging, verbose=context['verbose'])
+    known_files = set(db_dict['file_downloaded'])
+    for download_file in download_files:
+        if download_file not in known_files:
+            try:
+                db.add_new_file_row(context['database_name'], 'file_downloaded',\
+                                    module_config, download_file,\
+                                    os.stat(download_file).st_mtime,\
+                                    logging=logging, verbose=context['verbose'])
+            except:
+                # unreadable (e.g. partly transferred); tried again next run
+                db.shout(f"Failed to register {download_file}",\
+                         logging=logging, verbose=True)
+
+    return {'download_files': download_files}, []
+
+def staging_inputs(context):
+    return context['download_files'] + config_files(context)
+
+def staging_stage(context, inputs, last):
+    '''
+     Stages every registered file not yet staged, or re-delivered since it
+     was staged, keeping the trajectory of the new profiles in memory for
+     the trajectory stage
+    '''
+    module_config = context['module_config']
+    verbose = context['verbose']
+    download_dir = os.path.abspath(module_config['DIRECTORIES']['download_dir'])
+    staged_dir = os.path.abspath(module_config['DIRECTORIES']['staged_dir'])
+
+    nitems, db_dict = db.get_status(context['database_name'],\
+                        context['table_name'], context['all_keys'],\
+                        logging=logging, verbose=verbose)
+
+    staged = last.get('staged', {})
+    signatures = last.get('signatures', {})
+    trajectories = {}
+    new_staged = {}
+    pending = []
+    for item in range(nitems):
+        download_file = db_dict['file_downloaded'][item]
+        glider_tag = f"{db_dict['glider_prefix'][item]}_{db_dict['glider_number'][item]}_{db_dict['glider_name'][item]}"
+        GLIDER_CONFIG = glider_config(glider_tag)
+        if not os.path.exists(GLIDER_CONFIG):
+            db.shout(f"Config {GLIDER_CONFIG} does not exist; please create it!!",\
+                     logging=logging, verbose=True)
+            if str(db_dict['staged'][item]) != '1':
+                pending.append(download_file)
+            continue
+
+        mission_staged = staged.setdefault(glider_tag, {})
+        signature = download_signature(download_file)
+        if str(db_dict['staged'][item]) == '1':
+            if download_file not in signatures:
+                # staged outside the pipeline, as delivered then
+                signatures[download_file] = signature
+            if signatures[download_file] == signature:
+                if download_file not in mission_staged:
+                    mission_staged[download_file] = \
+                        staged_outputs(db_dict['staged_files'][item] or '')
+                continue
+            db.shout(f"{download_file} was delivered again; re-staging",\
+                     logging=logging, verbose=verbose)
+
+        # --sample: no more staging once enough profiles have been staged
+        if pf.sample_full():
+            pending.append(download_file)
+            continue
+
+        preproc_file = download_file.replace(download_dir, staged_dir)
+        if not os.path.exists(os.path.dirname(preproc_file)):
+            os.makedirs(os.path.dirname(preproc_file))
+            os.chmod(os.path.dirname(preproc_file), 0o777)
+
+        trajectory = {}
+        try:
+            split_files, staged_files = gt.stage_file(download_file,\
+                                        preproc_file, GLIDER_CONFIG,\
+                                        module_config, trajectory=trajectory,\
+                                        max_profiles=pf.sample_left(),\
+                                        logging=logging)
+        except:
+            db.shout(f"{download_file} failed to stage", logging=logging,\
+                     verbose=True)
+            pending.append(download_file)
+            continue
+
+        # --sample can stop part way through a file, which stays unstaged
+        done = len(staged_files) == len(split_files)
+        db.set_staged(context['database_name'], context['table_name'],\
+                      download_file, os.path.dirname(preproc_file),\
+                      split_files, profile_table=context['profile_table'],\
+                      glider_tag=glider_tag, profiles=gt.profile_summaries(\
+                      GLIDER_CONFIG, split_files, staged_files, trajectory),\
+                      done=done)
+        if done:
+            signatures[download_file] = signature
+            db.shout(f"{download_file} has been successfully staged",\
+                     logging=logging, verbose=verbose)
+        else:
+            db.shout(f"{download_file}: {len(staged_files)} of "\
+                     f"{len(split_files)} profiles staged (--sample)",\
+                     logging=logging, verbose=verbose)
+            pending.append(download_file)
+
+        mission_staged[download_file] = staged_files
+        pf.sampled(len(staged_files))
+        new_staged.setdefault(glider_tag, []).extend(staged_files)
+        mission_trajectory = trajectories.setdefault(glider_tag, {})
+        for name, values in trajectory.items():
+            mission_trajectory.setdefault(name, []).extend(values)
+
+    # in memory only; a skipped staging stage has nothing new
+    context['trajectories'] = trajectories
+    context['new_staged'] = new_staged
+
+    outputs = [staged_file for mission_staged in staged.values() \
+               for staged_files in mission_staged.values() \
+               for staged_file in staged_files]
+    # unstaged rows keep the stage running until they stage
+    return {'staged': staged, 'signatures': signatures, 'pending': pending},\
+           outputs
+
+def trajectory_inputs(context):
+    return [staged_file for mission_staged in context['staged'].values() \
+            for staged_files in mission_staged.values() \
+            for staged_file in staged_files]
+
+def trajectory_stage(context, inputs, last):
+    '''
+     Writes each mission trajectory file, appending the profiles staged in
+     this run when the file already holds all the earlier ones
+    '''
+    module_config = context['module_config']
+    covered = last.get('trajectory_covers', {})
+    trajectory_files = {}
+    trajectory_covers = {}
+    for glider_tag, mission_staged in context['staged'].items():
+        staged_files = [staged_file for staged_files in mission_staged.values()\
+                        for staged_file in staged_files]
+        if not staged_files:
+            continue
+        GLIDER_CONFIG = glider_config(glider_tag)
+        EO_dir = os.path.join(os.path.abspath(\
+                 module_config['DIRECTORIES']['eo_dir']), glider_tag)
+        if not os.path.exists(EO_dir):
+            os.makedirs(EO_dir)
+        trajectory_file = os.path.join(EO_dir, glider_tag+'_trajectory.nc')
+
+        new_files = context.get('new_staged', {}).get(glider_tag, [])
+        trajectory = context.get('trajectories', {}).get(glider_tag, {})
+        old_files = [staged_file for staged_file in staged_files \
+                     if staged_file not in new_files]
+
+        if os.path.exists(trajectory_file) and \
+           old_files == covered.get(glider_tag):
+            if new_files:
+                gt.write_trajectory_arrays(GLIDER_CONFIG, trajectory,\
+                                           trajectory_file, append=True,\
+                                           logging=logging)
+                db.shout(f"Appended {len(new_files)} profiles to "\
+                         f"{trajectory_file}", logging=logging,\
+                         verbose=context['verbose'])
+        else:
+            # rebuild; only profiles staged in an earlier run are read back
+            full_trajectory = gt.read_trajectory_files(GLIDER_CONFIG, old_files)
+            for name, values in trajectory.items():
+                full_trajectory.setdefault(name, []).extend(values)
+            gt.write_trajectory_arrays(GLIDER_CONFIG, full_trajectory,\
+                                       trajectory_file, logging=logging)
+            db.shout(f"Made {trajectory_file} from {len(staged_files)} "\
+                     "profiles", logging=logging, verbose=context['verbose'])
+
+        trajectory_files[glider_tag] = trajectory_file
+        trajectory_covers[glider_tag] = staged_files
+
+    return {'trajectory_files': trajectory_files,\
+            'trajectory_covers': trajectory_covers},\
+           list(trajectory_files.values())
+
+def hydrography_stage(context, inputs, last):
+    '''
+     Writes each mission hydrography file (see write_mission_hydrography),
+     appending the profiles staged in this run when the file already
+     holds all the earlier ones
+    '''
+    module_config = context['module_config']
+    covered = last.get('hydrography_covers', {})
+    hydro_files = {}
+    hydrography_covers = {}
+    for glider_tag, mission_staged in context['staged'].items():
+        staged_files = [staged_file for staged_files in mission_staged.values()\
+                        for staged_file in staged_files \
+                        if not staged_file.endswith('_bad.nc')]
+        if not staged_files:
+            continue
+        EO_dir = os.path.join(os.path.abspath(\
+                 module_config['DIRECTORIES']['eo_dir']), glider_tag)
+        if not os.path.exists(EO_dir):
+            os.makedirs(EO_dir)
+        hydro_file = os.path.join(EO_dir, glider_tag+'_hydrography.nc')
+
+        new_files = [staged_file for staged_file in \
+                     context.get('new_staged', {}).get(glider_tag, []) \
+                     if staged_file in staged_files]
+        old_files = [staged_file for staged_file in staged_files \
+                     if staged_file not in new_files]
+
+        if os.path.exists(hydro_file) and old_files == covered.get(glider_tag):
+            if new_files:
+                gt.write_mission_hydrography(new_files, glider_config(glider_tag),\
+                                             hydro_file, append=True,\
+                                             logging=logging,\
+                                             verbose=context['verbose'])
+        else:
+            gt.write_mission_hydrography(staged_files, glider_config(glider_tag),\
+                                         hydro_file, logging=logging,\
+                                         verbose=context['verbose'])
+
+        hydro_files[glider_tag] = hydro_file
+        hydrography_covers[glider_tag] = staged_files
+
+    return {'hydrography_files': hydro_files,\
+            'hydrography_covers': hydrography_covers},\
+           list(hydro_files.values())
+
+def boundary_inputs(context):
+    return list(context['trajectory_files'].values())
+
+def boundary_stage(context, inputs, last):
+    '''
+     Updates the EO boundary file of each mission from its trajectory
+    '''
+    module_config = context['module_config']
+    boundary_files = {}
+    for glider_tag, trajectory_file in context['trajectory_files'].items():
+        boundary_file = os.path.join(os.path.dirname(trajectory_file),\
+                                     'boundaries.txt')
+        COORDS_LIST = [0]*6
+        if os.path.exists(boundary_file):
+            with open(boundary_file, "r") as filestream:
+                for line in filestream:
+                    COORDS_LIST = line.split(',')
+
+        gt.define_boundary_file(trajectory_file, glider_config(glider_tag),\
+                    COORDS_LIST, boundary_file,\
+                    float(module_config['EO_ACQUIRE']['date_pad']),\
+                    logging=logging, verbose=context['verbose'])
+        boundary_files[glider_tag] = boundary_file
+
+    return {'boundary_files': boundary_files}, list(boundary_files.values())
+
+#-default parameters------------------------------------------------------------
+OUT_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_LOG_PATH = os.path.join(OUT_ROOT, 'logs')
+DEFAULT_CFG_DIR = os.path.join(OUT_ROOT, 'configs')
+DEFAULT_CFG_FILE = os.path.join(DEFAULT_CFG_DIR, 'config_main.ini')
+
+STAGES = [{'name': 'init_db', 'run': init_db_stage, 'always': True},
+          {'name': 'download', 'requires': ['init_db'],
+           'run': download_stage, 'always': True},
+          {'name': 'register', 'requires': ['init_db', 'download'],
+           'run': register_stage, 'always': True},
+          {'name': 'staging', 'requires': ['register'],
+           'inputs': staging_inputs, 'run': staging_stage},
+          {'name': 'trajectory', 'requires': ['staging'],
+           'inputs': trajectory_inputs, 'run': trajectory_stage},
+          {'name': 'hydrography', 'requires': ['staging'],
+           'inputs': trajectory_inputs, 'run': hydrography_stage},
+          {'name': 'boundaries', 'requires': ['trajectory'],
+           'inputs': boundary_inputs, 'run': boundary_stage}]
+
+#-arguments---------------------------------------------------------------------
+
+PARSER = argparse.ArgumentParser()
+PARSER.add_argument('-cfg', '--config_file', type=str,\
+                    default=DEFAULT_CFG_FILE,\
+                    help='Config file')
+PARSER.add_argument('-d', '--download',\
+                    action='store_true',\
+                    help='Fetch new files from the sftp source first')
+PARSER.add_argument('-f', '--force',\
+                    action='store_true',\
+                    help='Run every stage even if its inputs are unchanged')
+PARSER.add_argument('-v', '--verbose',\
+                    action='store_true')
+PARSER.add_argument('-l', '--log_path', type=str,\
+                    default=DEFAULT_LOG_PATH,\
+                    help='log file output path')
+pf.add_profiling_arguments(PARSER)
+ARGS = PARSER.parse_args()
+
+#-main--------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    verbose = ARGS.verbose
+
+    # preliminary stuff
+    LOGFILE = os.path.join(ARGS.log_path,"PPglider_pipeline_"+\
+              datetime.datetime.now().strftime('%Y%m%d_%H%M')+".log")
+
+    # make required log directory if it does not exist
+    if not os.path.exists(os.path.abspath(ARGS.log_path)):
+        os.makedirs(ARGS.log_path)
+
+    # set file logger
+    try:
+        if os.path.exists(LOGFILE):
+            os.remove(LOGFILE)
+        print("logging to: "+LOGFILE)
+        logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
+    except:
+        print("Failed to set logger")
+        sys.exit()
+
+    # opt-in profiling (--profile, --trace-memory, --sample)
+    pf.start_profiling(ARGS, LOGFILE, logging=logging)
+
+    # read processing config file
+    module_config = configparser.ConfigParser(allow_no_value=True)
+    module_config.read(ARGS.config_file)
+
+    # set database names
+    database_dir = os.path.abspath(module_config['DIRECTORIES']['database_dir'])
+    context = {'module_config': module_config,
+               'database_name': os.path.join(database_dir,\
+                                module_config['DATABASE']['database_name']),
+               'table_name': module_config['DATABASE']['table_name'],
+               'profile_table': db.profile_table(module_config),
+               'all_keys': [item for item in module_config['DATABASE_columns'].keys()],
+               'verbose': verbose}
+
+    # without --download the pipeline starts from the files on disk
+    if not ARGS.download:
+        STAGES = [stage for stage in STAGES if stage['name'] != 'download']
+        for stage in STAGES:
+            stage['requires'] = [name for name in stage.get('requires', []) \
+                                 if name != 'download']
+
+    statuses = pt.run_pipeline(STAGES, context,\
+                   os.path.join(database_dir, 'PPglider_pipeline_state.json'),\
+                   force=ARGS.force, logging=logging, verbose=verbose)
+
+    db.shout(', '.join([f"{name}: {status}" for name, status in statuses.items()]),\
+             logging=logging, verbose=True)
+#--EOF
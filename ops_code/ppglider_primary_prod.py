@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+'''
+Purpose:    Runs the PAR and Morel91 primary production models on the
+            station files of each corrected glider mission, in parallel,
+            and gathers the results into per-mission netCDF files
+            (integrated values and station x depth profiles).
+
+License:    See LICENCE.txt
+'''
+#-imports-----------------------------------------------------------------------
+import os
+import datetime
+import logging
+import argparse
+import warnings
+import sys
+import configparser
+
+# add paths/tools
+import tools.database_tools as db
+import tools.pp_model_tools as ppt
+import tools.metrics_tools as mt
+import tools.profiling_tools as pf
+
+#-messages----------------------------------------------------------------------
+print('RUNNING: WARNINGS ARE SUPPRESSED')
+warnings.filterwarnings('ignore')
+
+#-default parameters------------------------------------------------------------
+OUT_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_LOG_PATH = os.path.join(OUT_ROOT, 'logs')
+DEFAULT_CFG_DIR = os.path.join(OUT_ROOT, 'configs')
+DEFAULT_CFG_FILE = os.path.join(DEFAULT_CFG_DIR, 'config_main.ini')
+
+#-arguments---------------------------------------------------------------------
+
+PARSER = argparse.ArgumentParser()
+PARSER.add_argument('-cfg', '--config_file', type=str,\
+                    default=DEFAULT_CFG_FILE,\
+                    help='Config file')
+PARSER.add_argument('-n', '--n_workers', type=int,\
+                    default=None,\
+                    help='Number of model processes (default: config or all cores)')
+PARSER.add_argument('-r', '--re_run',\
+                    action='store_true',\
+                    help='Re-run missions that already have PP')
+PARSER.add_argument('-v', '--verbose',\
+                    action='store_true')
+PARSER.add_argument('-l', '--log_path', type=str,\
+                    default=DEFAULT_LOG_PATH,\
+                    help='log file output path')
+pf.add_profiling_arguments(PARSER)
+ARGS = PARSER.parse_args()
+
+#-main--------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    verbose = ARGS.verbose
+
+    # preliminary stuff
+    LOGFILE = os.path.join(ARGS.log_path,"PPglider_primary_prod_"+\
+              datetime.datetime.now().strftime('%Y%m%d_%H%M')+".log")
+
+    # make required log directory if it does not exist
+    if not os.path.exists(os.path.abspath(ARGS.log_path)):
+        os.makedirs(ARGS.log_path)
+
+    # set file logger
+    try:
+        if os.path.exists(LOGFILE):
+            os.remove(LOGFILE)
+        print("logging to: "+LOGFILE)
+        logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
+    except:
+        print("Failed to set logger")
+        sys.exit()
+
+    # opt-in profiling (--profile, --trace-memory, --sample)
+    pf.start_profiling(ARGS, LOGFILE, logging=logging)
+
+    # read processing config file
+    module_config = configparser.ConfigParser(allow_no_value=True)
+    module_config.read(ARGS.config_file)
+    MODEL_DICT = ppt.read_model_config(module_config)
+    if ARGS.n_workers:
+        MODEL_DICT['n_workers'] = ARGS.n_workers
+
+    # set database names
+    database_name = os.path.join(os.path.abspath(module_config['DIRECTORIES']['database_dir']),
+      module_config['DATABASE']['database_name'])
+    table_name = module_config['DATABASE']['table_name']
+    profile_table = db.profile_table(module_config)
+    db.create_profile_table(database_name, profile_table)
+    mt.configure(database_name, 'primary_prod', logging=logging)
+
+    all_keys = [item for item in module_config['DATABASE_columns'].keys()]
+
+    # get database statuses
+    nitems, db_dict = db.get_status(database_name, table_name, all_keys,
+        logging=logging, verbose=verbose)
+
+    # group corrected rows by mission station directory
+    missions = {}
+    for item in range(nitems):
+        if str(db_dict['corrected'][item]) != '1' or not db_dict['corrected_dir'][item]:
+            continue
+        if str(db_dict['primary_prod'][item]) == '1' and not ARGS.re_run:
+            continue
+        glider_tag = f"{db_dict['glider_prefix'][item]}_{db_dict['glider_number'][item]}_{db_dict['glider_name'][item]}"
+        key = (glider_tag, db_dict['corrected_dir'][item])
+        missions.setdefault(key, []).append(db_dict['file_downloaded'][item])
+
+    for (glider_tag, station_dir), downloaded_files in missions.items():
+        # --sample: stop once enough stations have been modelled
+        if pf.sample_full():
+            break
+        try:
+            mission_dict = dict(MODEL_DICT)
+            mission_dict['output_dir'] = os.path.join(MODEL_DICT['output_dir'],\
+                                         glider_tag)
+            with mt.span('primary_prod', glider=glider_tag, target=station_dir):
+                results = ppt.run_pp_models(station_dir, mission_dict,\
+                                            max_stations=pf.sample_left(),\
+                                            logging=logging, verbose=verbose)
+                mt.count('stations', len(results))
+            sampled = pf.sample_left() is not None
+            pf.sampled(len(results))
+            if len(results) == 0:
+                db.shout(f"No station files in {station_dir}; skipping",\
+                         logging=logging, verbose=verbose)
+                continue
+
+            pp_file = ppt.write_pp_netcdf(results, os.path.join(\
+                          mission_dict['output_dir'], glider_tag+'_PP.nc'),\
+                          logging=logging, verbose=verbose)
+            profile_file = ppt.aggregate_model_outputs(\
+                          [(result['station'], result['profile_file'],\
+                            result['telemetry_file']) for result in results \
+                           if result['status'] == 'ok'],\
+                          os.path.join(mission_dict['output_dir'],\
+                          glider_tag+'_PP_profiles.nc'),\
+                          n_workers=mission_dict['n_workers'],\
+                          logging=logging, verbose=verbose)
+            n_failed = sum([result['status'] != 'ok' for result in results])
+            db.shout(f"{glider_tag}: PP for {len(results)-n_failed} of "
+                     f"{len(results)} stations", logging=logging, verbose=verbose)
+
+            #update database; a sampled run only flags the stations it ran
+            if not sampled:
+                today = datetime.datetime.now().strftime('%Y%m%d_%H%M')
+                conn, c = db.connectDB(database_name)
+                for downloaded_file in downloaded_files:
+                    c.execute(f"UPDATE {table_name} SET primary_prod = 1,"
+                              " primary_prod_date = ?, primary_prod_dir = ?,"
+                              " primary_prod_files = ? WHERE file_downloaded = ?",
+                              (today, mission_dict['output_dir'],
+                               pp_file+','+profile_file, downloaded_file))
+                conn.commit()
+                conn.close()
+            db.set_profile_stage(database_name, profile_table, 'primary_prod',\
+                                 glider_tag, [result['station'] for result in \
+                                 results if result['status'] == 'ok'])
+
+        except:
+            db.shout(f"{glider_tag} PP models failed for {station_dir}",\
+                     logging=logging, verbose=True)
+#--EOF
@@ -23,6 +23,8 @@ import configparser
 # add paths/tools
 import tools.database_tools as db
 import tools.glider_tools as gt
+import tools.metrics_tools as mt
+import tools.profiling_tools as pf
 
 #-messages----------------------------------------------------------------------
 print('RUNNING: WARNINGS ARE SUPPRESSED')
@@ -39,47 +41,32 @@ def the_file_date(x):
     return val
 
 def process_file(database, input_file, output_file, GLIDER_CONFIG, \
-                 module_config, interp_flag=False, logging=None, verbose=False):
+                 module_config, interp_flag=False, max_profiles=None,\
+                 logging=None, verbose=False):
     '''
-     Performs all necessary pre-processing operations on glider data
+     Performs all necessary pre-processing operations on glider data; with
+     max_profiles only the first max_profiles profiles are staged
     '''
 
     good_flag = True
+    split_files = []
+    profiles = []
     try:
-        #check to see if profile numbers exist already
-        profiles_nums_exist = \
-                          gt.check_for_profile_numbers(input_file,GLIDER_CONFIG)
-
-        # dive splitting
-        split_files = gt.split_dive_index(input_file,\
-                                     output_file, GLIDER_CONFIG,\
-                                     logging=logging, \
-                                     profiles_nums_exist=profiles_nums_exist)
-
-        logging.info("Split into: "+str(len(split_files))+" profiles")
-
-        # interpolation onto depth levels (if required) and output
-        for split_file in split_files:
-            if interp_flag:
-                gt.interpolate_dive(split_file, \
-                                split_file.replace('.nc','_st_int.nc'),\
-                                GLIDER_CONFIG, module_config,\
-                                interp_flag=interp_flag,\
-                                logging=logging)
-                logging.info("Created interpolated: "+split_file)
-            else:
-                gt.interpolate_dive(split_file, \
-                                split_file.replace('.nc','_st.nc'),\
-                                GLIDER_CONFIG, module_config,\
-                                interp_flag=interp_flag,\
-                                logging=logging)
-                logging.info("Created: "+split_file)
+        trajectory = {}
+        split_files, staged_files = gt.stage_file(input_file, output_file,\
+                                       GLIDER_CONFIG, module_config,\
+                                       interp_flag=interp_flag,\
+                                       trajectory=trajectory,\
+                                       max_profiles=max_profiles,\
+                                       logging=logging)
+        profiles = gt.profile_summaries(GLIDER_CONFIG, split_files,\
+                                        staged_files, trajectory)
 
     except:
         db.shout("Failed to process profile", logging=logging, verbose=verbose)   
         good_flag = False
 
-    return good_flag, split_files
+    return good_flag, split_files, profiles
 
 #-default parameters------------------------------------------------------------
 OUT_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
@@ -102,6 +89,7 @@ PARSER.add_argument('-v', '--verbose',\
 PARSER.add_argument('-l', '--log_path', type=str,\
                     default=DEFAULT_LOG_PATH,\
                     help='log file output path')
+pf.add_profiling_arguments(PARSER)
 ARGS = PARSER.parse_args()
 
 #-main--------------------------------------------------------------------------
@@ -129,6 +117,9 @@ if __name__ == "__main__":
         print("Failed to set logger")
         sys.exit()
 
+    # opt-in profiling (--profile, --trace-memory, --sample)
+    pf.start_profiling(ARGS, LOGFILE, logging=logging)
+
     # read processing config file
     module_config = configparser.ConfigParser(allow_no_value=True)
     module_config.read(ARGS.config_file)
@@ -137,6 +128,9 @@ if __name__ == "__main__":
     database_name = os.path.join(os.path.abspath(module_config['DIRECTORIES']['database_dir']),
       module_config['DATABASE']['database_name'])
 
+    db.create_profile_table(database_name, db.profile_table(module_config))
+    mt.configure(database_name, 'staging', logging=logging)
+
     all_keys = [item for item in module_config['DATABASE_columns'].keys()]
 
     # get database statuses
@@ -144,8 +138,13 @@ if __name__ == "__main__":
         module_config['DATABASE']['table_name'],all_keys,
         logging=logging, verbose=verbose)
 
+    new_staged = {}
     for item in range(nitems):
 
+        # --sample: stop once enough profiles have been staged
+        if pf.sample_full():
+            break
+
         try:
             preproc_file = db_dict['file_downloaded'][item].replace(
                             os.path.abspath(module_config['DIRECTORIES']['download_dir']), \
@@ -159,8 +158,9 @@ if __name__ == "__main__":
                 db.shout(file_name+' not updated & already staged; skipping',\
                      logging=logging, verbose=verbose)
             else:
+                glider_tag = f"{db_dict['glider_prefix'][item]}_{db_dict['glider_number'][item]}_{db_dict['glider_name'][item]}"
                 GLIDER_CONFIG = os.path.join(DEFAULT_CFG_DIR,
-                    f"config_{db_dict['glider_prefix'][item]}_{db_dict['glider_number'][item]}_{db_dict['glider_name'][item]}.ini")
+                    f"config_{glider_tag}.ini")
 
                 if not os.path.exists(os.path.abspath(GLIDER_CONFIG)):
                     print(f"Config {GLIDER_CONFIG} does not exist; please create it!!")
@@ -169,68 +169,36 @@ if __name__ == "__main__":
                 db.shout(f"Using config: {GLIDER_CONFIG} on {db_dict['file_downloaded'][item]}",
                      logging=logging, verbose=verbose)
 
-                success, split_files = process_file(database_name, db_dict['file_downloaded'][item], \
+                success, split_files, profiles = process_file(database_name, db_dict['file_downloaded'][item], \
                                    preproc_file, GLIDER_CONFIG, module_config, \
-                                   interp_flag=interp_flag, logging=logging, \
-                                   verbose=verbose)
-
-                # convetr list to string
-                split_files = ','.join(split_files)
+                                   interp_flag=interp_flag, \
+                                   max_profiles=pf.sample_left(), \
+                                   logging=logging, verbose=verbose)
 
                 if success:
-                    db.shout(f"{db_dict['file_downloaded'][item]} has been successfully staged", \
-                         logging=logging, verbose=verbose)
+                    # --sample can stop part way through a file, which
+                    # stays unstaged
+                    done = len(profiles) == len(split_files)
+                    if done:
+                        db.shout(f"{db_dict['file_downloaded'][item]} has been successfully staged", \
+                             logging=logging, verbose=verbose)
+                    else:
+                        db.shout(f"{db_dict['file_downloaded'][item]}: {len(profiles)} of {len(split_files)} profiles staged (--sample)", \
+                             logging=logging, verbose=verbose)
 
                     #update database(s)
-                    today = "'"+\
-                        datetime.datetime.now().strftime('%Y%m%d_%H%M')+"'"
-
-                    conn, c = db.connectDB(database_name)
-                    c.execute("UPDATE {tn} SET {sn} = 1 WHERE {fn} = {fname}".\
-                              format(tn=module_config['DATABASE']['table_name'],\
-                              sn='staged',\
-                              fn='file_downloaded',\
-                              fname='"'+db_dict['file_downloaded'][item]+'"'))
-
-                    c.execute("UPDATE {tn} SET {sn} = {val} \
-                              WHERE {fn} = {fname}".\
-                              format(tn=module_config['DATABASE']['table_name'],\
-                              sn='staged_dir',\
-                              val='"'+os.path.dirname(preproc_file)+'"',\
-                              fn='file_downloaded',\
-                              fname='"'+db_dict['file_downloaded'][item]+'"'))
-
-                    c.execute("UPDATE {tn} SET {sn} = {val} \
-                              WHERE {fn} = {fname}".\
-                              format(tn=module_config['DATABASE']['table_name'],\
-                              sn='staged_date',\
-                              val=today,\
-                              fn='file_downloaded',\
-                              fname='"'+db_dict['file_downloaded'][item]+'"'))
-
-                    c.execute("UPDATE {tn} SET {sn} = {val} \
-                              WHERE {fn} = {fname}".\
-                              format(tn=module_config['DATABASE']['table_name'],\
-                              sn='staged_files',\
-                              val=f'"{split_files}"',\
-                              fn='file_downloaded',\
-                              fname='"'+db_dict['file_downloaded'][item]+'"'))
-
-                    #zero the flags in case of re-processing
-                    c.execute("UPDATE {tn} SET {sn1} = 0, {sn2} = 0, {sn3} = 0,"
-                              " {sn4} = 0, {sn5} = 0, {sn6} = 0"
-                              " WHERE {fn} = {fname}".\
-                              format(tn=module_config['DATABASE']['table_name'],\
-                              sn1='EO_acquire',\
-                              sn2='preproc',\
-                              sn3='spectral',\
-                              sn4='corrected',\
-                              sn5='primary_prod',\
-                              sn6='postproc',\
-                              fn='file_downloaded',\
-                              fname='"'+db_dict['file_downloaded'][item]+'"'))
-                    conn.commit()
-                    conn.close()
+                    db.set_staged(database_name,\
+                                  module_config['DATABASE']['table_name'],\
+                                  db_dict['file_downloaded'][item],\
+                                  os.path.dirname(preproc_file),\
+                                  split_files,\
+                                  profile_table=db.profile_table(module_config),\
+                                  glider_tag=glider_tag,\
+                                  profiles=profiles, done=done)
+                    pf.sampled(len(profiles))
+                    new_staged.setdefault(glider_tag, []).extend(\
+                        [profile['staged_file'] for profile in profiles \
+                         if profile['good']])
 
                 else:
                     db.shout(f"{db_dict['file_downloaded'][item]} failed to stage", \
@@ -238,4 +206,21 @@ if __name__ == "__main__":
         except:
             db.shout(f"{db_dict['file_downloaded'][item]} failed to stage", \
                      logging=logging, verbose=True)
+
+    # mission hydrography of the staged profiles; every row is re-staged,
+    # so the file is rebuilt unless only a sample was staged
+    for glider_tag, staged_files in new_staged.items():
+        EO_dir = os.path.join(os.path.abspath(\
+                 module_config['DIRECTORIES']['eo_dir']), glider_tag)
+        if not os.path.exists(EO_dir):
+            os.makedirs(EO_dir)
+        try:
+            gt.write_mission_hydrography(staged_files, os.path.join(\
+                DEFAULT_CFG_DIR, f"config_{glider_tag}.ini"),\
+                os.path.join(EO_dir, glider_tag+'_hydrography.nc'),\
+                append=ARGS.sample is not None, logging=logging,\
+                verbose=verbose)
+        except:
+            db.shout(f"Failed to derive the {glider_tag} hydrography",\
+                     logging=logging, verbose=True)
 #--EOF
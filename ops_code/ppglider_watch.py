@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+'''
+Purpose:    Near real-time daemon. Watches the download directory and
+            pushes each newly delivered glider file straight through
+            registration, staging, the trajectory file, the EO cubes (for
+            its new profiles only) and preprocessing, instead of waiting
+            for the next run of the batch chain.
+
+License:    See LICENCE.txt
+'''
+#-imports-----------------------------------------------------------------------
+import os
+import datetime
+import logging
+import argparse
+import warnings
+import sys
+import time
+import signal
+import queue
+import threading
+import configparser
+import numpy as np
+
+# add paths/tools
+import tools.database_tools as db
+import tools.glider_tools as gt
+import tools.watch_tools as wt
+import tools.metrics_tools as mt
+import tools.profiling_tools as pf
+
+# EO cube settings need the EO credentials file; without it the daemon
+# leaves EO flying to ppglider_acquire_eo
+try:
+    from ppglider_acquire_eo_config import tra_config
+except:
+    tra_config = None
+
+#-messages----------------------------------------------------------------------
+print('RUNNING: WARNINGS ARE SUPPRESSED')
+warnings.filterwarnings('ignore')
+
+#-functions---------------------------------------------------------------------
+def glider_config(glider_tag):
+    return os.path.join(DEFAULT_CFG_DIR, f"config_{glider_tag}.ini")
+
+def file_row(database_name, table_name, file_name):
+    '''
+     Glider tag and staged flag of a registered file
+    '''
+    conn, c = db.connectDB(database_name)
+    c.execute(f"SELECT glider_prefix, glider_number, glider_name, staged"
+              f" FROM {table_name} WHERE file_downloaded = ?", (file_name,))
+    row = c.fetchone()
+    conn.close()
+    if row is None:
+        return None, None
+    return f"{row[0]}_{row[1]}_{row[2]}", str(row[3])
+
+def preprocessed_profiles(database_name, profile_table, file_name):
+    '''
+     Profile numbers of a downloaded file that are already preprocessed
+    '''
+    conn, c = db.connectDB(database_name)
+    c.execute(f"SELECT profile_number FROM {profile_table} WHERE"
+              " file_downloaded = ? AND preproc = 1", (file_name,))
+    done = set([row[0] for row in c.fetchall()])
+    conn.close()
+    return done
+
+def backlog_files(database_name, table_name, download_dir):
+    '''
+     Downloaded files that have not been staged yet, oldest name first
+    '''
+    conn, c = db.connectDB(database_name)
+    c.execute(f"SELECT file_downloaded FROM {table_name} WHERE staged = 1")
+    staged = set([row[0] for row in c.fetchall()])
+    conn.close()
+    return sorted([path for path in wt.directory_snapshot(download_dir, '*.nc')\
+                   if path not in staged])
+
+def preprocess_new_profiles(profiles, GLIDER_CONFIG, eo_values, eo_profiles,\
+                            mission_state, module_config, hydro_file=None,\
+                            stats_file=None, verbose=False):
+    '''
+     Preprocesses each new staged profile with its EO values and mission
+     hydrography; MLD/ZEU carry over between dives and Hemsley statistics
+     build up in stats_file. Returns the profiles and files done and the
+     profiles left waiting for the Hemsley regression.
+    '''
+    staged_dir = os.path.abspath(module_config['DIRECTORIES']['staged_dir'])
+    preproc_dir = os.path.abspath(module_config['DIRECTORIES'].get(\
+                  'preproc_dir', './preprocessed'))
+
+    preproc_files = []
+    preproc_profiles = []
+    pending_profiles = []
+    for prof_number, staged_file in profiles:
+        if staged_file.endswith('_bad.nc'):
+            continue
+        match = np.flatnonzero(np.asarray(eo_profiles) == prof_number)
+        profile_eo = dict([(calc_var, values[match[0]]) for calc_var, values \
+                           in eo_values.items() if len(match)])
+
+        preproc_file = staged_file.replace(staged_dir, preproc_dir)
+        success, mission_state['last_MLD'], mission_state['last_ZEU'], \
+          state = gt.preprocess_profile(staged_file, preproc_file, GLIDER_CONFIG,\
+                profile_eo, mission_state.get('last_MLD', np.nan),\
+                mission_state.get('last_ZEU', np.nan), hydro_file=hydro_file,\
+                stats_file=stats_file, logging=logging, verbose=verbose)
+        if success:
+            preproc_files.append(preproc_file)
+            preproc_profiles.append(prof_number)
+            if state == gt.HEMSLEY_PENDING:
+                pending_profiles.append(prof_number)
+
+    return preproc_profiles, preproc_files, pending_profiles
+
+def process_new_file(download_file, context):
+    '''
+     Pushes one newly delivered file through the chain. A file delivered
+     again (e.g. a growing mission file) is staged again and its profiles
+     not yet preprocessed go on; a repeated event for a file unchanged
+     since it was staged is skipped.
+    '''
+    module_config = context['module_config']
+    database_name = context['database_name']
+    table_name = context['table_name']
+    verbose = context['verbose']
+
+    stat = os.stat(download_file)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    if context['delivered'].get(download_file) == signature:
+        db.shout(f"{download_file} unchanged since staged; skipping",\
+                 logging=logging, verbose=verbose)
+        return 'skipped'
+
+    # registration
+    db.add_new_file_row(database_name, 'file_downloaded', module_config,\
+                        download_file, stat.st_mtime,\
+                        logging=logging, verbose=verbose)
+    glider_tag, staged = file_row(database_name, table_name, download_file)
+    if staged == '1':
+        db.shout(f"{download_file} delivered again; re-staging",\
+                 logging=logging, verbose=verbose)
+    GLIDER_CONFIG = glider_config(glider_tag)
+    if not os.path.exists(GLIDER_CONFIG):
+        db.shout(f"Config {GLIDER_CONFIG} does not exist; please create it!!",\
+                 logging=logging, verbose=True)
+        return 'no config'
+
+    # staging, keeping the new profiles' trajectory in memory
+    preproc_file = download_file.replace(context['download_dir'],\
+                                         context['staged_dir'])
+    if not os.path.exists(os.path.dirname(preproc_file)):
+        os.makedirs(os.path.dirname(preproc_file))
+        os.chmod(os.path.dirname(preproc_file), 0o777)
+    trajectory = {}
+    split_files, staged_files = gt.stage_file(download_file, preproc_file,\
+                                GLIDER_CONFIG, module_config,\
+                                trajectory=trajectory,\
+                                max_profiles=pf.sample_left(), logging=logging)
+    # --sample can stop part way through a file, which stays unstaged
+    done = len(staged_files) == len(split_files)
+    db.set_staged(database_name, table_name, download_file,\
+                  os.path.dirname(preproc_file), split_files,\
+                  profile_table=context['profile_table'],\
+                  glider_tag=glider_tag, profiles=gt.profile_summaries(\
+                  GLIDER_CONFIG, split_files, staged_files, trajectory),\
+                  done=done)
+    pf.sampled(len(staged_files))
+    if done:
+        context['delivered'][download_file] = signature
+    if staged == '1':
+        # only the profiles of a re-delivery not through the chain yet
+        done_profiles = preprocessed_profiles(database_name,\
+                        context['profile_table'], download_file)
+        new = [(split_file, staged_file) for split_file, staged_file in \
+               zip(split_files, staged_files) if \
+               gt.get_profile_number(split_file) not in done_profiles]
+        split_files = [split_file for split_file, _ in new]
+        staged_files = [staged_file for _, staged_file in new]
+        trajectory = gt.read_trajectory_files(GLIDER_CONFIG, staged_files)
+    if not staged_files:
+        # the dive is still open; it completes with the next delivery
+        return 'staged'
+
+    # trajectory append
+    EO_dir = os.path.join(os.path.abspath(module_config['DIRECTORIES']['eo_dir']),\
+                          glider_tag)
+    if not os.path.exists(EO_dir):
+        os.makedirs(EO_dir)
+    gt.update_trajectory(GLIDER_CONFIG, os.path.join(EO_dir,\
+                         glider_tag+'_trajectory.nc'), trajectory,\
+                         staged_files, logging=logging)
+
+    # hydrography append
+    hydro_file = os.path.join(EO_dir, glider_tag+'_hydrography.nc')
+    gt.write_mission_hydrography([staged_file for staged_file in staged_files \
+                                  if not staged_file.endswith('_bad.nc')],\
+                                 GLIDER_CONFIG, hydro_file, append=True,\
+                                 logging=logging, verbose=verbose)
+
+    # EO flight for just the new profiles
+    eo_values, eo_profiles, missing = {}, [], []
+    if tra_config is not None:
+        eo_values, eo_profiles, missing = gt.fly_profiles(EO_dir,\
+                                          GLIDER_CONFIG, trajectory,\
+                                          module_config, tra_config,\
+                                          logging=logging, verbose=verbose)
+    today = datetime.datetime.now().strftime('%Y%m%d_%H%M')
+    conn, c = db.connectDB(database_name)
+    c.execute(f"UPDATE {table_name} SET eo_acquire = ?, eo_acquire_state = ?,"
+              " eo_acquire_date = ?, eo_acquire_dir = ? WHERE file_downloaded = ?",
+              (0 if missing else 1,\
+               'missing: '+','.join(missing) if missing else None,\
+               today, EO_dir, download_file))
+    conn.commit()
+    conn.close()
+    if len(eo_profiles):
+        db.set_profile_stage(database_name, context['profile_table'],\
+                             'eo_acquire', glider_tag, eo_profiles,\
+                             done=not missing,\
+                             state='missing: '+','.join(missing) \
+                                   if missing else None)
+
+    # preprocessing
+    profiles = [(gt.get_profile_number(split_file), staged_file) for \
+                split_file, staged_file in zip(split_files, staged_files)]
+    stats_file = gt.hemsley_stats_file(EO_dir, glider_tag)
+    preproc_profiles, preproc_files, pending_profiles = \
+        preprocess_new_profiles(profiles, GLIDER_CONFIG, eo_values,\
+                    eo_profiles, context['missions'].setdefault(glider_tag, {}),\
+                    module_config, hydro_file=hydro_file,\
+                    stats_file=stats_file, verbose=verbose)
+    if preproc_files:
+        conn, c = db.connectDB(database_name)
+        c.execute(f"UPDATE {table_name} SET preproc = 1, preproc_date = ?,"
+                  " preproc_dir = ?, preproc_files = ? WHERE file_downloaded = ?",
+                  (today, os.path.dirname(preproc_files[0]),\
+                   ','.join(preproc_files), download_file))
+        conn.commit()
+        conn.close()
+        db.set_profile_stage(database_name, context['profile_table'],\
+                             'preproc', glider_tag, preproc_profiles,\
+                             files=preproc_files)
+    if pending_profiles:
+        db.set_profile_stage(database_name, context['profile_table'],\
+                             'preproc', glider_tag, pending_profiles,\
+                             state=gt.HEMSLEY_PENDING)
+
+    # day profiles that waited for the Hemsley regression
+    if os.path.exists(stats_file):
+        pending = db.profiles_in_state(database_name, context['profile_table'],\
+                                       'preproc', gt.HEMSLEY_PENDING, glider_tag)
+        corrected = gt.correct_hemsley_pending(GLIDER_CONFIG, stats_file,\
+                        [row['preproc_file'] for row in pending],\
+                        logging=logging, verbose=verbose)
+        db.set_profile_stage(database_name, context['profile_table'],\
+                             'preproc', glider_tag, [row['profile_number'] \
+                             for row in pending if row['preproc_file'] in \
+                             corrected])
+
+    return f"{len(staged_files)} profiles, {len(preproc_files)} preprocessed"
+
+#-default parameters------------------------------------------------------------
+OUT_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_LOG_PATH = os.path.join(OUT_ROOT, 'logs')
+DEFAULT_CFG_DIR = os.path.join(OUT_ROOT, 'configs')
+DEFAULT_CFG_FILE = os.path.join(DEFAULT_CFG_DIR, 'config_main.ini')
+
+#-arguments---------------------------------------------------------------------
+
+PARSER = argparse.ArgumentParser()
+PARSER.add_argument('-cfg', '--config_file', type=str,\
+                    default=DEFAULT_CFG_FILE,\
+                    help='Config file')
+PARSER.add_argument('-q', '--queue_size', type=int,\
+                    default=None,\
+                    help='Maximum files waiting to be processed')
+PARSER.add_argument('-p', '--poll', action='store_true',\
+                    help='Poll the download directory instead of using inotify')
+PARSER.add_argument('-v', '--verbose',\
+                    action='store_true')
+PARSER.add_argument('-l', '--log_path', type=str,\
+                    default=DEFAULT_LOG_PATH,\
+                    help='log file output path')
+pf.add_profiling_arguments(PARSER)
+ARGS = PARSER.parse_args()
+
+#-main--------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    verbose = ARGS.verbose
+
+    # preliminary stuff
+    LOGFILE = os.path.join(ARGS.log_path,"PPglider_watch_"+\
+              datetime.datetime.now().strftime('%Y%m%d_%H%M')+".log")
+
+    # make required log directory if it does not exist
+    if not os.path.exists(os.path.abspath(ARGS.log_path)):
+        os.makedirs(ARGS.log_path)
+
+    # set file logger
+    try:
+        if os.path.exists(LOGFILE):
+            os.remove(LOGFILE)
+        print("logging to: "+LOGFILE)
+        logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
+    except:
+        print("Failed to set logger")
+        sys.exit()
+
+    # opt-in profiling (--profile, --trace-memory, --sample)
+    pf.start_profiling(ARGS, LOGFILE, logging=logging)
+
+    # read processing config file
+    module_config = configparser.ConfigParser(allow_no_value=True)
+    module_config.read(ARGS.config_file)
+    watch_config = {'queue_size': '64', 'poll_interval': '5', 'settle': '2'}
+    if module_config.has_section('WATCH'):
+        watch_config.update(dict(module_config['WATCH']))
+    if ARGS.queue_size:
+        watch_config['queue_size'] = ARGS.queue_size
+
+    # set database names
+    database_name = os.path.join(os.path.abspath(module_config['DIRECTORIES']['database_dir']),
+      module_config['DATABASE']['database_name'])
+    download_dir = os.path.abspath(module_config['DIRECTORIES']['download_dir'])
+    for dir_key in ['database_dir', 'download_dir', 'staged_dir']:
+        if not os.path.exists(os.path.abspath(module_config['DIRECTORIES'][dir_key])):
+            os.makedirs(os.path.abspath(module_config['DIRECTORIES'][dir_key]))
+    db.create_table(database_name, module_config)
+    mt.configure(database_name, 'watch', logging=logging)
+
+    context = {'module_config': module_config,
+               'database_name': database_name,
+               'table_name': module_config['DATABASE']['table_name'],
+               'profile_table': db.profile_table(module_config),
+               'download_dir': download_dir,
+               'staged_dir': os.path.abspath(module_config['DIRECTORIES']['staged_dir']),
+               'missions': {},
+               'delivered': {},
+               'verbose': verbose}
+    if tra_config is None:
+        db.shout("No EO configuration; EO flying left to ppglider_acquire_eo",\
+                 logging=logging, verbose=True, level='warning')
+
+    # the watcher thread feeds a bounded queue; this thread works it
+    watcher = wt.DirectoryWatcher(download_dir,\
+                  poll_interval=float(watch_config['poll_interval']),\
+                  settle=float(watch_config['settle']),\
+                  use_inotify=not ARGS.poll)
+    work_queue = queue.Queue(maxsize=int(watch_config['queue_size']))
+    stop_event = threading.Event()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signum, lambda *args: stop_event.set())
+
+    backlog = backlog_files(database_name, context['table_name'], download_dir)
+    feeder = threading.Thread(target=wt.feed_queue, args=(watcher, work_queue,\
+                              stop_event), kwargs={'backlog': backlog,\
+                              'logging': logging, 'verbose': verbose},\
+                              daemon=True)
+    feeder.start()
+    db.shout(f"Watching {download_dir} ({watcher.mode}); {len(backlog)} files "\
+             "in backlog", logging=logging, verbose=True)
+
+    while not stop_event.is_set():
+        try:
+            download_file, queued = work_queue.get(timeout=1.0)
+        except queue.Empty:
+            continue
+
+        t0 = time.time()
+        try:
+            status = process_new_file(download_file, context)
+        except:
+            status = 'failed'
+        db.shout(f"{download_file}: {status} in {time.time()-t0:.2f} s"\
+                 f" ({time.time()-queued:.2f} s since queued,"\
+                 f" {work_queue.qsize()} waiting)", logging=logging,\
+                 verbose=verbose)
+
+        # --sample: stop once enough profiles have been through the chain
+        if pf.sample_full():
+            db.shout("Sample complete; stopping", logging=logging, verbose=True)
+            stop_event.set()
+
+    feeder.join()
+
+    # opt-in Hemsley regression plots, once per mission
+    if module_config['DIRECTORIES'].get('plot_dir'):
+        gt.plot_hemsley_regressions(os.path.abspath(\
+            module_config['DIRECTORIES']['eo_dir']), os.path.abspath(\
+            module_config['DIRECTORIES']['plot_dir']), logging=logging,\
+            verbose=verbose)
+    db.shout("Watcher stopped", logging=logging, verbose=True)
+#--EOF
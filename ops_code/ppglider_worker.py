@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+'''
+Purpose:    Parallel worker for the staging, EO flight and preprocessing
+            stages. Workers claim jobs from the job queue (the processing
+            database, or a ppglider_job_server on another machine) under a
+            lease, so any number of them can run side by side without
+            processing a file twice. Each finished job queues the next
+            stage for its profiles.
+
+License:    See LICENCE.txt
+'''
+#-imports-----------------------------------------------------------------------
+import os
+import datetime
+import logging
+import argparse
+import warnings
+import sys
+import time
+import traceback
+import configparser
+import multiprocessing
+import numpy as np
+
+# add paths/tools
+import tools.database_tools as db
+import tools.glider_tools as gt
+import tools.job_tools as jt
+import tools.metrics_tools as mt
+import tools.profiling_tools as pf
+
+# EO cube settings need the EO credentials file; without it EO flying is
+# left to ppglider_acquire_eo
+try:
+    from ppglider_acquire_eo_config import tra_config
+except:
+    tra_config = None
+
+#-messages----------------------------------------------------------------------
+print('RUNNING: WARNINGS ARE SUPPRESSED')
+warnings.filterwarnings('ignore')
+
+#-functions---------------------------------------------------------------------
+def glider_config(glider_tag):
+    return os.path.join(DEFAULT_CFG_DIR, f"config_{glider_tag}.ini")
+
+def queue_downloads(jobs, database_name, table_name, re_stage=False):
+    '''
+    Queues a staging job for every downloaded file not staged yet, again
+    if an earlier job left it unstaged (e.g. cut short by --sample). The
+    dives of a glider are split statefully, so they form one job group.
+    '''
+    conn, c = db.connectDB(database_name)
+    c.execute(f"SELECT file_downloaded, glider_prefix, glider_number,"
+              f" glider_name, staged FROM {table_name} ORDER BY file_downloaded")
+    rows = c.fetchall()
+    conn.close()
+
+    new_jobs = []
+    for download_file, prefix, number, name, staged in rows:
+        if str(staged) == '1' and not re_stage:
+            continue
+        glider_tag = f"{prefix}_{number}_{name}"
+        new_jobs.append(('staging', download_file, 'staging:'+glider_tag,\
+                         {'glider_tag': glider_tag}))
+    return jobs.add(new_jobs, reset=True)
+
+def run_staging(job, context):
+    '''
+    Stages a downloaded file and appends its profiles to the mission
+    trajectory; queues their EO flight
+    '''
+    module_config = context['module_config']
+    download_file = job['target']
+    glider_tag = job['payload']['glider_tag']
+    GLIDER_CONFIG = glider_config(glider_tag)
+    if not os.path.exists(GLIDER_CONFIG):
+        raise IOError(f"Config {GLIDER_CONFIG} does not exist; please create it!!")
+
+    preproc_file = download_file.replace(\
+        os.path.abspath(module_config['DIRECTORIES']['download_dir']),\
+        os.path.abspath(module_config['DIRECTORIES']['staged_dir']))
+    if not os.path.exists(os.path.dirname(preproc_file)):
+        os.makedirs(os.path.dirname(preproc_file), exist_ok=True)
+        os.chmod(os.path.dirname(preproc_file), 0o777)
+    # --sample: the workers share one budget; take what is left and give
+    # back what this file does not use. While another worker holds the
+    # budget, wait for what it gives back.
+    reserved = pf.reserve_sample()
+    while reserved == 0 and pf.sample_reserved():
+        time.sleep(context['poll_interval'])
+        reserved = pf.reserve_sample()
+    if reserved == 0:
+        return 'held back by --sample', [], []
+    trajectory = {}
+    staged_files = []
+    try:
+        split_files, staged_files = gt.stage_file(download_file, preproc_file,\
+                                    GLIDER_CONFIG, module_config,\
+                                    trajectory=trajectory,\
+                                    max_profiles=reserved, logging=logging)
+    finally:
+        pf.release_sample(reserved, len(staged_files))
+
+    updates = []
+    if len(staged_files) == len(split_files):
+        # a file cut short by --sample stays unstaged
+        updates.append({'file': download_file,\
+                'set': {'staged': 1, 'staged_dir': os.path.dirname(preproc_file),\
+                        'staged_date': context['today'],\
+                        'staged_files': ','.join(split_files),\
+                        'eo_acquire': 0, 'preproc': 0, 'spectral': 0,\
+                        'corrected': 0, 'primary_prod': 0, 'postproc': 0}})
+    if not staged_files:
+        # the dive is still open; it completes with the next delivery
+        return 'staged, dive open', updates, []
+
+    updates.append({'file': download_file, 'glider_tag': glider_tag,\
+                    'profiles': gt.profile_summaries(GLIDER_CONFIG,\
+                                split_files, staged_files, trajectory)})
+
+    EO_dir = os.path.join(os.path.abspath(module_config['DIRECTORIES']['eo_dir']),\
+                          glider_tag)
+    os.makedirs(EO_dir, exist_ok=True)
+    gt.update_trajectory(GLIDER_CONFIG, os.path.join(EO_dir,\
+                         glider_tag+'_trajectory.nc'), trajectory,\
+                         staged_files, logging=logging)
+    gt.write_mission_hydrography([staged_file for staged_file in staged_files \
+                                  if not staged_file.endswith('_bad.nc')],\
+                                 GLIDER_CONFIG, os.path.join(EO_dir,\
+                                 glider_tag+'_hydrography.nc'), append=True,\
+                                 logging=logging)
+
+    profiles = [[gt.get_profile_number(split_file), staged_file] for \
+                split_file, staged_file in zip(split_files, staged_files)]
+    next_jobs = [('eo_flight', download_file, 'eo_flight:'+glider_tag,\
+                  {'glider_tag': glider_tag, 'profiles': profiles})]
+    return f"{len(staged_files)} profiles staged", updates, next_jobs
+
+def run_eo_flight(job, context):
+    '''
+    Flies the staged profiles of a downloaded file through the mission EO
+    cubes; queues their preprocessing
+    '''
+    module_config = context['module_config']
+    download_file = job['target']
+    glider_tag = job['payload']['glider_tag']
+    profiles = job['payload']['profiles']
+    GLIDER_CONFIG = glider_config(glider_tag)
+    EO_dir = os.path.join(os.path.abspath(module_config['DIRECTORIES']['eo_dir']),\
+                          glider_tag)
+
+    eo_values, eo_profiles, missing = {}, [], ['all (no EO configuration)']
+    if tra_config is not None:
+        trajectory = gt.read_trajectory_files(GLIDER_CONFIG,\
+                     [staged_file for _, staged_file in profiles])
+        eo_values, eo_profiles, missing = gt.fly_profiles(EO_dir,\
+                                          GLIDER_CONFIG, trajectory,\
+                                          module_config, tra_config,\
+                                          logging=logging,\
+                                          verbose=context['verbose'])
+
+    next_jobs = []
+    for prof_number, staged_file in profiles:
+        if staged_file.endswith('_bad.nc'):
+            continue
+        match = np.flatnonzero(np.asarray(eo_profiles) == prof_number)
+        profile_eo = dict([(calc_var, float(values[match[0]])) for \
+                           calc_var, values in eo_values.items() if len(match)])
+        next_jobs.append(('preproc', staged_file, 'preproc:'+glider_tag,\
+                          {'glider_tag': glider_tag,\
+                           'profile_number': int(prof_number),\
+                           'download_file': download_file, 'eo': profile_eo}))
+
+    state = 'missing: '+','.join(missing) if missing else None
+    updates = [{'file': download_file,\
+                'set': {'eo_acquire': 0 if missing else 1,\
+                        'eo_acquire_state': state,\
+                        'eo_acquire_date': context['today'],\
+                        'eo_acquire_dir': EO_dir}}]
+    updates.extend([{'table': 'profiles',\
+                     'where': {'glider_tag': glider_tag,\
+                               'profile_number': int(prof_number)},\
+                     'set': {'eo_acquire': 0 if missing else 1,\
+                             'eo_acquire_state': state,\
+                             'eo_acquire_date': context['today']}}\
+                    for prof_number in eo_profiles])
+    return f"{len(eo_profiles)} profiles flown", updates, next_jobs
+
+def run_preproc(job, context):
+    '''
+    Preprocesses one staged profile with its EO values. The profiles of a
+    glider form one job group, so the MLD/ZEU of the previous profile are
+    in the profile table to carry over. Day profiles preprocessed before
+    the mission had a Hemsley regression are corrected once it has one.
+    '''
+    module_config = context['module_config']
+    staged_file = job['target']
+    glider_tag = job['payload']['glider_tag']
+    preproc_file = staged_file.replace(\
+        os.path.abspath(module_config['DIRECTORIES']['staged_dir']),\
+        os.path.abspath(module_config['DIRECTORIES'].get('preproc_dir',\
+                                                         './preprocessed')))
+    EO_dir = os.path.join(os.path.abspath(module_config['DIRECTORIES']['eo_dir']),\
+                          glider_tag)
+    stats_file = gt.hemsley_stats_file(EO_dir, glider_tag)
+    previous = context['jobs'].previous_profile(glider_tag,\
+                                                job['payload']['profile_number'])
+    last_MLD, last_ZEU = np.nan, np.nan
+    if previous is not None:
+        last_MLD = np.nan if previous['mld'] is None else previous['mld']
+        last_ZEU = np.nan if previous['zeu'] is None else previous['zeu']
+    success, last_MLD, last_ZEU, state = gt.preprocess_profile(staged_file,\
+                    preproc_file, glider_config(glider_tag),\
+                    job['payload']['eo'], last_MLD, last_ZEU,\
+                    hydro_file=os.path.join(EO_dir,\
+                    glider_tag+'_hydrography.nc'), stats_file=stats_file,\
+                    logging=logging, verbose=context['verbose'])
+    if not success:
+        raise RuntimeError(f"Failed to preprocess {staged_file}")
+
+    updates = [{'file': job['payload']['download_file'],\
+                'set': {'preproc': 1, 'preproc_date': context['today'],\
+                        'preproc_dir': os.path.dirname(preproc_file)},\
+                'append': {'preproc_files': preproc_file}},\
+               {'table': 'profiles',\
+                'where': {'glider_tag': glider_tag,\
+                          'profile_number': job['payload']['profile_number']},\
+                'set': {'preproc': 1, 'preproc_date': context['today'],\
+                        'preproc_state': state, 'preproc_file': preproc_file,\
+                        'mld': float(last_MLD) if np.isfinite(last_MLD) \
+                               else None,\
+                        'zeu': float(last_ZEU) if np.isfinite(last_ZEU) \
+                               else None}}]
+
+    # day profiles that waited for the Hemsley regression
+    if state is None and os.path.exists(stats_file):
+        pending = context['jobs'].profiles_in_state(glider_tag, 'preproc',\
+                                                    gt.HEMSLEY_PENDING)
+        corrected = gt.correct_hemsley_pending(glider_config(glider_tag),\
+                        stats_file, [row['preproc_file'] for row in pending],\
+                        logging=logging, verbose=context['verbose'])
+        updates.extend([{'table': 'profiles',\
+                         'where': {'glider_tag': glider_tag,\
+                                   'profile_number': row['profile_number']},\
+                         'set': {'preproc_state': None}} \
+                        for row in pending if row['preproc_file'] in corrected])
+    if state:
+        return 'preprocessed, '+state, updates, []
+    return 'preprocessed', updates, []
+
+STAGES = {'staging': run_staging,
+          'eo_flight': run_eo_flight,
+          'preproc': run_preproc}
+
+def work(worker_number, jobs_location, context):
+    '''
+    Claims and runs jobs until stopped, or until the queue is empty when
+    exit_idle is set. With --sample the workers stop claiming staging jobs
+    once they have staged that many profiles between them; while a worker
+    holds part of the budget, the others wait for what it gives back.
+    '''
+    pf.restart_profiling(f"_{worker_number}")
+    try:
+        work_jobs(worker_number, jobs_location, context)
+    finally:
+        pf.stop_profiling()
+
+def work_jobs(worker_number, jobs_location, context):
+    jobs = jt.job_queue(jobs_location, context['table_name'],\
+                        max_attempts=context['max_attempts'],\
+                        profile_table=context['profile_table'])
+    owner = f"{jt.job_owner()}:{worker_number}"
+    context['jobs'] = jobs
+    lease_seconds = context['lease_seconds']
+    verbose = context['verbose']
+
+    while True:
+        stages = context['stages']
+        if pf.sample_full():
+            stages = [stage for stage in stages if stage != 'staging']
+            if not stages:
+                if not pf.sample_reserved():
+                    break
+                # another worker may give part of the budget back
+                time.sleep(context['poll_interval'])
+                continue
+        job = jobs.claim(stages, owner, lease_seconds)
+        if job is None:
+            summary = jobs.summary()
+            busy = sum([counts.get('pending', 0)+counts.get('leased', 0) \
+                        for stage, counts in summary.items() \
+                        if stage in stages])
+            if context['exit_idle'] and not busy and not pf.sample_reserved():
+                break
+            time.sleep(context['poll_interval'])
+            continue
+
+        db.shout(f"{owner}: {job['stage']} {job['target']} (attempt "\
+                 f"{job['attempts']})", logging=logging, verbose=verbose)
+        context['today'] = datetime.datetime.now().strftime('%Y%m%d_%H%M')
+        done_event = jt.start_lease_keeper(jobs, job['job_id'], owner,\
+                                           lease_seconds)
+        t0 = time.time()
+        try:
+            message, updates, next_jobs = STAGES[job['stage']](job, context)
+            success = True
+        except:
+            message = traceback.format_exc().strip().splitlines()[-1]
+            updates, next_jobs, success = None, None, False
+        done_event.set()
+
+        if not jobs.complete(job['job_id'], owner, success, message,\
+                             updates=updates, next_jobs=next_jobs):
+            db.shout(f"{owner}: lost the lease on {job['target']}; its "\
+                     "result was discarded", logging=logging, verbose=True,\
+                     level='warning')
+            continue
+        db.shout(f"{owner}: {job['stage']} {job['target']}: {message} in "\
+                 f"{time.time()-t0:.2f} s", logging=logging,\
+                 verbose=verbose, level='info' if success else 'error')
+
+#-default parameters------------------------------------------------------------
+OUT_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_LOG_PATH = os.path.join(OUT_ROOT, 'logs')
+DEFAULT_CFG_DIR = os.path.join(OUT_ROOT, 'configs')
+DEFAULT_CFG_FILE = os.path.join(DEFAULT_CFG_DIR, 'config_main.ini')
+
+#-arguments---------------------------------------------------------------------
+
+PARSER = argparse.ArgumentParser()
+PARSER.add_argument('-cfg', '--config_file', type=str,\
+                    default=DEFAULT_CFG_FILE,\
+                    help='Config file')
+PARSER.add_argument('-u', '--url', type=str,\
+                    default=None,\
+                    help='Job server URL (default: the processing database)')
+PARSER.add_argument('-n', '--n_workers', type=int,\
+                    default=None,\
+                    help='Worker processes (default: [JOBS] n_workers);'\
+                         ' 0 only queues jobs')
+PARSER.add_argument('-s', '--stages', type=str,\
+                    default=','.join(STAGES),\
+                    help='Comma separated stages to work on')
+PARSER.add_argument('-e', '--enqueue', action='store_true',\
+                    help='Queue staging jobs for unstaged downloaded files')
+PARSER.add_argument('-r', '--re_stage', action='store_true',\
+                    help='With -e, queue staged files again as well')
+PARSER.add_argument('-x', '--exit_idle', action='store_true',\
+                    help='Stop once no jobs are pending')
+PARSER.add_argument('-v', '--verbose',\
+                    action='store_true')
+PARSER.add_argument('-l', '--log_path', type=str,\
+                    default=DEFAULT_LOG_PATH,\
+                    help='log file output path')
+pf.add_profiling_arguments(PARSER)
+ARGS = PARSER.parse_args()
+
+#-main--------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    verbose = ARGS.verbose
+
+    # preliminary stuff
+    LOGFILE = os.path.join(ARGS.log_path,"PPglider_worker_"+\
+              datetime.datetime.now().strftime('%Y%m%d_%H%M')+"_"+\
+              str(os.getpid())+".log")
+
+    # make required log directory if it does not exist
+    if not os.path.exists(os.path.abspath(ARGS.log_path)):
+        os.makedirs(ARGS.log_path)
+
+    # set file logger
+    try:
+        if os.path.exists(LOGFILE):
+            os.remove(LOGFILE)
+        print("logging to: "+LOGFILE)
+        logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
+    except:
+        print("Failed to set logger")
+        sys.exit()
+
+    # opt-in profiling (--profile, --trace-memory, --sample)
+    pf.start_profiling(ARGS, LOGFILE, logging=logging)
+
+    # read processing config file
+    module_config = configparser.ConfigParser(allow_no_value=True)
+    module_config.read(ARGS.config_file)
+    jobs_config = {'n_workers': '0', 'lease_seconds': '600',\
+                   'max_attempts': '3', 'poll_interval': '5'}
+    if module_config.has_section('JOBS'):
+        jobs_config.update(dict(module_config['JOBS']))
+    n_workers = ARGS.n_workers
+    if n_workers is None:
+        n_workers = int(jobs_config['n_workers']) or multiprocessing.cpu_count()
+
+    # set database names
+    database_name = os.path.join(os.path.abspath(module_config['DIRECTORIES']['database_dir']),
+      module_config['DATABASE']['database_name'])
+    table_name = module_config['DATABASE']['table_name']
+    jobs_location = ARGS.url or database_name
+    if not ARGS.url:
+        db.create_table(database_name, module_config)
+        mt.configure(database_name, 'worker', logging=logging)
+
+    stages = ARGS.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            db.shout(f"Unknown stage {stage}; choose from {','.join(STAGES)}",\
+                     logging=logging, verbose=True, level='error')
+            sys.exit()
+    if 'eo_flight' in stages and tra_config is None:
+        db.shout("No EO configuration; EO flight jobs will pass profiles on "\
+                 "without EO values", logging=logging, verbose=True,\
+                 level='warning')
+
+    jobs = jt.job_queue(jobs_location, table_name,\
+                        max_attempts=int(jobs_config['max_attempts']),\
+                        profile_table=db.profile_table(module_config))
+    if ARGS.enqueue:
+        if ARGS.url:
+            db.shout("Staging jobs are queued where the database is; run -e "\
+                     "there", logging=logging, verbose=True, level='error')
+            sys.exit()
+        added = queue_downloads(jobs, database_name, table_name,\
+                                re_stage=ARGS.re_stage)
+        db.shout(f"Queued {added} staging jobs", logging=logging, verbose=True)
+
+    context = {'module_config': module_config,
+               'table_name': table_name,
+               'profile_table': db.profile_table(module_config),
+               'stages': stages,
+               'lease_seconds': float(jobs_config['lease_seconds']),
+               'max_attempts': int(jobs_config['max_attempts']),
+               'poll_interval': float(jobs_config['poll_interval']),
+               'exit_idle': ARGS.exit_idle,
+               'verbose': verbose}
+
+    db.shout(f"Starting {n_workers} workers on {jobs_location}",\
+             logging=logging, verbose=True)
+    pf.share_sample()
+    workers = [multiprocessing.Process(target=work, args=(i, jobs_location,\
+               context)) for i in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+
+    db.shout(f"Jobs: {jobs.summary()}", logging=logging, verbose=True)
+
+    # opt-in Hemsley regression plots, once per mission
+    if module_config['DIRECTORIES'].get('plot_dir') and not ARGS.url:
+        gt.plot_hemsley_regressions(os.path.abspath(\
+            module_config['DIRECTORIES']['eo_dir']), os.path.abspath(\
+            module_config['DIRECTORIES']['plot_dir']), logging=logging,\
+            verbose=verbose)
+#--EOF
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+'''
+Purpose:    Regression test of findmld (tools/mld_utils.py): the running-sum
+            line fit errors against the per-depth np.polyfit loop they
+            replaced, on the profiles of the sample missions in test_ftp.
+
+            Run from the repository root with: python -m pytest ops_code/tests
+
+License:    See LICENCE.txt
+'''
+import os, sys, glob
+import numpy as np
+import gsw
+import pytest
+from netCDF4 import Dataset
+
+OPS_CODE = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+TEST_FTP = os.path.join(os.path.dirname(OPS_CODE), 'test_ftp')
+sys.path.insert(0, OPS_CODE)
+
+import tools.mld_utils as mu
+
+#-------------------------------------------------------------------------------
+def polyfit_errors(x, y):
+    '''
+    The fit errors as findmld computed them before linefit_errors: a
+    np.polyfit line through x[0:j], y[0:j] for every j
+    '''
+    err = [0]
+    for j in range(2, len(x)+1):
+        P = np.polyfit(x[0:j], y[0:j], 1)
+        fit = np.polyval(P, x[0:j])
+        err.append(np.dot((y[0:j] - fit).T, (y[0:j] - fit)))
+    return np.asarray(err)
+
+def read_var(nc_fid, name):
+    return np.ma.filled(np.ma.asarray(nc_fid.variables[name][:]).astype(float),\
+                        np.nan)
+
+def split_profiles(pres, min_records=20):
+    '''
+    Dive and climb segments of a pressure record, split at its turning
+    points
+    '''
+    ok = np.flatnonzero(np.isfinite(pres))
+    direction = np.sign(np.diff(pres[ok]))
+    turns = ok[1:][np.flatnonzero(np.diff(direction[direction != 0]) != 0)]
+    edges = np.concatenate(([0], turns, [len(pres)]))
+    return [np.arange(lo, hi) for lo, hi in zip(edges[:-1], edges[1:]) \
+            if hi - lo >= min_records]
+
+def seaglider_profiles():
+    profiles = []
+    for nc_file in sorted(glob.glob(os.path.join(TEST_FTP, 'NRT', '*', '*',\
+                                                 'p*.nc'))):
+        nc_fid = Dataset(nc_file)
+        pres, temp, sal, lon, lat = [read_var(nc_fid, name) for name in \
+            ['pressure', 'temperature', 'salinity', 'longitude', 'latitude']]
+        nc_fid.close()
+        for ii in split_profiles(pres):
+            ASAL = gsw.SA_from_SP(sal[ii], pres[ii], np.nanmean(lon[ii]),\
+                                  np.nanmean(lat[ii]))
+            CTEMP = gsw.CT_from_t(ASAL, temp[ii], pres[ii])
+            profiles.append((os.path.basename(nc_file), pres[ii], CTEMP, ASAL))
+    return profiles
+
+def ego_profiles():
+    profiles = []
+    for nc_file in sorted(glob.glob(os.path.join(TEST_FTP, 'DT', '*', '*.nc'))):
+        nc_fid = Dataset(nc_file)
+        pres, temp, cndc, lon, lat = [read_var(nc_fid, name) for name in \
+            ['PRES', 'TEMP', 'CNDC', 'LONGITUDE', 'LATITUDE']]
+        nc_fid.close()
+        for ii in split_profiles(pres):
+            PSAL = gsw.SP_from_C(cndc[ii]*1000/100, temp[ii], pres[ii])
+            ASAL = gsw.SA_from_SP(PSAL, pres[ii], np.nanmean(lon[ii]),\
+                                  np.nanmean(lat[ii]))
+            CTEMP = gsw.CT_from_t(ASAL, temp[ii], pres[ii])
+            profiles.append((os.path.basename(nc_file), pres[ii], CTEMP, ASAL))
+    return profiles
+
+def mld_input(profile):
+    '''
+    The finite records of a profile, as preprocess_dive passes them
+    '''
+    name, pres, CTEMP, ASAL = profile
+    ii = np.where(np.isfinite(pres) & np.isfinite(CTEMP) & np.isfinite(ASAL))
+    return pres[ii], CTEMP[ii], ASAL[ii]
+
+# segments with no valid CTD records never reach the fits
+PROFILES = [profile for profile in seaglider_profiles() + ego_profiles() \
+            if len(mld_input(profile)[0]) > 2]
+
+#-------------------------------------------------------------------------------
+def test_sample_missions_found():
+    assert len(PROFILES) > 10
+
+@pytest.mark.parametrize('profile', PROFILES,\
+                         ids=[f"{profile[0]}:{ii}" for ii, profile in \
+                              enumerate(PROFILES)])
+def test_linefit_errors_match_polyfit(profile):
+    pres, CTEMP, ASAL = mld_input(profile)
+    for values in [CTEMP, ASAL]:
+        new = mu.linefit_errors(pres, values)
+        old = polyfit_errors(pres, values)
+        scale = max(np.max(np.abs(old)), 1e-12)
+        np.testing.assert_allclose(new, old, rtol=1e-6, atol=1e-8*scale)
+
+@pytest.mark.parametrize('profile', PROFILES,\
+                         ids=[f"{profile[0]}:{ii}" for ii, profile in \
+                              enumerate(PROFILES)])
+def test_findmld_matches_polyfit(profile, monkeypatch):
+    pres, CTEMP, ASAL = mld_input(profile)
+    try:
+        new = mu.findmld(pres, CTEMP, ASAL, 0, rec_cut=10, pmax=20)
+    except Exception as error:
+        new = type(error)
+    monkeypatch.setattr(mu, 'linefit_errors', polyfit_errors)
+    try:
+        old = mu.findmld(pres, CTEMP, ASAL, 0, rec_cut=10, pmax=20)
+    except Exception as error:
+        old = type(error)
+
+    if not isinstance(old, dict):
+        # profiles findmld cannot handle must still fail the same way
+        assert new == old
+        return
+    assert sorted(new.keys()) == sorted(old.keys())
+    for key in old:
+        np.testing.assert_allclose(np.asarray(new[key], dtype=float),\
+                                   np.asarray(old[key], dtype=float),\
+                                   rtol=1e-6, atol=1e-6, err_msg=key)
+
+#--EOF
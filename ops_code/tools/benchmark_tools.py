@@ -0,0 +1,572 @@
+#!/usr/bin/env python
+'''
+Purpose:    Synthetic glider missions and benchmarks of the processing hot
+            spots. A mission is a depth sawtooth of dive/climb profiles with
+            PAR, CHLA, backscatter, temperature and salinity fields, written
+            in the Seaglider (one file per dive) or EGO (one mission file)
+            layout, with matching daily EO cubes. Each benchmark case runs
+            in its own process and reports wall/CPU time and peak memory.
+
+License:    See LICENCE.txt
+'''
+import os, glob, shutil, datetime
+import contextlib
+import multiprocessing
+import traceback
+import numpy as np
+import gsw
+from netCDF4 import Dataset
+
+from . import glider_tools as gt
+from . import mld_utils as mu
+from . import fluor_correction as fcorr
+from . import metrics_tools as mt
+
+# raw file layouts: the glider config each is processed with (a repo config
+# plus overrides), its record dimension and the file variable of each field
+LAYOUTS = {'seaglider': {'template': 'config_glider_sg579_sg579.ini',
+                         'tag': 'glider_sg999_synthetic',
+                         'record_dim': 'sg_data_point',
+                         'file_per_dive': True,
+                         'float_type': 'f8',
+                         'fill_value': None,
+                         'names': {'time': 'time', 'depth': 'depth',
+                                   'pres': 'pressure', 'lon': 'longitude',
+                                   'lat': 'latitude', 'temp': 'temperature',
+                                   'sal': 'salinity',
+                                   'chla': 'eng_wlbbfl2_FL1sig',
+                                   'scatter': 'eng_wlbbfl2_BB1sig',
+                                   'par': 'eng_qsp_PARuV'},
+                         'config': {'allowed_vars': 'eng_wlbbfl2_FL1sig,'
+                                    'eng_wlbbfl2_BB1sig,eng_qsp_PARuV,'
+                                    'temperature,salinity,pressure,time,'
+                                    'longitude,latitude',
+                                    'allowed_heads': 'CHLA,SCATTER,PAR,TEMP,'
+                                    'SAL,PRES,TIME,LONGITUDE,LATITUDE',
+                                    'allowed_exact': '1,1,1,1,1,1,1,1,1'}},
+           'ego': {'template': 'config_ego_454_cabot.ini',
+                   'tag': 'ego_999_synthetic',
+                   'record_dim': 'TIME',
+                   'file_per_dive': False,
+                   'float_type': 'f4',
+                   'fill_value': 99999.,
+                   'names': {'time': 'TIME', 'pres': 'PRES',
+                             'lon': 'LONGITUDE', 'lat': 'LATITUDE',
+                             'temp': 'TEMP', 'cndc': 'CNDC', 'chla': 'CHLA',
+                             'scatter': 'BBP700', 'par': 'DOWNWELLING_PAR'},
+                   'config': {}}}
+
+# synthetic EO cubes, set up as in ppglider_acquire_eo_config
+EO_CONFIG = {'PAR': {'source': 'SYNTHETIC',
+                     'lat_var': 'lat',
+                     'lon_var': 'lon',
+                     't_var': 'time',
+                     't_ref': '2000-01-01 00:00:00',
+                     't_base': 'seconds',
+                     'vars': ['par'],
+                     'calc_vars': ['PAR'],
+                     'include': True,
+                     'NRT_clim': False,
+                     'clim_file': None},
+             'CHL': {'source': 'SYNTHETIC',
+                     'lat_var': 'lat',
+                     'lon_var': 'lon',
+                     't_var': 'time',
+                     't_ref': '1900-01-01 00:00:00',
+                     't_base': 'days',
+                     'vars': ['CHL'],
+                     'calc_vars': ['CHL', 'ZEU'],
+                     'include': True,
+                     'NRT_clim': False,
+                     'clim_file': None}}
+
+UNITS = {'time': 'seconds since 1970-01-01 00:00:00', 'depth': 'meters',
+         'pres': 'decibar', 'lon': 'degree_east', 'lat': 'degree_north',
+         'temp': 'degree_Celsius', 'sal': '1e-3', 'cndc': 'mhos/m',
+         'chla': 'mg/m3', 'scatter': 'm-1', 'par': 'microMoleQuanta/m^2/sec'}
+
+#-------------------------------------------------------------------------------
+def synthetic_mission(n_profiles, records=200, max_depth=1000., seed=0,\
+                      start=datetime.datetime(2018, 5, 1), lon0=2.0, lat0=56.0):
+    '''
+    A mission of n_profiles alternating dive and climb profiles of records
+    samples each: a noisy depth sawtooth to 50-100% of max_depth, a
+    drifting position, a mixed layer over a thermocline, a deep CHLA
+    maximum with daytime surface quenching and PAR decaying from a
+    diurnal surface value. Sensor fields have occasional gaps.
+    '''
+    rand = np.random.RandomState(seed)
+    n_dives = (n_profiles+1)//2
+    profile = np.repeat(np.arange(n_profiles), records)
+    dive = profile//2
+    climb = profile % 2
+    frac = np.tile(np.linspace(0., 1., records), n_profiles)
+
+    # sawtooth; each profile takes dive depth/vertical speed, with 15
+    # minutes at the surface between dives
+    dive_depth = max_depth*rand.uniform(0.5, 1.0, n_dives)
+    duration = dive_depth/rand.uniform(0.08, 0.15, n_dives)
+    dive_start = np.concatenate(([0.], np.cumsum(2*duration+900.)[:-1]))
+    depth = np.where(climb, 1.-frac, frac)*dive_depth[dive]
+    depth = np.abs(depth+rand.normal(0., 0.3, len(depth)))
+    t0 = (start-datetime.datetime(1970, 1, 1)).total_seconds()
+    time_s = t0+dive_start[dive]+(climb+frac)*duration[dive]
+
+    # about a kilometre of drift per dive
+    lon_dive = lon0+np.cumsum(rand.normal(0., 0.012, n_dives+1))
+    lat_dive = lat0+np.cumsum(rand.normal(0., 0.008, n_dives+1))
+    step = (climb+frac)/2.
+    lon = lon_dive[dive]+step*(lon_dive[dive+1]-lon_dive[dive])
+    lat = lat_dive[dive]+step*(lat_dive[dive+1]-lat_dive[dive])
+
+    # per profile water column
+    mld = np.clip(30.+np.cumsum(rand.normal(0., 3., n_profiles)), 10., 80.)
+    kd = rand.uniform(0.05, 0.12, n_profiles)
+    dcm = mld+rand.uniform(5., 25., n_profiles)
+    z = depth
+    thermo = 1./(1.+np.exp(np.clip((z-mld[profile])/5., -50., 50.)))
+    temp = 7.+5.*thermo-0.002*z
+    sal = 35.2-0.2*thermo
+    hour = (((time_s % 86400.)/3600.)+lon/15.) % 24.
+    daylight = np.clip(np.sin(np.pi*(hour-6.)/12.), 0., None)
+    par = 1500.*daylight*np.exp(-kd[profile]*z)
+    chla = 0.05+0.4*thermo+1.5*np.exp(-((z-dcm[profile])/10.)**2)
+    scatter = 5e-4+1e-3*chla
+    chla = chla*(1.-0.6*daylight*np.exp(-z/np.maximum(mld[profile]/2., 5.)))
+
+    noise = lambda values, scale: values+rand.normal(0., scale, len(values))
+    fields = {'time': time_s, 'depth': depth, 'lon': lon, 'lat': lat,
+              'temp': noise(temp, 0.01), 'sal': noise(sal, 0.005),
+              'par': np.abs(noise(par, 0.5)), 'chla': np.abs(noise(chla, 0.01)),
+              'scatter': np.abs(noise(scatter, 1e-5))}
+    fields['pres'] = gsw.p_from_z(-depth, lat)
+    fields['cndc'] = gsw.C_from_SP(fields['sal'], fields['temp'],\
+                                   fields['pres'])/10.
+    for name in ['temp', 'sal', 'cndc', 'par', 'chla', 'scatter']:
+        fields[name][rand.uniform(size=len(depth)) < 0.005] = np.nan
+
+    fields.update({'profile': profile, 'dive': dive, 'n_profiles': n_profiles,
+                   'records': records, 'mld': mld, 'kd': kd})
+    return fields
+
+def profile_slice(mission, profile):
+    return slice(profile*mission['records'], (profile+1)*mission['records'])
+
+def write_glider_config(layout, template_dir, output_dir):
+    '''
+    Writes the glider config of a layout: its repo template with the
+    layout overrides. Returns the config file name.
+    '''
+    GLIDER_DICT = dict(gt.read_config_file(os.path.join(template_dir,\
+                       LAYOUTS[layout]['template'])))
+    GLIDER_DICT.update(LAYOUTS[layout]['config'])
+    GLIDER_CONFIG = os.path.join(output_dir, 'config_'+LAYOUTS[layout]['tag']+\
+                                 '.ini')
+    with open(GLIDER_CONFIG, 'w') as config_fid:
+        for name, value in GLIDER_DICT.items():
+            if name:
+                config_fid.write(name+'='+value+'\n')
+    return GLIDER_CONFIG
+
+def write_records(output_file, mission, layout, records):
+    '''
+    Writes the records (a slice) of mission to a raw file of layout
+    '''
+    spec = LAYOUTS[layout]
+    nc_fid = Dataset(output_file, 'w', format='NETCDF3_CLASSIC')
+    nc_fid.createDimension(spec['record_dim'], len(mission['time'][records]))
+    for field, name in spec['names'].items():
+        dtype = 'f8' if field in ['time', 'lon', 'lat'] else spec['float_type']
+        nc_var = nc_fid.createVariable(name, dtype, (spec['record_dim'],),\
+                                       fill_value=spec['fill_value'])
+        nc_var.units = UNITS[field]
+        nc_var[:] = np.ma.masked_invalid(mission[field][records])
+    if layout == 'seaglider':
+        # GPS fixes at the start and end of the dive
+        nc_fid.createDimension('gps_info', 2)
+        for field, name in [('time', 'log_gps_time'), ('lon', 'log_gps_lon'),\
+                            ('lat', 'log_gps_lat')]:
+            nc_var = nc_fid.createVariable(name, 'f8', ('gps_info',))
+            nc_var[:] = mission[field][records][[0, -1]]
+    nc_fid.close()
+
+def write_mission(mission, layout, output_dir):
+    '''
+    Writes mission as delivered: a file per dive (Seaglider) or a single
+    mission file (EGO). Returns the file names.
+    '''
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    records = mission['records']
+    if not LAYOUTS[layout]['file_per_dive']:
+        mission_file = os.path.join(output_dir, 'Synthetic_999_R.nc')
+        write_records(mission_file, mission, layout, slice(None))
+        return [mission_file]
+
+    mission_files = []
+    for dive in range(mission['dive'][-1]+1):
+        mission_file = os.path.join(output_dir, 'p999'+str(dive+1).zfill(4)+'.nc')
+        write_records(mission_file, mission, layout,\
+                      slice(2*dive*records, (2*dive+2)*records))
+        mission_files.append(mission_file)
+    return mission_files
+
+def write_split_files(mission, layout, mission_files, output_dir):
+    '''
+    Writes each profile as the dive splitting would, named after the file
+    it came from. Returns the file names.
+    '''
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    split_files = []
+    for profile in range(mission['n_profiles']):
+        if LAYOUTS[layout]['file_per_dive']:
+            mission_file = mission_files[profile//2]
+        else:
+            mission_file = mission_files[0]
+        split_file = os.path.join(output_dir, os.path.basename(mission_file).\
+                     replace('.nc', '_'+str(profile).zfill(6)+'.nc'))
+        write_records(split_file, mission, layout, profile_slice(mission, profile))
+        split_files.append(split_file)
+    return split_files
+
+def write_mission_trajectory(mission, GLIDER_CONFIG, output_file):
+    '''
+    Writes the mission trajectory file staging would build
+    '''
+    GLIDER_DICT = gt.read_config_file(GLIDER_CONFIG)
+    trajectory = {}
+    for field, name in [('lon', GLIDER_DICT['lon_var']),\
+                        ('lat', GLIDER_DICT['lat_var']),\
+                        ('time', GLIDER_DICT['t_var'])]:
+        trajectory[name] = [mission[field][profile_slice(mission, profile)] \
+                            for profile in range(mission['n_profiles'])]
+    trajectory[GLIDER_DICT['profile_var']] = \
+        [np.ones(mission['records'])*profile for profile in \
+         range(mission['n_profiles'])]
+    gt.write_trajectory_arrays(GLIDER_CONFIG, trajectory, output_file)
+
+def write_eo_cube(mission, variable, output_file, resolution=0.05, pad=0.5,\
+                  seed=0):
+    '''
+    Writes a daily EO cube of variable (see EO_CONFIG) covering mission,
+    smooth in space and time, with cloud gaps in CHL
+    '''
+    rand = np.random.RandomState(seed)
+    config = EO_CONFIG[variable]
+    lon = np.arange(np.nanmin(mission['lon'])-pad,\
+                    np.nanmax(mission['lon'])+pad, resolution)
+    lat = np.arange(np.nanmin(mission['lat'])-pad,\
+                    np.nanmax(mission['lat'])+pad, resolution)
+    day0 = np.floor(np.nanmin(mission['time'])/86400.)-1
+    day1 = np.ceil(np.nanmax(mission['time'])/86400.)+1
+    days = np.arange(day0, day1+1)
+
+    t_ref = datetime.datetime.strptime(config['t_ref'], '%Y-%m-%d %H:%M:%S')
+    offset = (datetime.datetime(1970, 1, 1)-t_ref).total_seconds()
+    times = days*86400.+offset
+    if config['t_base'] == 'days':
+        times = times/86400.
+
+    phase = 2*np.pi*(days[:, None, None]/365.)
+    field = np.sin(phase+np.radians(lat)[None, :, None]*4.)+\
+            np.cos(np.radians(lon)[None, None, :]*6.)
+    if variable == 'PAR':
+        values = 35.+10.*field/2.
+    else:
+        values = np.exp(np.log(0.5)+0.5*field/2.)
+        values[rand.uniform(size=values.shape) < 0.2] = np.nan
+
+    nc_fid = Dataset(output_file, 'w', format='NETCDF4_CLASSIC')
+    nc_fid.createDimension(config['t_var'], len(times))
+    nc_fid.createDimension(config['lat_var'], len(lat))
+    nc_fid.createDimension(config['lon_var'], len(lon))
+    nc_fid.createVariable(config['t_var'], 'f8', (config['t_var'],))[:] = times
+    nc_fid.createVariable(config['lat_var'], 'f8', (config['lat_var'],))[:] = lat
+    nc_fid.createVariable(config['lon_var'], 'f8', (config['lon_var'],))[:] = lon
+    nc_var = nc_fid.createVariable(config['vars'][0], 'f4', (config['t_var'],\
+                                   config['lat_var'], config['lon_var']),\
+                                   fill_value=-32767.)
+    nc_var[:] = np.ma.masked_invalid(values)
+    nc_fid.close()
+
+def generate_case(mission, layout, template_dir, case_dir, module_config=None):
+    '''
+    Writes the glider config, raw files, trajectory file and EO cubes of a
+    mission to case_dir. Returns the benchmark case.
+    '''
+    if os.path.exists(case_dir):
+        shutil.rmtree(case_dir)
+    os.makedirs(case_dir)
+    GLIDER_CONFIG = write_glider_config(layout, template_dir, case_dir)
+    case = {'layout': layout, 'mission': mission, 'dir': case_dir,
+            'GLIDER_CONFIG': GLIDER_CONFIG,
+            'module_config': module_config or {},
+            'n_profiles': mission['n_profiles'],
+            'records': mission['records'],
+            'mission_files': write_mission(mission, layout,\
+                                           os.path.join(case_dir, 'raw')),
+            'trajectory_file': os.path.join(case_dir, 'trajectory.nc'),
+            'eo_dir': os.path.join(case_dir, 'EO'),
+            'logging': None}
+    write_mission_trajectory(mission, GLIDER_CONFIG, case['trajectory_file'])
+    os.makedirs(case['eo_dir'])
+    for variable in EO_CONFIG:
+        write_eo_cube(mission, variable, eo_cube(case, variable))
+    return case
+
+def eo_cube(case, variable):
+    return os.path.join(case['eo_dir'], variable+'_'+\
+                        EO_CONFIG[variable]['source']+'.nc')
+
+def clean_dir(path):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    return path
+
+#-benchmarks: each sets up (untimed) and returns the timed run, which returns
+# the number of items it processed------------------------------------------
+def bench_split_dive_index(case):
+    split_dir = clean_dir(os.path.join(case['dir'], 'split'))
+    def run():
+        split_files = []
+        for mission_file in case['mission_files']:
+            split_files.extend(gt.split_dive_index(mission_file,\
+                               os.path.join(split_dir, os.path.basename(mission_file)),\
+                               case['GLIDER_CONFIG'], logging=case['logging']))
+        return len(split_files)
+    return run
+
+def bench_split_dive_stateful(case):
+    split_dir = clean_dir(os.path.join(case['dir'], 'split'))
+    state_file = os.path.join(split_dir, 'segment_state.json')
+    def run():
+        split_files = []
+        for mission_file in case['mission_files']:
+            split_files.extend(gt.split_dive_stateful(mission_file,\
+                               os.path.join(split_dir, os.path.basename(mission_file)),\
+                               case['GLIDER_CONFIG'], state_file,\
+                               logging=case['logging']))
+        return len(split_files)
+    return run
+
+def staged_files(case):
+    '''
+    The staged profiles of a case, staging them first if needed
+    '''
+    staged_dir = os.path.join(case['dir'], 'staged')
+    files = sorted(glob.glob(os.path.join(staged_dir, '*_st_*.nc')))
+    if len(files) < case['n_profiles']:
+        bench_interpolate_dive(case)()
+        files = sorted(glob.glob(os.path.join(staged_dir, '*_st_*.nc')))
+    return files
+
+def bench_interpolate_dive(case):
+    staged_dir = clean_dir(os.path.join(case['dir'], 'staged'))
+    split_files = write_split_files(case['mission'], case['layout'],\
+                                    case['mission_files'], staged_dir)
+    def run():
+        trajectory = {}
+        for split_file in split_files:
+            gt.interpolate_dive(split_file, split_file.replace('.nc', '_st.nc'),\
+                                case['GLIDER_CONFIG'], case['module_config'],\
+                                logging=case['logging'], trajectory=trajectory)
+        return len(split_files)
+    return run
+
+def bench_get_coords(case):
+    GLIDER_DICT = gt.read_config_file(case['GLIDER_CONFIG'])
+    def run():
+        coords = gt.get_coords(case['trajectory_file'], GLIDER_DICT,\
+                               logging=case['logging'])
+        return len(coords[-1])
+    return run
+
+def fly_cube_case(case, variable):
+    '''
+    Flies the mission trajectory through the synthetic cube of variable,
+    as fly_profiles does
+    '''
+    GLIDER_DICT = gt.read_config_file(case['GLIDER_CONFIG'])
+    _, _, lon_average, _, _, lat_average, _, _, time_average, \
+      profile_average = gt.get_coords(case['trajectory_file'], GLIDER_DICT)
+    adapted_time = gt.convert_time(time_average, EO_CONFIG[variable]['t_ref'],\
+                                   EO_CONFIG[variable]['t_base'])
+    nc_outfile = eo_cube(case, variable).replace('.nc', '_traj.nc')
+    if os.path.exists(nc_outfile):
+        os.remove(nc_outfile)
+    def run():
+        if not gt.fly_cube(variable, EO_CONFIG, case['GLIDER_CONFIG'],\
+                           case['module_config'], eo_cube(case, variable),\
+                           nc_outfile, adapted_time, time_average,\
+                           lon_average, lat_average, profile_average,\
+                           logging=case['logging']):
+            raise RuntimeError('fly_cube failed for '+variable)
+        return len(profile_average)
+    return run
+
+def bench_fly_cube_PAR(case):
+    return fly_cube_case(case, 'PAR')
+
+def bench_fly_cube_CHL(case):
+    return fly_cube_case(case, 'CHL')
+
+def bench_findmld(case):
+    mission = case['mission']
+    columns = []
+    for profile in range(mission['n_profiles']):
+        records = profile_slice(mission, profile)
+        ASAL = gsw.SA_from_SP(mission['sal'][records], mission['pres'][records],\
+                              mission['lon'][records], mission['lat'][records])
+        CTEMP = gsw.CT_from_t(ASAL, mission['temp'][records],\
+                              mission['pres'][records])
+        ii = np.where(np.isfinite(mission['pres'][records]) & \
+                      np.isfinite(CTEMP) & np.isfinite(ASAL))
+        columns.append((mission['pres'][records][ii], CTEMP[ii], ASAL[ii]))
+    def run():
+        for PRES, CTEMP, ASAL in columns:
+            mu.findmld(PRES, CTEMP, ASAL, 0, rec_cut=10, pmax=20,\
+                       logging=case['logging'])
+        return len(columns)
+    return run
+
+def hydrography_file(case):
+    return os.path.join(case['dir'], 'hydrography.nc')
+
+def bench_mission_hydrography(case):
+    files = [staged_file for staged_file in staged_files(case) \
+             if not staged_file.endswith('_bad.nc')]
+    def run():
+        gt.write_mission_hydrography(files, case['GLIDER_CONFIG'],\
+                                     hydrography_file(case),\
+                                     logging=case['logging'])
+        return len(files)
+    return run
+
+def bench_preprocess_dive(case):
+    mission = case['mission']
+    preproc_dir = clean_dir(os.path.join(case['dir'], 'preproc'))
+    files = []
+    for staged_file in staged_files(case):
+        files.append(os.path.join(preproc_dir, os.path.basename(staged_file)))
+        shutil.copy(staged_file, files[-1])
+    if not os.path.exists(hydrography_file(case)):
+        bench_mission_hydrography(case)()
+    def run():
+        last_MLD, last_ZEU = np.nan, np.nan
+        done = 0
+        for profile, nc_file in enumerate(files):
+            hydro = gt.read_mission_hydrography(hydrography_file(case),\
+                                                gt.get_profile_number(nc_file))
+            results = gt.preprocess_dive(nc_file, case['GLIDER_CONFIG'], 35.,\
+                          mission['kd'][profile], 0.5, np.nan, 5., last_MLD,\
+                          last_ZEU, logging=case['logging'], hydro=hydro)
+            last_MLD, last_ZEU = results[-2], results[-1]
+            done = done + 1
+        return done
+    return run
+
+def bench_quench_corrections(case):
+    mission = case['mission']
+    GLIDER_DICT = gt.read_config_file(case['GLIDER_CONFIG'])
+    edges = GLIDER_DICT.depth_edges
+    n_bins = len(edges)-1
+    # bin every profile onto the config depth grid (depth x profile)
+    depth_bin = np.clip(np.digitize(mission['depth'], edges)-1, 0, n_bins-1)
+    cell = depth_bin*mission['n_profiles']+mission['profile']
+    binned = {}
+    for name in ['chla', 'scatter']:
+        ok = np.isfinite(mission[name])
+        sums = np.bincount(cell[ok], mission[name][ok],\
+                           minlength=n_bins*mission['n_profiles'])
+        counts = np.bincount(cell[ok], minlength=n_bins*mission['n_profiles'])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            binned[name] = (sums/counts).reshape(n_bins, mission['n_profiles'])
+    DEPTH = np.repeat(edges[:-1, None], mission['n_profiles'], axis=1)
+    DEPTH = np.where(np.isfinite(binned['chla']), DEPTH, np.nan)
+    ZEU = 4.6/mission['kd']
+    def run():
+        fcorr.quench_corrections(fcorr.QUENCH_METHODS, binned['chla'], DEPTH,\
+                                 MLD=mission['mld'], ZEU=ZEU,\
+                                 SCATTER=binned['scatter'],\
+                                 logging=case['logging'])
+        return mission['n_profiles']
+    return run
+
+BENCHMARKS = {'split_dive_index': bench_split_dive_index,
+              'split_dive_stateful': bench_split_dive_stateful,
+              'interpolate_dive': bench_interpolate_dive,
+              'get_coords': bench_get_coords,
+              'fly_cube_PAR': bench_fly_cube_PAR,
+              'fly_cube_CHL': bench_fly_cube_CHL,
+              'findmld': bench_findmld,
+              'mission_hydrography': bench_mission_hydrography,
+              'preprocess_dive': bench_preprocess_dive,
+              'quench_corrections': bench_quench_corrections}
+
+# preprocess_dive reads the corrected EGO variables on the TIME dimension
+BENCHMARK_LAYOUTS = {'preprocess_dive': ('ego',)}
+
+def select_benchmarks(names):
+    '''
+    Benchmarks matching the comma separated names (or name prefixes)
+    '''
+    if not names or names == 'all':
+        return list(BENCHMARKS)
+    wanted = [name.strip() for name in names.split(',') if name.strip()]
+    return [name for name in BENCHMARKS if any([name.startswith(prefix) \
+            for prefix in wanted])]
+
+#-measurement-------------------------------------------------------------------
+def case_process(name, case, writer):
+    result = {'benchmark': name, 'layout': case['layout'],
+              'profiles': case['n_profiles'], 'records': case['records'],
+              'items': 0, 'wall': np.nan, 'cpu': np.nan, 'peak_mb': np.nan,
+              'status': 'ok'}
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            run = BENCHMARKS[name](case)
+            baseline = mt.proc_status_kb('VmRSS')
+            with mt.span('benchmark_'+name) as bench_span:
+                result['items'] = run()
+            if not bench_span.rss_reset:
+                result['status'] = 'ok (peak includes setup)'
+            result['wall'] = bench_span.record['wall']
+            result['cpu'] = bench_span.record['cpu']
+            result['peak_mb'] = max((bench_span.record['peak_rss_kb'] or \
+                                     baseline)-baseline, 0)/1024.
+    except:
+        result['status'] = 'error: '+traceback.format_exc().strip().splitlines()[-1]
+    writer.send(result)
+    writer.close()
+
+def run_case(name, case):
+    '''
+    Runs benchmark name on case in a forked process, so that every case
+    starts from the same memory and cache state. Returns the wall and CPU
+    time, peak RSS above the pre-run baseline (MB) and items processed.
+    '''
+    if case['layout'] not in BENCHMARK_LAYOUTS.get(name, LAYOUTS):
+        return {'benchmark': name, 'layout': case['layout'],
+                'profiles': case['n_profiles'], 'records': case['records'],
+                'items': 0, 'wall': np.nan, 'cpu': np.nan, 'peak_mb': np.nan,
+                'status': 'skipped: '+','.join(BENCHMARK_LAYOUTS[name])+\
+                          ' layout only'}
+
+    reader, writer = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=case_process,\
+                                      args=(name, case, writer))
+    process.start()
+    writer.close()
+    try:
+        result = reader.recv()
+    except EOFError:
+        result = {'benchmark': name, 'layout': case['layout'],
+                  'profiles': case['n_profiles'], 'records': case['records'],
+                  'items': 0, 'wall': np.nan, 'cpu': np.nan, 'peak_mb': np.nan,
+                  'status': 'crashed'}
+    process.join()
+    return result
+
+#--EOF
@@ -36,12 +36,10 @@ License:        MIT Licence -- Copyright 2017 Plymouth Marine Laboratory
 #-imports-----------------------------------------------------------------------
 import datetime
 import numpy as np
-import ephem
-import pysolar
+import functools
 import matplotlib.pyplot as plt
 from scipy.interpolate import interp1d
 import os
-import pytz
 
 #---
 def running_mean(values, window):
@@ -71,37 +69,127 @@ def  ref_index(S,T,lam):
     return n
 
 #---
-def glider_times(lat, lon, tref, time, to_UTC=0, correct_time=True):
-                           
-    glider_ephem = ephem.Observer()
-    glider_ephem.horizon = '0' # actual sunrise
-    glider_ephem.lat = str(lat)
-    glider_ephem.lon = str(lon)
-
+def julian_day(time, tref, to_UTC=0, correct_time=True):
+    '''
+    Julian day (UTC) of glider times: seconds since tref if correct_time,
+    otherwise matlab datenums. Works on scalars or arrays.
+    '''
+    time = np.asarray(time, dtype=float)
     if correct_time:
-        python_UTC_datetime = datetime.datetime.strptime(tref,'%Y-%m-%d %H:%M:%S') \
-                              + datetime.timedelta(seconds=int(time)) \
-                              - datetime.timedelta(hours=to_UTC)
+        ref = datetime.datetime.strptime(tref,'%Y-%m-%d %H:%M:%S')
+        jd_ref = ref.toordinal() + 1721424.5 + (ref - datetime.datetime(\
+                 ref.year, ref.month, ref.day)).total_seconds()/86400.0
+        jd = jd_ref + np.trunc(time)/86400.0
     else:
-        python_UTC_datetime = datetime.datetime.fromordinal(int(time)\
-                              - 366) + datetime.timedelta(days=time%1)\
-                              - datetime.timedelta(hours=to_UTC)
-    
-    glider_ephem.date = python_UTC_datetime
-    last_sunrise = glider_ephem.previous_rising(ephem.Sun()).datetime()
-    last_sunset = glider_ephem.previous_setting(ephem.Sun()).datetime()
-    next_sunset = glider_ephem.next_setting(ephem.Sun()).datetime()
-
-    if glider_ephem.date.datetime() > last_sunrise and \
-      glider_ephem.date.datetime() < next_sunset and \
-      last_sunset < last_sunrise:
-        is_day = 1
-        is_night = 0
+        jd = time + 1721058.5
+    return jd - to_UTC/24.0
+
+def julian_to_datetime(jd):
+    '''
+    Converts a scalar Julian day to a (naive, UTC) datetime
+    '''
+    return datetime.datetime.fromordinal(1) + \
+           datetime.timedelta(days=float(jd) - 1721425.5)
+
+def solar_terms(jd):
+    '''
+    NOAA solar declination and equation of time (minutes) at Julian day jd
+    '''
+    jc = (jd - 2451545.0)/36525.0
+    mean_long = np.mod(280.46646 + jc*(36000.76983 + jc*0.0003032), 360.0)
+    mean_anom = 357.52911 + jc*(35999.05029 - 0.0001537*jc)
+    eccent = 0.016708634 - jc*(0.000042037 + 0.0000001267*jc)
+    centre = np.sin(np.radians(mean_anom))*(1.914602 - jc*(0.004817 + \
+             0.000014*jc)) + np.sin(np.radians(2*mean_anom))*(0.019993 - \
+             0.000101*jc) + np.sin(np.radians(3*mean_anom))*0.000289
+    omega = np.radians(125.04 - 1934.136*jc)
+    app_long = mean_long + centre - 0.00569 - 0.00478*np.sin(omega)
+    obliq = 23.0 + (26.0 + (21.448 - jc*(46.815 + jc*(0.00059 - \
+            jc*0.001813)))/60.0)/60.0 + 0.00256*np.cos(omega)
+    declin = np.arcsin(np.sin(np.radians(obliq))*np.sin(np.radians(app_long)))
+    yy = np.tan(np.radians(obliq/2.0))**2
+    ml = np.radians(mean_long)
+    ma = np.radians(mean_anom)
+    eq_time = 4.0*np.degrees(yy*np.sin(2*ml) - 2*eccent*np.sin(ma) + \
+              4*eccent*yy*np.sin(ma)*np.cos(2*ml) - 0.5*yy*yy*np.sin(4*ml) - \
+              1.25*eccent*eccent*np.sin(2*ma))
+    return declin, eq_time
+
+def solar_geometry(lat, lon, time, tref, to_UTC=0, correct_time=True):
+    '''
+    Vectorised NOAA solar position for arrays of (lat, lon, time). Returns
+    a dict of solar zenith (degrees, no refraction), the sunrise and sunset
+    (Julian days) of the solar day nearest each time, and day/night flags
+    (sun above the 90.833 degree apparent horizon).
+    '''
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    jd = julian_day(time, tref, to_UTC=to_UTC, correct_time=correct_time)
+
+    declin, eq_time = solar_terms(jd)
+
+    # solar zenith
+    true_solar = np.mod(np.mod(jd - 0.5, 1.0)*1440.0 + eq_time + 4.0*lon,\
+                        1440.0)
+    hour_angle = np.radians(true_solar/4.0 - 180.0)
+    cos_zen = np.sin(np.radians(lat))*np.sin(declin) + \
+              np.cos(np.radians(lat))*np.cos(declin)*np.cos(hour_angle)
+    zenith = np.degrees(np.arccos(np.clip(cos_zen, -1.0, 1.0)))
+
+    # nearest solar noon, with the solar terms re-evaluated there
+    noon = np.floor(jd - 0.5) + 0.5 + (720.0 - 4.0*lon - eq_time)/1440.0
+    noon = noon + np.round(jd - noon)
+    declin, noon_eq_time = solar_terms(noon)
+    noon = noon - (noon_eq_time - eq_time)/1440.0
+
+    # sunrise/sunset hour angle; nan when the sun never rises or sets
+    cos_ha = np.cos(np.radians(90.833))/(np.cos(np.radians(lat))*\
+             np.cos(declin)) - np.tan(np.radians(lat))*np.tan(declin)
+    with np.errstate(invalid='ignore'):
+        ha = np.degrees(np.arccos(np.where(np.abs(cos_ha) <= 1.0, cos_ha,\
+                                           np.nan)))
+
+    is_day = np.where(zenith < 90.833, 1, 0)
+
+    return {'zenith': zenith, 'sunrise': noon - ha*4.0/1440.0,\
+            'sunset': noon + ha*4.0/1440.0, 'is_day': is_day,\
+            'is_night': 1 - is_day}
+
+@functools.lru_cache(maxsize=4096)
+def profile_sun(lat, lon, tref, time, to_UTC=0, correct_time=True):
+    '''
+    Memoised scalar solar_geometry for one profile position and time
+    '''
+    sun = solar_geometry(lat, lon, time, tref, to_UTC=to_UTC,\
+                         correct_time=correct_time)
+    return dict((key, sun[key].item()) for key in sun)
+
+#---
+def glider_times(lat, lon, tref, time, to_UTC=0, correct_time=True):
+    '''
+    Day/night flags plus the last sunrise and next sunset (UTC datetimes)
+    for a profile
+    '''
+    sun = profile_sun(float(lat), float(lon), tref, float(time),\
+                      to_UTC=to_UTC, correct_time=correct_time)
+    jd = float(julian_day(time, tref, to_UTC=to_UTC,\
+                          correct_time=correct_time))
+
+    last_sunrise = sun['sunrise']
+    next_sunset = sun['sunset']
+    if np.isfinite(last_sunrise):
+        if last_sunrise > jd:
+            last_sunrise = last_sunrise - 1.0
+        # the sunset of the same solar day as that sunrise, so that the
+        # daylight span stays under 24 h
+        next_sunset = next_sunset + np.floor(last_sunrise - next_sunset) + 1.0
+        last_sunrise = julian_to_datetime(last_sunrise)
+        next_sunset = julian_to_datetime(next_sunset)
     else:
-        is_day = 0
-        is_night = 1
-    
-    return is_night, is_day, last_sunrise, next_sunset
+        # polar day/night: no events within the solar day
+        last_sunrise = next_sunset = None
+
+    return sun['is_night'], sun['is_day'], last_sunrise, next_sunset
 
 def check_remask_var(var,vmin,vmax):
     if 'Masked' in str(type(var)):
@@ -178,40 +266,32 @@ def profile_specifics(TIME,TREF,LAT,LON,DEPTH,glider_bathy,\
     return is_night, is_day, is_bad, is_good, is_no_DCM_night, \
            is_day_good_PAR
 
-def fresnel_refl(lat,lon,time,tref,depth,PAR,is_day_good_PAR,WS,SST,SSS,to_UTC=0,\
-                 correct_time=True):
-
+def fresnel_refl_array(lat,lon,time,tref,is_day_good_PAR,WS,SST,SSS,to_UTC=0,\
+                       correct_time=True):
+    '''
+    Fresnel plus foam reflectance (Hemsley et al., 2015) and solar zenith
+    (radians) for per-profile vectors of position, time, surface T/S and
+    wind speed. Night, bad PAR and bad coordinate profiles get r_tot = 0
+    and a nan zenith.
+    '''
     deg2rad = np.pi/180
     rho_a   = 1.2e-3
-    r_tot = 0.0
-    theta_a = np.nan
 
-    # ignore night time and bad PAR profiles
-    if is_day_good_PAR == 0.0 or np.isnan(lat) or np.isnan(lon)\
-      or np.isnan(time):
-        print('Cannot correct Fresnel, reflectance set to 0')
-    else:      
-        if correct_time:
-            python_UTC_datetime = datetime.datetime.strptime(tref,'%Y-%m-%d %H:%M:%S') \
-                                  + datetime.timedelta(seconds=int(time)) \
-                                  - datetime.timedelta(hours=to_UTC)
-        else:
-            python_UTC_datetime = datetime.datetime.fromordinal(int(time)\
-                                  - 366) + datetime.timedelta(days=time%1)\
-                                  - datetime.timedelta(hours=to_UTC)
-
-        python_UTC_datetime = pytz.utc.localize(python_UTC_datetime)
-
-        # get solar zenith
-        theta_a = deg2rad*(90.0 - pysolar.solar.get_altitude_fast(lat, lon,\
-                  python_UTC_datetime))
+    lat, lon, time, is_day_good_PAR, WS, SST, SSS = np.broadcast_arrays(\
+         *[np.asarray(var, dtype=float) for var in \
+           [lat, lon, time, is_day_good_PAR, WS, SST, SSS]])
+    good = (is_day_good_PAR != 0.0) & np.isfinite(lat) & np.isfinite(lon) \
+           & np.isfinite(time)
 
-        # get refractive indices (using average of 450/700 for sea-water)
+    # get solar zenith
+    theta_a = deg2rad*solar_geometry(lat, lon, time, tref, to_UTC=to_UTC,\
+                                     correct_time=correct_time)['zenith']
+    theta_a = np.where(good, theta_a, np.nan)
 
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # get refractive indices (using average of 450/700 for sea-water)
         n_a     = 1.000277
-        n_w1    = ref_index(SSS,SST,450.0)
-        n_w2    = ref_index(SSS,SST,700.0)
-        n_w     = (n_w1 + n_w2)/2.0
+        n_w     = (ref_index(SSS,SST,450.0) + ref_index(SSS,SST,700.0))/2.0
 
         # get theta_w
         theta_w = np.arcsin(n_a/n_w * np.sin(theta_a))
@@ -223,38 +303,60 @@ def fresnel_refl(lat,lon,time,tref,depth,PAR,is_day_good_PAR,WS,SST,SSS,to_UTC=0
                  / (np.tan(theta_a+theta_w))**2
 
         # calculate foam effects
-        if WS < 7.0:
-            c_n = (6.2e-4 + 1.56e-3)/WS
-            r_f = rho_a*c_n*2.2e-5*WS**2-4.0e-4
-        else:
-            c_n = 0.49-3 + 0.065*WS
-            r_f = (rho_a*c_n*4.5e-5 - 4.0e-5)*WS**2
-
-        if r_f == 0.0:
-            r_diff = 0.066
-        else:
-            r_diff = r_f + 0.057
+        r_f = np.where(WS < 7.0,\
+                       rho_a*(6.2e-4 + 1.56e-3)/WS*2.2e-5*WS**2-4.0e-4,\
+                       (rho_a*(0.49-3 + 0.065*WS)*4.5e-5 - 4.0e-5)*WS**2)
+        r_diff = np.where(r_f == 0.0, 0.066, r_f + 0.057)
 
-        # get total reflectance
-        r_tot = r_diff + rr
+    # get total reflectance
+    r_tot = np.where(good, r_diff + rr, 0.0)
 
     return r_tot, theta_a
 
+def fresnel_refl(lat,lon,time,tref,depth,PAR,is_day_good_PAR,WS,SST,SSS,to_UTC=0,\
+                 correct_time=True):
+    '''
+    Single profile fresnel_refl_array
+    '''
+    # ignore night time and bad PAR profiles
+    if is_day_good_PAR == 0.0 or np.isnan(lat) or np.isnan(lon)\
+      or np.isnan(time):
+        print('Cannot correct Fresnel, reflectance set to 0')
+
+    r_tot, theta_a = fresnel_refl_array(lat,lon,time,tref,is_day_good_PAR,\
+                                        WS,np.nanmean(SST),np.nanmean(SSS),\
+                                        to_UTC=to_UTC,\
+                                        correct_time=correct_time)
+
+    return float(r_tot), float(theta_a)
+
 def get_E0(E_0_minus,r_tot):
     '''
-    Calculate broadband PAR above water
+    Calculate broadband PAR above water, for scalars or per-profile arrays
     '''
     # temporary measure: contacted Victoria about this
     R = 0.04
     # Hemsley 2015
     r_bar   = 0.48
     # cross the air/water interface
-    if np.isnan(r_tot):
-        E_0_plus = E_0_minus.copy()
-    else:
-        E_0_plus = E_0_minus*(1-R*r_bar)/(1-r_tot)
+    E_0_minus = np.asarray(E_0_minus, dtype=float)
+    E_0_plus = np.where(np.isnan(r_tot), E_0_minus,\
+                        E_0_minus*(1-R*r_bar)/(1-np.asarray(r_tot)))
+    if np.ndim(E_0_plus) == 0:
+        E_0_plus = float(E_0_plus)
     return E_0_plus
 
+def surface_irradiance(lat,lon,time,tref,E_0_minus,is_day_good_PAR,WS,SST,SSS,\
+                       to_UTC=0,correct_time=True):
+    '''
+    r_tot, solar zenith (radians) and above-surface E0+ for every profile of
+    a mission at once
+    '''
+    r_tot, solzen = fresnel_refl_array(lat,lon,time,tref,is_day_good_PAR,WS,\
+                                       SST,SSS,to_UTC=to_UTC,\
+                                       correct_time=correct_time)
+    return r_tot, solzen, get_E0(E_0_minus,r_tot)
+
 def findZEU(depth,par,verbose=False, logging=None):
     '''
     finds 1% light level from surface value
@@ -273,6 +375,139 @@ def findZEU(depth,par,verbose=False, logging=None):
         Zeu = depth[ii[-1]]
     return Zeu
 
+def station_text(values):
+    '''
+    Formats values as they print one at a time (masked values as '--'),
+    in one array step.
+    '''
+    values = np.ma.asarray(values)
+    text = np.asarray(values.filled(0)).astype(str).astype(object)
+    text[np.ma.getmaskarray(values)] = str(np.ma.masked)
+    return text
+
+def station_datetime(times, tref, correct_time=True):
+    '''
+    Station time from the mean of its record times (seconds since tref, or
+    matlab datenum).
+    '''
+    if correct_time:
+        return datetime.datetime.strptime(tref,'%Y-%m-%d %H:%M:%S') +\
+               datetime.timedelta(seconds=int(np.nanmean(times)))
+    matlab_datenum  = np.nanmean(times)
+    return datetime.datetime.fromordinal(int(matlab_datenum) - 366) + \
+           datetime.timedelta(days=matlab_datenum%1)
+
+def station_rows(times, tref, depths, chl, par, correct_time=True):
+    '''
+    Formats the Morel91 chl and par rows of one station. Rows with a NaN
+    chl, par or depth are skipped; the station time is computed once.
+
+    Returns the chl and par file contents, the station times (as used for
+    the time column) and the HH:MM time string, or empty text if no rows.
+    '''
+    depths = np.ma.asarray(depths)
+    chl = np.ma.asarray(chl)
+    par = np.ma.asarray(par)
+
+    # masked values are not NaN, so they are written as '--'
+    n_rows = len(times)
+    depths, chl, par = depths[:n_rows], chl[:n_rows], par[:n_rows]
+    skip = np.zeros(n_rows, dtype=bool)
+    for values in (chl, par, depths):
+        skip |= np.isnan(values.filled(0)) & ~np.ma.getmaskarray(values)
+    rows = np.where(~skip)[0]
+    if len(rows) == 0:
+        return '', '', times, None
+
+    if correct_time and 'numpy.ma.core.MaskedArray' in str(type(times)):
+        times = np.ma.filled(times.data.astype(float), np.nan)
+    formatted_time = station_datetime(times, tref, correct_time).strftime("%H:%M")
+
+    prefix = formatted_time + ' ' + station_text(np.ma.abs(depths[rows])) + ' '
+    chl_text = '\n'.join(prefix + station_text(chl[rows])) + '\n'
+    par_text = '\n'.join(prefix + station_text(par[rows])) + '\n'
+
+    return chl_text, par_text, times, formatted_time
+
+def write_station_file(fname, text):
+    '''
+    Replaces fname with text in a single buffered write.
+    '''
+    if os.path.exists(fname):
+        os.remove(fname)
+    with open(fname, "w") as fid:
+        fid.write(text)
+    os.chmod(fname, 0o777)
+
+def telemetry_text(times, formatted_time, wspd, rh, tcwv, o3, mslp, cloud,\
+                   chl_traj, zeu_traj, E_0_plus, MLD, ZEU, lon, lat,\
+                   temperature, is_day, correct_time=True):
+    '''
+    Formats the PAR model telemetry file of one station.
+    '''
+    if correct_time:
+        python_datetime = datetime.datetime(1970,1,1)+\
+                          datetime.timedelta(seconds=int(np.nanmean(times)))
+    else:
+        python_datetime = station_datetime(times, None, correct_time=False)
+
+    fields = [('time', formatted_time),\
+              ('longitude', str(np.nanmean(lon))),\
+              ('latitude', str(np.nanmean(lat))),\
+              ('year', python_datetime.strftime("%Y")),\
+              ('month', python_datetime.strftime("%m")),\
+              ('day', python_datetime.strftime("%d")),\
+              ('jday', python_datetime.strftime("%j")),\
+              ('temp', str(np.nanmean(temperature))),\
+              ('wspd', str(wspd)),\
+              ('rh', str(rh)),\
+              ('tcwv', str(tcwv)),\
+              ('o3', str(o3)),\
+              ('mslp', str(mslp)),\
+              ('cloud', str(cloud)),\
+              ('E0p', str(E_0_plus)),\
+              ('MLD', str(MLD)),\
+              ('ZEU', str(ZEU)),\
+              ('CHL_traj', str(chl_traj)),\
+              ('ZEU_traj', str(zeu_traj)),\
+              ('is_day', str(is_day))]
+    return '\n'.join([key + ' ' + value for key, value in fields])
+
+def write_station(station_number,times,tref,depths,chl,par,wspd,rh,tcwv,\
+                  o3,mslp,cloud,chl_traj,zeu_traj,E_0_plus,MLD,ZEU,lon,lat,\
+                  temperature,outdir,chlname,parname,is_day,correct_time=True,\
+                  outfile_suffix='.txt'):
+    '''
+    Writes the chl, par and telemetry files of one station, each with a
+    single buffered write. Stations without valid rows have their chl/par
+    files removed.
+
+    Returns the number of rows written and the chl, par and telemetry
+    file names.
+    '''
+    station = str(int(station_number)).zfill(6)+outfile_suffix
+    this_chl_file = outdir+'/'+chlname+'_station_'+station
+    this_par_file = outdir+'/'+parname+'_station_'+station
+    this_file = outdir+'/telemetry' + '_station_'+station
+    files = (this_chl_file, this_par_file, this_file)
+
+    chl_text, par_text, times, formatted_time = \
+        station_rows(times, tref, depths, chl, par, correct_time=correct_time)
+
+    if formatted_time is None:
+        for fname in (this_chl_file, this_par_file):
+            if os.path.exists(fname):
+                os.remove(fname)
+        return 0, files
+
+    write_station_file(this_chl_file, chl_text)
+    write_station_file(this_par_file, par_text)
+    write_station_file(this_file, telemetry_text(times, formatted_time, wspd,\
+                       rh, tcwv, o3, mslp, cloud, chl_traj, zeu_traj,\
+                       E_0_plus, MLD, ZEU, lon, lat, temperature, is_day,\
+                       correct_time=correct_time))
+    return chl_text.count('\n'), files
+
 def output_text(station_number,times,tref,depths,chl,par,
                 wspd,\
                 rh,\
@@ -292,139 +527,46 @@ def output_text(station_number,times,tref,depths,chl,par,
     Outputs Chl & PAR profiles in text format compatible with Morel19 PP model.
     Also produces telemetry files for use in PAR model.
     '''
+    nrows, files = write_station(station_number,times,tref,depths,chl,par,\
+                       wspd,rh,tcwv,o3,mslp,cloud,chl_traj,zeu_traj,\
+                       E_0_plus,MLD,ZEU,lon,lat,temperature,outdir,chlname,\
+                       parname,is_day,correct_time=correct_time,\
+                       outfile_suffix=outfile_suffix)
 
-    nrows=0
-    # chl file
-    this_chl_file = outdir+'/'+chlname+'_station_'\
-                    +str(int(station_number)).zfill(6)+outfile_suffix
-    this_par_file = outdir+'/'+parname+'_station_'\
-                    +str(int(station_number)).zfill(6)+outfile_suffix
-
-    if os.path.exists(this_chl_file):
-        os.chmod(this_chl_file, 0o777)
-        os.remove(this_chl_file)
-
-    if os.path.exists(this_par_file):
-        os.chmod(this_par_file, 0o777)
-        os.remove(this_par_file)
-    
-    with open(this_chl_file,"a") as chl_file:
-        with open(this_par_file,"a") as par_file:
-            print('Writing: '+this_chl_file)
-            print('Writing: '+this_par_file)
-            if logging:
-                logging.info('Writing: '+this_chl_file)
-                logging.info('Writing: '+this_par_file)
-
-            for iter_val in np.arange(0,len(times)):
-                # skip nan value rows: bit dangerous as CHL and PAR are linked
-                if np.isnan(chl[iter_val]) or np.isnan(par[iter_val]) or np.isnan(depths[iter_val]):
-                    continue
-
-                nrows = nrows+1
-                if correct_time:
-                    if 'numpy.ma.core.MaskedArray' in str(type(times)):
-                        times = times.data
-                        times = np.ma.filled(times.astype(float), np.nan)
-
-                    python_datetime = datetime.datetime.strptime(tref,'%Y-%m-%d %H:%M:%S') +\
-                                      datetime.timedelta(seconds=int(np.nanmean(times)))
-                else:
-                    matlab_datenum  = np.nanmean(times)
-                    python_datetime = datetime.datetime.\
-                                      fromordinal(int(matlab_datenum)\
-                                      - 366) + \
-                                      datetime.timedelta(days=matlab_datenum%1)
-
-                formatted_time  = python_datetime.strftime("%H:%M")
-                #formatted_depth = str(abs(int(depths[iter_val])))
-                formatted_depth = str(abs(depths[iter_val]))
-                formatted_chl   = str(chl[iter_val])
-                formatted_par   = str(par[iter_val])
-                chl_file.write(formatted_time  + ' ' +\
-                                  formatted_depth + ' ' +\
-                                  formatted_chl   + '\n')
-                par_file.write(formatted_time  + ' ' +\
-                                  formatted_depth + ' ' +\
-                                  formatted_par   + '\n')
-
-    os.chmod(this_chl_file, 0o777)
-    os.chmod(this_par_file, 0o777)
-
+    messages = ['Writing: '+files[0], 'Writing: '+files[1]]
     if nrows==0:
-        print('Empty (deleting): '+this_chl_file)
-        print('Empty (deleting): '+this_par_file)
-        if logging:
-            logging.info('Empty (deleting): '+this_chl_file)
-            logging.info('Empty (deleting): '+this_par_file)
-        os.remove(this_chl_file)
-        os.remove(this_par_file)
-      
+        messages += ['Empty (deleting): '+files[0], 'Empty (deleting): '+files[1]]
     else:
-        this_file = outdir+'/telemetry' + '_station_'\
-                    +str(int(station_number)).zfill(6)+outfile_suffix
-
-        if os.path.exists(this_file):
-            os.chmod(this_file, 0o777)
-            os.remove(this_file)
-         
-        with open(this_file,"a") as telemetry_file:
-            print('Writing: '+this_file)
-            if logging:
-                logging.info('Writing: '+this_file)
-
-            formatted_lon  = str(np.nanmean(lon))
-            formatted_lat  = str(np.nanmean(lat))
-            formatted_temp = str(np.nanmean(temperature))
-            formatted_WSPD  = str(wspd)
-            formatted_RH    = str(rh)
-            formatted_TCWV  = str(tcwv)
-            formatted_O3    = str(o3)
-            formatted_MSLP  = str(mslp)
-            formatted_CLOUD = str(cloud)
-            formatted_E0p   = str(E_0_plus)
-            formatted_MLD   = str(MLD)
-            formatted_ZEU   = str(ZEU)
-            formatted_CHLt  = str(chl_traj)
-            formatted_ZEUt  = str(zeu_traj)
-            formatted_dayt  = str(is_day)
-
-            if correct_time:
-                python_datetime = datetime.datetime(1970,1,1)+\
-                                  datetime.timedelta(seconds=int(np.nanmean(times)))
-            else:
-                matlab_datenum  = np.nanmean(times)
-                python_datetime = datetime.datetime.\
-                                  fromordinal(int(matlab_datenum)\
-                                  - 366) + \
-                                  datetime.timedelta(days=matlab_datenum%1)
-
-            formatted_year  = python_datetime.strftime("%Y")
-            formatted_month = python_datetime.strftime("%m")
-            formatted_day   = python_datetime.strftime("%d")
-            formatted_jday  = python_datetime.strftime("%j")
-
-            telemetry_file.write('time '+formatted_time + '\n')
-            telemetry_file.write('longitude '+formatted_lon + '\n')
-            telemetry_file.write('latitude '+formatted_lat + '\n')
-            telemetry_file.write('year '+formatted_year + '\n')
-            telemetry_file.write('month '+formatted_month + '\n')
-            telemetry_file.write('day '+formatted_day + '\n')
-            telemetry_file.write('jday '+formatted_jday + '\n')
-            telemetry_file.write('temp '+formatted_temp + '\n')
-            telemetry_file.write('wspd '+formatted_WSPD + '\n')
-            telemetry_file.write('rh '+formatted_RH + '\n')
-            telemetry_file.write('tcwv '+formatted_TCWV + '\n')
-            telemetry_file.write('o3 '+formatted_O3 + '\n')
-            telemetry_file.write('mslp '+formatted_MSLP + '\n')
-            telemetry_file.write('cloud '+formatted_CLOUD + '\n')
-            telemetry_file.write('E0p '+formatted_E0p + '\n')
-            telemetry_file.write('MLD '+formatted_MLD + '\n')
-            telemetry_file.write('ZEU '+formatted_ZEU + '\n')
-            telemetry_file.write('CHL_traj '+formatted_CHLt + '\n')
-            telemetry_file.write('ZEU_traj '+formatted_ZEUt + '\n')
-            telemetry_file.write('is_day '+formatted_dayt)
-
-        os.chmod(this_file, 0o777)
+        messages += ['Writing: '+files[2]]
+    for message in messages:
+        print(message)
+        if logging:
+            logging.info(message)
+
+def output_text_stations(stations, outdir, chlname, parname, logging=None,\
+                         correct_time=True, outfile_suffix='.txt'):
+    '''
+    Bulk version of output_text for many stations in one call. stations is
+    a sequence of dictionaries holding the per-station output_text
+    arguments (station_number, times, tref, depths, chl, par, wspd, rh,
+    tcwv, o3, mslp, cloud, chl_traj, zeu_traj, E_0_plus, MLD, ZEU, lon,
+    lat, temperature, is_day). Only a summary is printed.
+
+    Returns the number of stations written.
+    '''
+    n_written = 0
+    for station in stations:
+        nrows, files = write_station(outdir=outdir, chlname=chlname,\
+                           parname=parname, correct_time=correct_time,\
+                           outfile_suffix=outfile_suffix, **station)
+        if nrows:
+            n_written = n_written + 1
+
+    message = 'Written '+str(n_written)+' of '+str(len(stations))\
+              +' stations to: '+outdir
+    print(message)
+    if logging:
+        logging.info(message)
+    return n_written
 
 #-EOF--
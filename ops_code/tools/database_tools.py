@@ -12,6 +12,9 @@ import datetime
 import os, sys
 from netCDF4 import Dataset
 
+# per-profile stages, in processing order
+PROFILE_STAGES = ['staged', 'eo_acquire', 'preproc', 'primary_prod']
+
 #-------------------------------------------------------------------------------
 #-functions-
 def get_status(database, table_name, keys, \
@@ -71,7 +74,7 @@ def connectDB(DB_file):
     '''
     Make connection to an SQLite database file
     '''
-    conn = sqlite3.connect(DB_file)
+    conn = sqlite3.connect(DB_file, timeout=60)
     c = conn.cursor()
     return conn, c
 
@@ -92,9 +95,12 @@ def add_new_file_row(DB, column_name, CFG, file_name, timestamp,\
     # connect
     conn,c = connectDB(DB)  
 
-    # get table name
-    c.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    table_name=str(c.fetchall()[0][0])
+    # get table name; the database holds other tables as well now
+    if 'DATABASE' in CFG and 'table_name' in CFG['DATABASE']:
+        table_name = CFG['DATABASE']['table_name']
+    else:
+        c.execute("SELECT name FROM sqlite_master WHERE type='table';")
+        table_name=str(c.fetchall()[0][0])
 
     # get filenames
     c.execute("SELECT {cn} FROM {tn}".\
@@ -180,6 +186,186 @@ def add_new_file_row(DB, column_name, CFG, file_name, timestamp,\
     # close database
     conn.close()
 
+def create_table(database, module_config):
+    '''
+    Creates the processing table from the [DATABASE_columns] of the main
+    config, and the per-profile table, if the database does not have them
+    yet
+    '''
+    column_names = ','.join([f"{i} {module_config['DATABASE_columns'][i]}"
+                             for i in module_config['DATABASE_columns']])
+    conn, c = connectDB(database)
+    c.execute(f"CREATE TABLE IF NOT EXISTS "
+              f"{module_config['DATABASE']['table_name']} ({column_names})")
+    conn.commit()
+    conn.close()
+    create_profile_table(database, profile_table(module_config))
+
+def profile_table(module_config):
+    '''
+    Name of the per-profile table
+    '''
+    return module_config['DATABASE'].get('profile_table', 'PPglider_profiles')
+
+def create_profile_table(database, table_name):
+    '''
+    Creates the per-profile table: one row per staged profile of a glider,
+    with its position/time summary and a flag, date and state per stage
+    '''
+    stage_columns = ''.join([f", {stage} INTEGER NOT NULL DEFAULT 0,"
+                             f" {stage}_date TEXT, {stage}_state TEXT"
+                             for stage in PROFILE_STAGES])
+    conn, c = connectDB(database)
+    c.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ("
+              "glider_tag TEXT NOT NULL, profile_number INTEGER NOT NULL,"
+              " file_downloaded TEXT, split_file TEXT, staged_file TEXT,"
+              " good INTEGER, n_records INTEGER, time_start REAL,"
+              " time_end REAL, lon_mean REAL, lat_mean REAL, signature TEXT,"
+              " preproc_file TEXT, mld REAL, zeu REAL"+stage_columns+","
+              " PRIMARY KEY (glider_tag, profile_number))")
+    # tables made before the MLD/ZEU carry-over columns
+    columns = [row[1] for row in c.execute(f"PRAGMA table_info({table_name})")]
+    for column in ['mld', 'zeu']:
+        if column not in columns:
+            c.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} REAL")
+    for stage in PROFILE_STAGES:
+        c.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_{stage} ON"
+                  f" {table_name} (glider_tag, {stage})")
+    c.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_file ON"
+              f" {table_name} (file_downloaded)")
+    conn.commit()
+    conn.close()
+
+def upsert_profiles(c, table_name, glider_tag, file_name, profiles, today):
+    '''
+    Inserts or refreshes the rows of newly staged profiles (dicts from
+    glider_tools.profile_summaries) on an open cursor. The downstream
+    flags of a profile are only zeroed when its content signature changed,
+    so re-delivering a file does not send its unchanged profiles round the
+    chain again.
+    '''
+    downstream = ', '.join([f"{stage} = CASE WHEN signature IS"
+                            f" excluded.signature THEN {stage} ELSE 0 END"
+                            for stage in PROFILE_STAGES[1:]])
+    for profile in profiles:
+        c.execute(f"INSERT INTO {table_name} (glider_tag, profile_number,"
+                  " file_downloaded, split_file, staged_file, good,"
+                  " n_records, time_start, time_end, lon_mean, lat_mean,"
+                  " signature, staged, staged_date) VALUES (?, ?, ?, ?, ?,"
+                  " ?, ?, ?, ?, ?, ?, ?, 1, ?) ON CONFLICT (glider_tag,"
+                  f" profile_number) DO UPDATE SET {downstream},"
+                  " file_downloaded = excluded.file_downloaded, split_file ="
+                  " excluded.split_file, staged_file = excluded.staged_file,"
+                  " good = excluded.good, n_records = excluded.n_records,"
+                  " time_start = excluded.time_start, time_end ="
+                  " excluded.time_end, lon_mean = excluded.lon_mean,"
+                  " lat_mean = excluded.lat_mean, signature ="
+                  " excluded.signature, staged = 1, staged_date ="
+                  " excluded.staged_date",
+                  (glider_tag, profile['profile_number'], file_name,\
+                   profile['split_file'], profile['staged_file'],\
+                   profile['good'], profile['n_records'],\
+                   profile['time_start'], profile['time_end'],\
+                   profile['lon_mean'], profile['lat_mean'],\
+                   profile['signature'], today))
+
+def set_staged(database, table_name, file_name, staged_dir, split_files,\
+               profile_table=None, glider_tag=None, profiles=None, done=True):
+    '''
+    Marks a downloaded file as staged and zeroes the downstream flags in
+    case of re-processing; with profiles, also records its staged profiles
+    in profile_table. A file staged only in part (done=False, e.g. cut
+    short by --sample) just gets its profiles recorded, so that it is
+    staged again.
+    '''
+    today = datetime.datetime.now().strftime('%Y%m%d_%H%M')
+    conn, c = connectDB(database)
+    if done:
+        c.execute(f"UPDATE {table_name} SET staged = 1, staged_dir = ?,"
+                  " staged_date = ?, staged_files = ?, EO_acquire = 0,"
+                  " preproc = 0, spectral = 0, corrected = 0, primary_prod = 0,"
+                  " postproc = 0 WHERE file_downloaded = ?",
+                  (staged_dir, today, ','.join(split_files), file_name))
+    if profiles:
+        upsert_profiles(c, profile_table, glider_tag, file_name, profiles,\
+                        today)
+    conn.commit()
+    conn.close()
+
+def profiles_for_stage(database, table_name, stage, glider_tag=None,\
+                       file_name=None):
+    '''
+    Good profiles done by the stage before but not by stage, in profile
+    order, as dicts of their row
+    '''
+    previous = PROFILE_STAGES[PROFILE_STAGES.index(stage)-1]
+    query = f"SELECT * FROM {table_name} WHERE {stage} = 0 AND" \
+            f" {previous} = 1 AND good = 1"
+    values = []
+    if glider_tag is not None:
+        query = query+" AND glider_tag = ?"
+        values.append(glider_tag)
+    if file_name is not None:
+        query = query+" AND file_downloaded = ?"
+        values.append(file_name)
+    conn, c = connectDB(database)
+    c.execute(query+" ORDER BY glider_tag, profile_number", values)
+    names = [column[0] for column in c.description]
+    rows = [dict(zip(names, row)) for row in c.fetchall()]
+    conn.close()
+    return rows
+
+def previous_profile(database, table_name, glider_tag, profile_number):
+    '''
+    MLD and ZEU of the last preprocessed profile of a glider before
+    profile_number, as a dict, or None if there is none
+    '''
+    conn, c = connectDB(database)
+    c.execute(f"SELECT profile_number, mld, zeu FROM {table_name} WHERE"
+              " glider_tag = ? AND profile_number < ? AND preproc = 1 ORDER"
+              " BY profile_number DESC LIMIT 1", (glider_tag,\
+              int(profile_number)))
+    row = c.fetchone()
+    conn.close()
+    if row is None:
+        return None
+    return {'profile_number': row[0], 'mld': row[1], 'zeu': row[2]}
+
+def profiles_in_state(database, table_name, stage, state, glider_tag):
+    '''
+    Profiles of a glider done by stage but left in state (e.g. waiting
+    for mission data to complete them), in profile order, as dicts of
+    their row
+    '''
+    conn, c = connectDB(database)
+    c.execute(f"SELECT * FROM {table_name} WHERE glider_tag = ? AND"
+              f" {stage} = 1 AND {stage}_state = ? ORDER BY profile_number",
+              (glider_tag, state))
+    names = [column[0] for column in c.description]
+    rows = [dict(zip(names, row)) for row in c.fetchall()]
+    conn.close()
+    return rows
+
+def set_profile_stage(database, table_name, stage, glider_tag,\
+                      profile_numbers, done=True, state=None, files=None):
+    '''
+    Records the outcome of stage for some profiles of a glider; files
+    (one per profile) go to the preproc_file column for preprocessing
+    '''
+    today = datetime.datetime.now().strftime('%Y%m%d_%H%M')
+    conn, c = connectDB(database)
+    for count, profile_number in enumerate(profile_numbers):
+        c.execute(f"UPDATE {table_name} SET {stage} = ?, {stage}_date = ?,"
+                  f" {stage}_state = ? WHERE glider_tag = ? AND"
+                  " profile_number = ?", (int(done), today, state,\
+                  glider_tag, int(profile_number)))
+        if files is not None:
+            c.execute(f"UPDATE {table_name} SET preproc_file = ? WHERE"
+                      " glider_tag = ? AND profile_number = ?",\
+                      (files[count], glider_tag, int(profile_number)))
+    conn.commit()
+    conn.close()
+
 def rezero(database, table_name, file_column, file_name, update_column, newval):
 
    # RE-ZERO
@@ -34,6 +34,7 @@ License:        MIT Licence -- Copyright 2017 Plymouth Marine Laboratory
 '''
 #-imports-----------------------------------------------------------------------
 import os, sys, shutil
+import multiprocessing
 import datetime
 import numpy as np
 import scipy.stats as st
@@ -50,82 +51,255 @@ from . import glider_tools as gt
 from . import netCDF_tools as nct
 
 #---
-def fluor_correction_Hem(GLIDER_CONFIG,hem_regress_files,hem_correct_files,\
-                         glider_tag, N_smooth=3, surface_depth=20, \
-                         logging=False, verbose=False, Zthresh = 40):
+# rank sketch for the Hemsley Spearman correlation: joint histogram of
+# backscatter and CHLA on log-spaced bins, values beyond the edges are
+# clipped into the end bins
+HEM_BINS = 256
+HEM_SCATTER_EDGES = np.logspace(-6, 0, HEM_BINS+1)
+HEM_CHLA_EDGES = np.logspace(-3, 2, HEM_BINS+1)
+
+#---
+def hemsley_empty_stats():
     '''
-    Corrects Chl profiles with nighttime backscattering profiles. 
-    Now also corrects DCM profiles. Method ref: Hemsley et al., 2015      
+    Returns empty sufficient statistics for the Hemsley regression.
+    '''
+    return {'n': 0.0, 'mean_x': 0.0, 'mean_y': 0.0, 'Sxx': 0.0, 'Syy': 0.0,\
+            'Sxy': 0.0, 'min_x': np.inf, 'max_x': -np.inf, 'min_y': np.inf,\
+            'max_y': -np.inf, 'hist': np.zeros((HEM_BINS, HEM_BINS)),\
+            'files': []}
 
-    Steps:
-    1. prep masks and quality control
-    2. regress
-    3. determine DCM and correct profiles without DCM
+#---
+def hemsley_accumulate(stats, SCATTER, CHLA):
+    '''
+    Merges a batch of matched backscatter (x) and CHLA (y) values into the
+    running statistics (pairwise update of means and co-moments).
+    '''
+    n_b = float(len(SCATTER))
+    if n_b == 0:
+        return stats
+
+    mean_x = np.mean(SCATTER)
+    mean_y = np.mean(CHLA)
+    dx = SCATTER - mean_x
+    dy = CHLA - mean_y
+
+    n_a = stats['n']
+    n = n_a + n_b
+    delta_x = mean_x - stats['mean_x']
+    delta_y = mean_y - stats['mean_y']
+    stats['Sxx'] += np.sum(dx*dx) + delta_x*delta_x*n_a*n_b/n
+    stats['Syy'] += np.sum(dy*dy) + delta_y*delta_y*n_a*n_b/n
+    stats['Sxy'] += np.sum(dx*dy) + delta_x*delta_y*n_a*n_b/n
+    stats['mean_x'] += delta_x*n_b/n
+    stats['mean_y'] += delta_y*n_b/n
+    stats['n'] = n
+
+    stats['min_x'] = min(stats['min_x'], np.min(SCATTER))
+    stats['max_x'] = max(stats['max_x'], np.max(SCATTER))
+    stats['min_y'] = min(stats['min_y'], np.min(CHLA))
+    stats['max_y'] = max(stats['max_y'], np.max(CHLA))
+
+    ix = np.clip(np.searchsorted(HEM_SCATTER_EDGES, SCATTER, 'right')-1, 0, HEM_BINS-1)
+    iy = np.clip(np.searchsorted(HEM_CHLA_EDGES, CHLA, 'right')-1, 0, HEM_BINS-1)
+    np.add.at(stats['hist'], (ix, iy), 1)
+
+    return stats
 
-    Note: all other variables should be corrected by here, so read them in!
+#---
+def read_hemsley_stats(stats_file):
+    '''
+    Reads persisted Hemsley statistics, or returns empty ones.
     '''
+    stats = hemsley_empty_stats()
+    if stats_file and os.path.exists(stats_file):
+        with np.load(stats_file) as data:
+            for key in stats:
+                if key == 'files':
+                    stats[key] = [str(fname) for fname in data[key]]
+                elif key == 'hist':
+                    stats[key] = data[key].astype(float)
+                else:
+                    stats[key] = float(data[key])
+    return stats
 
-    debug = False
+#---
+def write_hemsley_stats(stats_file, stats):
+    '''
+    Persists Hemsley statistics, replacing the old file atomically.
+    '''
+    tmp_file = stats_file + '.tmp'
+    with open(tmp_file, 'wb') as fid:
+        np.savez(fid, **dict(stats, files=np.asarray(stats['files'], dtype=str)))
+    os.replace(tmp_file, stats_file)
 
-    all_CHLA = []
-    all_SCATTER = []
-    all_DEPTH = []
-    all_PAR = []
-    all_PROFILE_NUMBER = []
+#---
+def spearman_from_histogram(hist):
+    '''
+    Approximate Spearman rank correlation from a joint histogram: values in
+    a bin share its mid-rank, as for ties.
+    '''
+    count_x = hist.sum(axis=1)
+    count_y = hist.sum(axis=0)
+    rank_x = np.cumsum(count_x) - (count_x - 1)/2.
+    rank_y = np.cumsum(count_y) - (count_y - 1)/2.
+    n = hist.sum()
+    mean_rank = (n + 1)/2.
+    dx = rank_x - mean_rank
+    dy = rank_y - mean_rank
+    Sxy = np.dot(dx, hist.dot(dy))
+    Sxx = np.sum(count_x*dx*dx)
+    Syy = np.sum(count_y*dy*dy)
+    return Sxy/np.sqrt(Sxx*Syy)
 
-    # read processing config file
-    CONFIG_DICT = gt.read_config_file(GLIDER_CONFIG,logging=logging)
-    chl_var = CONFIG_DICT['allowed_vars'].split(',')[CONFIG_DICT['allowed_heads'].index('CHLA')]
+#---
+def hemsley_regression(stats):
+    '''
+    Least-squares slope and intercept of CHLA on backscatter, with the
+    (approximate) Spearman r and its p value; None if fewer than two
+    points or no spread in backscatter leave the line undefined.
+    '''
+    if stats['n'] < 2 or stats['Sxx'] <= 0:
+        return None
 
-    for hem_regress_file in hem_regress_files:
-        # -get the variable names for comparison to config list
-        nc_fid     = Dataset(hem_regress_file, 'r')
-        PRES = nc_fid.variables['PRES_CORRECTED'][:]
+    slope = stats['Sxy']/stats['Sxx']
+    intercept = stats['mean_y'] - slope*stats['mean_x']
+
+    n = stats['n']
+    r_val = spearman_from_histogram(stats['hist'])
+    with np.errstate(divide='ignore'):
+        t_val = r_val*np.sqrt((n - 2)/((1.0 - r_val)*(1.0 + r_val)))
+    p_val = 2*st.t.sf(np.abs(t_val), n - 2)
+
+    return slope, intercept, r_val, p_val
+
+#---
+def hemsley_regress_file(hem_regress_file, chl_var, Zthresh):
+    '''
+    Returns the finite backscatter and CHLA pairs above Zthresh in one file.
+    '''
+    nc_fid = Dataset(hem_regress_file, 'r')
+    DEPTH = np.ma.filled(nc_fid.variables['DEPTH_CORRECTED'][:].astype(float), np.nan)
+    CHLA = np.ma.filled(nc_fid.variables[chl_var][:].astype(float), np.nan)
+    SCATTER = np.ma.filled(nc_fid.variables['BACKSCATTER_CORRECTED'][:].astype(float), np.nan)
+    nc_fid.close()
+
+    with np.errstate(invalid='ignore'):
+        ii = (DEPTH <= Zthresh) & np.isfinite(CHLA) & np.isfinite(SCATTER)
+    return SCATTER[ii], CHLA[ii]
+
+#---
+def hemsley_correct_file(args):
+    '''
+    Applies the Hemsley regression to one profile file in place; a worker
+    for fluor_correction_Hem.
+    '''
+    hem_correct_file, chl_var, slope, intercept = args
+    fill_value = 1e36
+    try:
+        os.chmod(hem_correct_file, 0o777)
+        nc_fid = Dataset(hem_correct_file, 'r+')
         DEPTH = nc_fid.variables['DEPTH_CORRECTED'][:]
         CHLA = nc_fid.variables[chl_var][:]
         SCATTER = nc_fid.variables['BACKSCATTER_CORRECTED'][:]
-        PAR = nc_fid.variables['DOWNWELLING_PAR_CORRECTED'][:]
         ZEU = nc_fid.variables['EUPHOTIC_DEPTH'][:]
-        MLD = nc_fid.variables['MIXED_LAYER_DEPTH'][:]
-        PROFILE_NUMBER = nc_fid.variables['PROFILE_NUMBER'][:]
+
+        CORR_CHLA = CHLA.copy()
+        CHLA_chk = SCATTER*slope + intercept
+        dd = np.where((DEPTH <= ZEU))[0]
+        CORR_CHLA[dd] = np.maximum(CHLA_chk[dd],CORR_CHLA[dd])
+
+        CORR_CHLA = np.ma.filled(CORR_CHLA.astype(float), fill_value)
+        CORR_CHLA[np.isnan(CORR_CHLA)] = fill_value
+        nc_fid.variables['CHLA_CORRECTED'][:] = CORR_CHLA
         nc_fid.close()
+        return hem_correct_file, True
+    except:
+        return hem_correct_file, False
 
-        all_CHLA.append(CHLA)
-        all_SCATTER.append(SCATTER)
-        all_DEPTH.append(DEPTH)
-        all_PAR.append(PAR)
-        all_PROFILE_NUMBER.append(PROFILE_NUMBER)
-
-    # flatten lists and make into arrays
-    CHLA_array = np.asarray([item for sublist in all_CHLA for item in sublist]).astype(float)
-    SCATTER_array = np.asarray([item for sublist in all_SCATTER for item in sublist]).astype(float)
-    DEPTH_array = np.asarray([item for sublist in all_DEPTH for item in sublist]).astype(float)
-    PAR_array = np.asarray([item for sublist in all_PAR for item in sublist]).astype(float)
-    PROFILE_NUMBER_array = np.asarray([item for sublist in all_PROFILE_NUMBER for item in sublist]).astype(int)
-
-    # begin filtering
-    #remove deep values > Zthresh
-    CHLA_array[DEPTH_array > Zthresh]    = np.nan
-    SCATTER_array[DEPTH_array > Zthresh] = np.nan
-    PAR_array[DEPTH_array > Zthresh]     = np.nan
-
-    #remove nans
-    ii = np.where((np.isfinite(CHLA_array)) & \
-                  (np.isfinite(SCATTER_array)))[0]
-    CHLA_array = CHLA_array[ii]
-    SCATTER_array = SCATTER_array[ii]
+#---
+def hemsley_chl_var(GLIDER_CONFIG, logging=None):
+    '''
+    Name of the glider's CHLA variable.
+    '''
+    CONFIG_DICT = gt.read_config_file(GLIDER_CONFIG,logging=logging)
+    return CONFIG_DICT.allowed_vars[CONFIG_DICT.allowed_heads.index('CHLA')]
 
-    # regress
-    slope, intercept, r_val, p_val, stderr = st.linregress(SCATTER_array,CHLA_array)
-    r_val, p_val                           = st.spearmanr(SCATTER_array,CHLA_array)
+#---
+def hemsley_add_files(stats_file, hem_regress_files, chl_var, Zthresh=40):
+    '''
+    Accumulates the regression (night) files not in the statistics yet
+    and persists the statistics to stats_file (if given) when any were
+    added. Returns the statistics.
+    '''
+    stats = read_hemsley_stats(stats_file)
+    seen = set(stats['files'])
+    added = False
+    for hem_regress_file in hem_regress_files:
+        if os.path.basename(hem_regress_file) in seen:
+            continue
+        SCATTER, CHLA = hemsley_regress_file(hem_regress_file, chl_var, Zthresh)
+        hemsley_accumulate(stats, SCATTER, CHLA)
+        stats['files'].append(os.path.basename(hem_regress_file))
+        seen.add(stats['files'][-1])
+        added = True
+
+    if stats_file and added:
+        write_hemsley_stats(stats_file, stats)
+    return stats
+
+#---
+HEM_REGRESSIONS = {}
+
+def hemsley_file_regression(stats_file):
+    '''
+    hemsley_regression of persisted statistics (None without them), kept
+    until the file changes, so that correcting one profile at a time
+    does not read the statistics again for each.
+    '''
+    try:
+        stat = os.stat(stats_file)
+    except OSError:
+        return None
+    key = (stat.st_size, stat.st_mtime_ns)
+    if HEM_REGRESSIONS.get(stats_file, (None,))[0] != key:
+        HEM_REGRESSIONS[stats_file] = (key, hemsley_regression(\
+                                       read_hemsley_stats(stats_file)))
+    return HEM_REGRESSIONS[stats_file][1]
+
+#---
+def hemsley_correct_files(hem_correct_files, chl_var, slope, intercept,\
+                          n_workers=4):
+    '''
+    Applies a Hemsley regression to profile files in place, in a worker
+    pool when there are several; returns (file, corrected) pairs.
+    '''
+    jobs = [(hem_correct_file, chl_var, slope, intercept) \
+            for hem_correct_file in hem_correct_files]
+    if n_workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(n_workers, len(jobs)))
+        try:
+            return pool.map(hemsley_correct_file, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return [hemsley_correct_file(job) for job in jobs]
+
+#---
+def plot_hemsley_regression(stats, regression, glider_tag, plot_dir,\
+                            logging=None, verbose=False):
+    '''
+    Plots the rank sketch of the statistics and the regression line to
+    <plot_dir>/<glider_tag>_Hemsley_regression.png
+    '''
+    slope, intercept, r_val, p_val = regression
 
-    # make regression plot
     fig1 = plt.figure(figsize=(10,10), dpi=300)
-    plt.scatter(SCATTER_array, CHLA_array)
-    xvals = np.linspace(0,np.max(SCATTER_array),100)
+    hist = np.ma.masked_equal(stats['hist'].T, 0)
+    plt.pcolormesh(HEM_SCATTER_EDGES, HEM_CHLA_EDGES, hist, cmap='viridis')
+    xvals = np.linspace(0,stats['max_x'],100)
     plt.plot(xvals,slope*xvals + intercept,'k--')
-    plt.xlim([np.nanmin(SCATTER_array),np.nanmax(SCATTER_array)])
-    plt.ylim([np.nanmin(CHLA_array),np.nanmax(CHLA_array)])
+    plt.xlim([stats['min_x'],stats['max_x']])
+    plt.ylim([stats['min_y'],stats['max_y']])
     plt.xlabel('Backscatter [m$^{-1}$]')
     plt.ylabel('Chlorophyll [mg.m$^{-3}$]')
 
@@ -139,9 +313,8 @@ def fluor_correction_Hem(GLIDER_CONFIG,hem_regress_files,hem_correct_files,\
     else:
         p_val_format = str(p_val_format)
 
-    maxvalx = np.nanmax([np.nanmax(SCATTER_array)])
-    maxvaly = np.nanmax([np.nanmax(CHLA_array)])
-    minval = 0.0
+    maxvalx = stats['max_x']
+    maxvaly = stats['max_y']
 
     if intercept >= 0:
         isign='+'
@@ -153,125 +326,236 @@ def fluor_correction_Hem(GLIDER_CONFIG,hem_regress_files,hem_correct_files,\
             +' (r:'+str(r_val_format)\
             +', p:'+p_val_format+')',fontsize=10,color="0.5")
 
-    fname = '/users/rsg/utils/web_visible_public_share/blo/files/AlterEco/PP_plots/'\
-            + glider_tag + '_Hemsley_regression.png'
+    fname = os.path.join(plot_dir, glider_tag + '_Hemsley_regression.png')
 
     if verbose or logging==None:
         print('Plotting to: '+fname)
     if logging:
         logging.info('Plotting to: '+fname)
-    plt.savefig(fname)
+    try:
+        if not os.path.exists(plot_dir):
+            os.makedirs(plot_dir)
+        plt.savefig(fname)
+    except:
+        print('Failed to plot to: '+fname)
+        if logging:
+            logging.info('Failed to plot to: '+fname)
     plt.close(fig1) 
 
-    #-perform the corrections using regression----------------------------------
-    # check for DCM profiles: day
+#---
+def fluor_correction_Hem(GLIDER_CONFIG,hem_regress_files,hem_correct_files,\
+                         glider_tag, N_smooth=3, surface_depth=20, \
+                         logging=False, verbose=False, Zthresh = 40,\
+                         stats_file=None, n_workers=4, plot_dir=None):
+    '''
+    Corrects Chl profiles with nighttime backscattering profiles. 
+    Now also corrects DCM profiles. Method ref: Hemsley et al., 2015      
 
-    for hem_correct_file in hem_correct_files:
-        print(hem_correct_file)
+    Steps:
+    1. stream the regression files into running statistics
+    2. regress
+    3. correct profiles in a worker pool
 
-        # -get the variable names for comparison to config list
-        nc_fid = Dataset(hem_correct_file, 'r')
-        DEPTH = nc_fid.variables['DEPTH_CORRECTED'][:]
-        CHLA = nc_fid.variables[chl_var][:]
-        SCATTER = nc_fid.variables['BACKSCATTER_CORRECTED'][:]
-        PAR = nc_fid.variables['DOWNWELLING_PAR_CORRECTED'][:]
-        ZEU = nc_fid.variables['EUPHOTIC_DEPTH'][:]
-        nc_fid.close()
+    If stats_file is given, the statistics are persisted there and files
+    already in it are skipped, so NRT updates only add new night profiles.
+    The regression is plotted to plot_dir if given. Returns False,
+    correcting nothing, if the regression fails.
 
-        CORR_CHLA = CHLA.copy()
+    Note: all other variables should be corrected by here, so read them in!
+    '''
+    chl_var = hemsley_chl_var(GLIDER_CONFIG, logging=logging)
 
-        print('Correcting profile')
-        CHLA_chk = SCATTER*slope + intercept
-        try:
-            dd = np.where((DEPTH <= ZEU))[0]
-            CORR_CHLA[dd] = np.maximum(CHLA_chk[dd],CORR_CHLA[dd])
+    stats = hemsley_add_files(stats_file, hem_regress_files, chl_var,\
+                              Zthresh=Zthresh)
+
+    # regress
+    regression = hemsley_regression(stats)
+    if regression is None:
+        print('Hemsley regression failed for '+glider_tag+': '+\
+              str(int(stats['n']))+' points or no backscatter spread')
+        if logging:
+            logging.info('Hemsley regression failed for '+glider_tag+': '+\
+                         str(int(stats['n']))+' points')
+        return False
+    slope, intercept, r_val, p_val = regression
+
+    if plot_dir:
+        plot_hemsley_regression(stats, regression, glider_tag, plot_dir,\
+                                logging=logging, verbose=verbose)
+
+    #-perform the corrections using regression----------------------------------
+    results = hemsley_correct_files(hem_correct_files, chl_var, slope,\
+                                    intercept, n_workers=n_workers)
+
+    for hem_correct_file, corrected in results:
+        if corrected:
             if logging:
                 logging.info('Corrected profile: '+hem_correct_file)
-            nct.write_corrected_to_file(hem_correct_file,CORR_CHLA,'CHLA_CORRECTED','TIME',define_var=False)
-            print('Profile corrected!')
-        except:
-            print('Profile failed to corrrect')
+        else:
+            print('Profile failed to corrrect: '+hem_correct_file)
             if logging:
-                logging.info('Cannot correct profile: '+hem_correct_file)          
-
-        if debug:
-            fig = plt.figure(figsize=(10,20))
-            plt.scatter((PAR-np.nanmin(PAR))/(np.nanmax(PAR)-np.nanmin(PAR)),DEPTH*-1,color='b')
-            plt.plot([0,np.nanmax(CHLA)],[ZEU*-1,ZEU*-1],'k--')
-            plt.scatter(CHLA,DEPTH*-1,s=300,color='g',zorder=1)
-            plt.scatter(CHLA_chk,DEPTH*-1,s=200,color='0.5',zorder=2)
-            plt.scatter(CORR_CHLA,DEPTH*-1,s=100,color='r',zorder=3)
-            plt.ylim([np.nanmax(DEPTH)*-1.1, 0])
-            plt.xlim([-0.05, max([1.1,np.nanmax(CHLA)])])
-            plt.savefig('/users/rsg/utils/web_visible_public_share/blo/files/AlterEco/PP_plots/test_plots/test_'+os.path.basename(hem_correct_file).split('.')[-2])
-            plt.close(fig)
+                logging.info('Cannot correct profile: '+hem_correct_file)
+
+    return True
 
 #---
-def fluor_correction_Bie(PROFILE,TIME,CHLA,ZEU,DEPTH,\
-                         verbose=False,logging=None):
+def as_profile_columns(VAR):
     '''
-    fluor correction from Biermann et al., 2015.
+    Returns a float (depth x profile) copy of VAR with masked values as NaN,
+    and whether VAR was a single 1D profile.
     '''
-    method_success = True
-    CORR_CHLA = CHLA.copy()
+    VAR = np.ma.filled(np.ma.asarray(VAR, dtype=float), np.nan)
+    if VAR.ndim == 1:
+        return VAR.reshape(-1, 1).copy(), True
+    return VAR.copy(), False
 
-    # make 1d variables
-    if len(np.shape(PROFILE)) == 2:
-        profile1d     = np.nanmean(PROFILE,axis=0)
-        time1d        = np.nanmean(TIME,axis=0)
-        dims          = len(time1d)
-    else:
-        profile1d     = PROFILE[:]
-        time1d        = TIME[:]
-        dims          = 1
-
-    for ii in np.arange(0,dims):
-        if verbose:
-            print('profile: '+str(ii))
-        if len(np.shape(PROFILE)) == 2:
-            this_ZEU = ZEU[ii]
-            this_DEPTH = DEPTH[:,ii]
-            this_CORR_CHLA = CORR_CHLA[:,ii]
-        else:
-            this_ZEU = ZEU
-            this_DEPTH = DEPTH.copy()
-            this_CORR_CHLA = CORR_CHLA.copy()
-
-        if np.isnan(this_ZEU):
-            method_success = False
-            if logging == None or verbose:
-                print('Cannot apply Biermann correction, no ZEU: '+str(ii))
-            if logging:
-                logging.info('Cannot apply Biermann correction, no ZEU: '+str(ii))
-        else:
-            try:
-                kk = np.where(np.isnan(this_CORR_CHLA))
-                dd = np.where((this_DEPTH <= this_ZEU))[0]
-                max_fluor = np.nanmax(this_CORR_CHLA[dd])
-                ee = np.where((this_CORR_CHLA == max_fluor))
-                if this_DEPTH[np.isfinite(this_DEPTH)][0] > this_DEPTH[np.isfinite(this_DEPTH)][-1]:
-                    this_CORR_CHLA[ee[0][-1]:] = max_fluor
-                else:
-                    this_CORR_CHLA[:ee[0][0]] = max_fluor
-                this_CORR_CHLA[kk] = np.nan
-            except:
-                method_success = False
-                if logging == None or verbose:
-                    print('Cannot apply Biermann correction, NaN values: '+str(ii))
-                if logging:
-                    logging.info('Cannot apply Biermann correction, NaN values: '\
-                             +str(ii))
-
-        if len(np.shape(PROFILE)) == 2:
-            CORR_CHLA[:,ii] = this_CORR_CHLA[:]
+#---
+def profile_layers(LAYER, n_prof):
+    '''
+    Returns a per-profile float array of layer depths (MLD/ZEU).
+    '''
+    LAYER = np.ravel(np.ma.filled(np.ma.asarray(LAYER, dtype=float), np.nan))
+    if len(LAYER) == 1:
+        return np.repeat(LAYER, n_prof)
+    return LAYER[:n_prof]
+
+#---
+def profile_upcast(DEPTH):
+    '''
+    Flags columns whose first finite depth is deeper than the last, i.e.
+    profiles recorded from depth to the surface.
+    '''
+    n_rec = DEPTH.shape[0]
+    cols = np.arange(DEPTH.shape[1])
+    finite = np.isfinite(DEPTH)
+    first = np.argmax(finite, axis=0)
+    last = n_rec - 1 - np.argmax(finite[::-1], axis=0)
+    with np.errstate(invalid='ignore'):
+        return DEPTH[first, cols] > DEPTH[last, cols]
+
+#---
+def layer_maximum(VALUES, in_layer):
+    '''
+    Column maximum of VALUES inside the in_layer mask. Columns with no
+    finite in-layer value return NaN and are flagged as not ok.
+    '''
+    in_layer = in_layer & np.isfinite(VALUES)
+    ok = np.any(in_layer, axis=0)
+    max_val = np.where(in_layer, VALUES, -np.inf).max(axis=0, initial=-np.inf)
+    max_val[~ok] = np.nan
+    return max_val, ok
+
+#---
+def fill_above_maximum(CHLA, VALUES, max_val, ok, upcast, FILL):
+    '''
+    Replaces CHLA with FILL between the surface and the depth at which
+    VALUES reaches max_val (the deepest match on upcasts, the shallowest on
+    downcasts), for every ok column at once. NaNs are not replaced.
+    '''
+    n_rec = CHLA.shape[0]
+    rows = np.arange(n_rec)[:, None]
+    with np.errstate(invalid='ignore'):
+        at_max = VALUES == max_val[None, :]
+    first = np.argmax(at_max, axis=0)
+    last = n_rec - 1 - np.argmax(at_max[::-1], axis=0)
+    above = np.where(upcast[None, :], rows >= last[None, :], rows < first[None, :])
+    above &= ok[None, :] & np.isfinite(CHLA)
+    return np.where(above, FILL, CHLA)
+
+#---
+def report_failures(method, reason, failed, verbose=False, logging=None):
+    '''
+    Reports the profile columns a quenching method could not correct.
+    '''
+    if len(failed) == 0:
+        return
+    message = 'Cannot apply '+method+' correction, '+reason+': '\
+              +', '.join([str(ii) for ii in failed])
+    if logging == None or verbose:
+        print(message)
+    if logging:
+        logging.info(message)
+
+#---
+# layer that bounds the search for the quenching maximum, per method
+QUENCH_LAYERS = {'Xing': 'MLD', 'Biermann': 'ZEU', 'Swart': 'ZEU'}
+QUENCH_METHODS = ('Xing', 'Biermann', 'Swart')
+
+#---
+def quench_corrections(methods, CHLA, DEPTH, MLD=np.nan, ZEU=np.nan,\
+                       SCATTER=None, verbose=False, logging=None):
+    '''
+    Applies every requested quenching method in one pass over 1 or 2
+    dimensional (depth x profile) data. The depth ordering, in-layer masks
+    and in-layer CHLA maxima are computed once and shared between methods.
+    Each method works on the uncorrected CHLA.
+
+    Returns a dictionary of method: (CORR_CHLA, method_success). Methods
+    without a profile-level implementation (e.g. Hemsley) are ignored.
+    '''
+    CHLA, is_1d = as_profile_columns(CHLA)
+    DEPTH = as_profile_columns(DEPTH)[0]
+    n_prof = CHLA.shape[1]
+
+    upcast = profile_upcast(DEPTH)
+    layers = {'MLD': profile_layers(MLD, n_prof),\
+              'ZEU': profile_layers(ZEU, n_prof)}
+    in_layer = {}
+    layer_max = {}
+
+    results = {}
+    for method in methods:
+        if method not in QUENCH_LAYERS:
+            continue
+        layer_name = QUENCH_LAYERS[method]
+        if layer_name not in in_layer:
+            with np.errstate(invalid='ignore'):
+                in_layer[layer_name] = DEPTH <= layers[layer_name][None, :]
+        has_layer = np.isfinite(layers[layer_name])
+
+        if method == 'Swart':
+            if SCATTER is None:
+                SCATTER_cols = np.full(CHLA.shape, np.nan)
+            else:
+                SCATTER_cols = as_profile_columns(SCATTER)[0]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                ratio = np.where(in_layer[layer_name] & (SCATTER_cols > 0),\
+                                 CHLA/SCATTER_cols, np.nan)
+            max_ratio, ok = layer_maximum(ratio, in_layer[layer_name])
+            CORR_CHLA = fill_above_maximum(CHLA, ratio, max_ratio, ok,\
+                                           upcast, max_ratio[None, :]*SCATTER_cols)
+            failure = 'NaN ratio'
         else:
-            CORR_CHLA = this_CORR_CHLA[:]
+            if layer_name not in layer_max:
+                layer_max[layer_name] = layer_maximum(CHLA, in_layer[layer_name])
+            max_fluor, ok = layer_max[layer_name]
+            CORR_CHLA = fill_above_maximum(CHLA, CHLA, max_fluor, ok,\
+                                           upcast, max_fluor[None, :])
+            failure = 'NaN values'
+
+        report_failures(method, 'no '+layer_name, np.where(~has_layer)[0],\
+                        verbose=verbose, logging=logging)
+        report_failures(method, failure, np.where(has_layer & ~ok)[0],\
+                        verbose=verbose, logging=logging)
 
-    return CORR_CHLA, method_success
+        if is_1d:
+            CORR_CHLA = CORR_CHLA[:, 0]
+        results[method] = (CORR_CHLA, bool(np.all(ok)))
+
+    return results
+
+#---
+def fluor_correction_Bie(PROFILE,TIME,CHLA,ZEU,DEPTH,\
+                         verbose=False,logging=None,debug=False):
+    '''
+    fluor correction from Biermann et al., 2015.
+    '''
+    return quench_corrections(['Biermann'], CHLA, DEPTH, ZEU=ZEU,\
+                              verbose=verbose, logging=logging)['Biermann']
 
 #---
 def fluor_correction_Xin(PROFILE, TIME, CHLA, MLD, DEPTH,\
-                         verbose=False, logging=None):
+                         verbose=False, logging=None, debug=False):
     '''
      fluor correction from Xing et al., 2012.
 
@@ -288,145 +572,30 @@ def fluor_correction_Xin(PROFILE, TIME, CHLA, MLD, DEPTH,\
      Returns:
 
      CHLA_CORR: quenching corrected CHL, dimensionally consistent with CHL
-     method_success: flag to determine success. Only valid in 1D case.
+     method_success: flag to determine success; False if any profile
+                     could not be corrected.
 
      Notes:
 
      - Routine will accept 'downward' and 'upward' dives
      - NaNs are not replaced
+     - All profile columns are corrected at once with broadcast masks
 
     '''
-    method_success = True
-    CORR_CHLA = CHLA.copy()
-
-    # make 1d variables
-    if len(np.shape(PROFILE)) == 2:
-        profile1d     = np.nanmean(PROFILE,axis=0)
-        time1d        = np.nanmean(TIME,axis=0)
-        dims          = len(time1d)
-    else:
-        profile1d     = PROFILE[:]
-        time1d        = TIME[:]
-        dims          = 1
-
-    # loop to accommodate 2D data. 1D data only runs once.
-    for ii in np.arange(0,dims):
-        if verbose:
-            print('profile: '+str(ii))
-
-        if len(np.shape(PROFILE)) == 2:
-            this_MLD = MLD[ii]
-            this_DEPTH = DEPTH[:,ii]
-            this_CORR_CHLA = CORR_CHLA[:,ii]
-        else:
-            this_MLD = MLD
-            this_DEPTH = DEPTH.copy()
-            this_CORR_CHLA = CORR_CHLA.copy()
-
-        if np.isnan(this_MLD):
-            method_success = False
-            if logging == None or verbose:
-                print('Cannot apply Xing correction, no MLD: '+str(ii))
-            if logging:
-                logging.info('Cannot apply Xing correction, no MLD: '+str(ii))
-        else:
-            try:
-                kk = np.where(np.isnan(this_CORR_CHLA))            
-                dd = np.where((this_DEPTH <= this_MLD))[0]
-                max_fluor = np.nanmax(this_CORR_CHLA[dd])
-                ee = np.where((this_CORR_CHLA == max_fluor))
-                if this_DEPTH[np.isfinite(this_DEPTH)][0] > this_DEPTH[np.isfinite(this_DEPTH)][-1]:
-                    this_CORR_CHLA[ee[0][-1]:] = max_fluor
-                else:
-                    this_CORR_CHLA[:ee[0][0]] = max_fluor
-                this_CORR_CHLA[kk] = np.nan
-            except:
-                method_success = False
-                if logging == None or verbose:
-                     print('Cannot apply Xing correction, NaN values: '+str(ii))
-                if logging:
-                     logging.info('Cannot apply Xing correction, NaN values: '\
-                             +str(ii))
-
-        if len(np.shape(PROFILE)) == 2:
-            CORR_CHLA[:,ii] = this_CORR_CHLA[:]
-        else:
-            CORR_CHLA = this_CORR_CHLA[:]
-
-    return CORR_CHLA, method_success
+    return quench_corrections(['Xing'], CHLA, DEPTH, MLD=MLD,\
+                              verbose=verbose, logging=logging)['Xing']
 
 #---
 def fluor_correction_Swa(PROFILE,TIME,CHLA,ZEU,DEPTH,SCATTER,\
-                         verbose=False,logging=None):
+                         verbose=False,logging=None,debug=False):
     '''
     fluor correction from Swart et al., 2015.
-    '''
-    method_success = True
-    CORR_CHLA = CHLA.copy()
-    SCATTER_corr = SCATTER.copy()
-
-    # make 1d variables
-    if len(np.shape(PROFILE)) == 2:
-        profile1d     = np.nanmean(PROFILE,axis=0)
-        time1d        = np.nanmean(TIME,axis=0)
-        dims          = len(time1d)
-    else:
-        profile1d     = PROFILE[:]
-        time1d        = TIME[:]
-        dims          = 1
-
 
-    for ii in np.arange(0,dims):
-        if verbose:
-            print('profile: '+str(ii))
-
-        if len(np.shape(PROFILE)) == 2:
-            this_ZEU = ZEU[ii]
-            this_DEPTH = DEPTH[:,ii]
-            this_CORR_CHLA = CORR_CHLA[:,ii]
-            this_SCATTER_corr = SCATTER_corr[:,ii]
-        else:
-            this_ZEU = ZEU
-            this_DEPTH = DEPTH.copy()
-            this_CORR_CHLA = CORR_CHLA.copy()
-            this_SCATTER_corr = SCATTER_corr.copy()
-
-        if np.isnan(this_ZEU):
-            method_success = False
-            if logging == None or verbose:
-                print('Cannot apply Swart correction, no Zeu: '+str(ii))
-            if logging:
-                logging.info('Cannot apply Swart correction, no Zeu: '+str(ii))
-
-        else:
-            try:
-                kk = np.where(np.isnan(this_CORR_CHLA))
-                dd = np.where((this_DEPTH <= this_ZEU))[0]
-                tmp_CHLA = this_CORR_CHLA.copy()
-                tmp_SCA = this_SCATTER_corr.copy()
-                tmp_CHLA[~dd] = np.nan
-                tmp_SCA[~dd] = np.nan
-                ratio = tmp_CHLA/tmp_SCA
-                max_ratio = np.nanmax(ratio)
-                ee = np.where((ratio == max_ratio))
-                if this_DEPTH[np.isfinite(this_DEPTH)][0] > this_DEPTH[np.isfinite(this_DEPTH)][-1]:
-                    this_CORR_CHLA[ee[0][-1]:] = max_ratio*this_SCATTER_corr[ee:]
-                else:
-                    this_CORR_CHLA[:ee[0][0]] = max_ratio*this_SCATTER_corr[0:ee]
-                this_CORR_CHLA[kk] = np.nan
-            except:
-                method_success = False
-                if logging == None or verbose:
-                    print('Cannot apply Swart correction, NaN ratio: '+str(ii))
-                if logging:
-                    logging.info('Cannot apply Swart correction, NaN ratio: '\
-                             +str(ii))
-
-        if len(np.shape(PROFILE)) == 2:
-            CORR_CHLA[:,ii] = this_CORR_CHLA[:]
-        else:
-            CORR_CHLA = this_CORR_CHLA[:]
-
-    return CORR_CHLA, method_success
+    CHLA above the depth of the maximum in-ZEU CHLA:backscatter ratio is
+    replaced by that ratio times backscatter.
+    '''
+    return quench_corrections(['Swart'], CHLA, DEPTH, ZEU=ZEU,\
+                              SCATTER=SCATTER, verbose=verbose,\
+                              logging=logging)['Swart']
 
 #-EOF---
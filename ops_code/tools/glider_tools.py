@@ -32,12 +32,12 @@ License:        MIT Licence -- Copyright 2017 Plymouth Marine Laboratory
                 OTHER DEALINGS IN THE SOFTWARE.
 '''
 #-imports-----------------------------------------------------------------------
-import os, sys, shutil, datetime, logging
+import os, sys, datetime, logging, json, shutil, hashlib
+from collections.abc import Mapping
 from netCDF4 import Dataset
 import numpy as np
 import subprocess
 from scipy.interpolate import interp1d
-from scipy import stats
 import glob
 from scipy.interpolate import RegularGridInterpolator
 from dateutil.relativedelta import relativedelta
@@ -50,8 +50,10 @@ from matplotlib import gridspec
 from . import netCDF_tools as nct
 from . import database_tools as db
 from . import mld_utils as mu
+from . import list_array_utils as la_utils
 from . import common_tools as ct
 from . import fluor_correction as fcorr
+from . import metrics_tools as mt
 
 #-functions---------------------------------------------------------------------
 def write_trajectory_file(GLIDER_CONFIG, input_files, output_file,logging=None):
@@ -66,6 +68,95 @@ def write_trajectory_file(GLIDER_CONFIG, input_files, output_file,logging=None):
     execute(bashCommand,logging=logging)
     permit(output_file)
 
+def trajectory_variables(GLIDER_DICT):
+    '''
+     Names of the variables kept in a mission trajectory file: those of
+     write_trajectory_file plus the time coordinate that ncrcat carries
+     along with them. EGO files use the time as their record variable, so
+     names are only listed once.
+    '''
+    names = [GLIDER_DICT['lon_var'], GLIDER_DICT['lat_var'],\
+             GLIDER_DICT['t_var'], GLIDER_DICT['record_var'],\
+             GLIDER_DICT['profile_var']]
+    return [name for ii, name in enumerate(names) if name not in names[:ii]]
+
+def collect_trajectory(trajectory, dsin, record_dim, GLIDER_DICT, prof_number,\
+                       interp_vars=None):
+    '''
+     Appends the trajectory variables of one staged profile, as they are
+     written to its staged file, to trajectory (name -> list of arrays).
+     This is what write_trajectory_file would read back from the staged
+     files.
+    '''
+    if interp_vars is not None:
+        record_len = len(list(interp_vars.values())[0])
+    else:
+        record_len = len(dsin.dimensions[record_dim])
+
+    for name in trajectory_variables(GLIDER_DICT)[:-1]:
+        if interp_vars is not None:
+            if name not in interp_vars:
+                continue
+            values = np.asarray(interp_vars[name], dtype=float)
+        elif name in dsin.variables and \
+             dsin.variables[name].dimensions[:1] == (record_dim,):
+            values = np.ma.filled(dsin.variables[name][:].astype(float),\
+                                  np.nan)
+        else:
+            continue
+        trajectory.setdefault(name, []).append(values)
+
+    trajectory.setdefault(GLIDER_DICT['profile_var'], []).append(\
+        np.ones(record_len)*prof_number)
+
+def read_trajectory_files(GLIDER_CONFIG, input_files, trajectory=None):
+    '''
+     Collects the trajectory variables of already staged files
+    '''
+    GLIDER_DICT = read_config_file(GLIDER_CONFIG)
+    if trajectory is None:
+        trajectory = {}
+    for input_file in input_files:
+        nc_fid = Dataset(input_file, 'r')
+        for name in trajectory_variables(GLIDER_DICT):
+            if name in nc_fid.variables:
+                trajectory.setdefault(name, []).append(np.ma.filled(\
+                    nc_fid.variables[name][:].astype(float), np.nan))
+        nc_fid.close()
+    return trajectory
+
+def write_trajectory_arrays(GLIDER_CONFIG, trajectory, output_file,\
+                            append=False, logging=None):
+    '''
+     Writes an in-memory trajectory (see collect_trajectory) as the mission
+     trajectory file, in place of concatenating the staged files. With
+     append=True the records are added to the end of an existing file.
+    '''
+    GLIDER_DICT = read_config_file(GLIDER_CONFIG, logging=logging)
+    record_dim = GLIDER_DICT['record_var']
+    names = [name for name in trajectory_variables(GLIDER_DICT) \
+             if name in trajectory]
+
+    if append and os.path.exists(output_file):
+        nc_fid = Dataset(output_file, 'a')
+        start = len(nc_fid.dimensions[record_dim])
+        for name in names:
+            values = np.concatenate(trajectory[name])
+            nc_fid.variables[name][start:start+len(values)] = values
+        nc_fid.close()
+        return
+
+    tmp_file = output_file+'.tmp'
+    nc_fid = Dataset(tmp_file, 'w')
+    nc_fid.createDimension(record_dim, None)
+    for name in names:
+        nc_var = nc_fid.createVariable(name, np.float64, (record_dim,),\
+                                       fill_value=np.nan)
+        nc_var[:] = np.concatenate(trajectory[name])
+    nc_fid.close()
+    os.replace(tmp_file, output_file)
+    permit(output_file)
+
 def get_coords(open_file, GLIDER_DICT, logging=None, verbose=False, use_backups=False):
     '''
      Finds spatio-temporal limits of glider profile
@@ -76,8 +167,6 @@ def get_coords(open_file, GLIDER_DICT, logging=None, verbose=False, use_backups=
     good_lat = True
     good_prof = True
 
-    debug = False
-
     # lon var
     try:
         lon = nc_fid.variables[GLIDER_DICT['lon_var']][:]
@@ -126,6 +215,27 @@ def get_coords(open_file, GLIDER_DICT, logging=None, verbose=False, use_backups=
         except:
             lat = np.nan
 
+    # profile vars
+    profile_numbers = nc_fid.variables[GLIDER_DICT['profile_var']][:]
+
+    # time vars
+    try:
+        time = np.copy(nc_fid.variables[GLIDER_DICT['t_var']][:])
+    except:
+        time = None
+    nc_fid.close()
+
+    return coords_from_arrays(lon, lat, time, profile_numbers, GLIDER_DICT,\
+                              logging=logging, verbose=verbose)
+
+def coords_from_arrays(lon, lat, time, profile_numbers, GLIDER_DICT,\
+                       logging=None, verbose=False):
+    '''
+     Finds spatio-temporal limits and per-profile averages from glider
+     coordinate arrays (see get_coords)
+    '''
+    debug = False
+
     #sanity checks
     lat[lat>90.]=np.nan
     lat[lat<-90.]=np.nan
@@ -142,9 +252,6 @@ def get_coords(open_file, GLIDER_DICT, logging=None, verbose=False, use_backups=
         lat_check = lat.copy()
         lon_check = lon.copy()
 
-    # profile vars
-    profile_numbers = nc_fid.variables[GLIDER_DICT['profile_var']][:]
-
     if debug:
         print(np.nanmin(lon_check))
         print(np.nanmax(lon_check))
@@ -153,16 +260,9 @@ def get_coords(open_file, GLIDER_DICT, logging=None, verbose=False, use_backups=
 
     # time vars
     try:
-        time = np.copy(nc_fid.variables[GLIDER_DICT['t_var']][:])
         time[time > 1e32] = np.nan
-        mean_times = []
-        mean_lat = []
-        mean_lon = []
-        for profile_number in np.unique(profile_numbers):
-            
-            mean_times.append(np.nanmean(time[profile_number == profile_numbers]))
-            mean_lat.append(np.nanmean(lat[profile_number == profile_numbers]))
-            mean_lon.append(np.nanmean(lon[profile_number == profile_numbers]))
+        _, mean_times, mean_lat, mean_lon = \
+            la_utils.group_nanmean(profile_numbers, time, lat, lon)
 
         if GLIDER_DICT['t_base'] == 'seconds':
             min_time = datetime.datetime.strptime(GLIDER_DICT['t_ref'],\
@@ -221,7 +321,6 @@ def get_coords(open_file, GLIDER_DICT, logging=None, verbose=False, use_backups=
             ave_time[ii] = (this_time - \
 			   datetime.datetime(1,1,1)).total_seconds()/86400 \
                            -int(mean_times[ii])+mean_times[ii]
-    nc_fid.close()
 
     # check latitude per profile against checked coordinates
     mean_lon = np.asarray(mean_lon).astype(float)
@@ -236,19 +335,10 @@ def get_coords(open_file, GLIDER_DICT, logging=None, verbose=False, use_backups=
            np.nanmin(lat_check), np.nanmax(lat_check), mean_lat, \
            min_time, max_time, ave_time, np.unique(profile_numbers) 
 
-def nan_vals(x):
-   '''
-    QC data does not survive this process...
-   '''
-   x = x.astype(float)
-   val = np.nanmean(x)
-   return val
-
-def concatenate_files(input_dir, CONFIG, logging = None):
+def concatenate_files(input_dir, CONFIG, GLIDER_CONFIG, logging = None):
     '''
-     Concatenates glider profiles into single file
+     Concatenates glider profiles into single binned file
     '''
-    good_flag = True    
     concat_dir = input_dir.replace(CONFIG['output_dir'],CONFIG['concat_dir'])
 
     if not os.path.exists(concat_dir):
@@ -258,87 +348,175 @@ def concatenate_files(input_dir, CONFIG, logging = None):
     concat_file = concat_dir + '/' + CONFIG['gprefix'] +\
                   str(CONFIG['gnumber']) + '_binned.nc'
 
-    nc_files = glob.glob(input_dir+'/*.nc')
+    nc_files = sorted(glob.glob(input_dir+'/*.nc'))
 
-    for nc_file in nc_files:
-        output_file = nc_file.replace('_fin','_rec')
-        output_file = output_file.replace('_bad','_rec')
-        bashCommand='ncks -O --mk_rec_dim profile_number ' + nc_file + ' '\
-                     + output_file
-        execute(bashCommand,logging=logging)
-        permit(output_file)
-
-    bashCommand='ncrcat -O ' + ' '.join(nc_files) + ' '\
-                  + concat_file
-                 
-    execute(bashCommand,logging=logging)
-    permit(concat_file)
+    good_flag = write_gridded_mission(concat_file, nc_files, GLIDER_CONFIG,\
+                                      logging=logging)
     return good_flag
 
-def create_interpolated_netcdf_file(dsin, output_file, old_dim, \
-                                    interp_dim, dim_name, prof_number):
+def create_staged_netcdf_file(dsin, output_file, dim_name, profile_name,\
+                              prof_number, interp_vars=None):
     '''
-     Create a netCDF file ready to ingest interpolated variables. All variables
-     that have a different dimension length to the interpolation variables
-     are copied across untouched.
+     Writes a staged profile in a single pass. dim_name becomes the (only)
+     unlimited dimension and a profile number variable is added on it. If
+     interp_vars (name -> binned values) is given, record variables are
+     resized to the binned grid and filled from it, and QC variables are
+     dropped; otherwise every variable is copied across untouched.
     '''
+    record_len = len(dsin.dimensions[dim_name])
+    if interp_vars is not None:
+        record_len = len(list(interp_vars.values())[0])
 
     # create a new netCDF file for writing
-    dsout = Dataset(output_file,'w', format='NETCDF4_CLASSIC')
+    dsout = Dataset(output_file,'w', format=dsin.data_model)
+    dsin.set_auto_maskandscale(False)
+    dsin.set_auto_chartostring(False)
+    dsout.set_auto_maskandscale(False)
+    dsout.set_auto_chartostring(False)
 
     #Copy dimensions
-    for dname, the_dim in dsin.dimensions.iteritems():
-        if len(the_dim) == len(old_dim):
-            dsout.createDimension(dname, len(interp_dim) \
-                  if not the_dim.isunlimited() else None)
+    for dname, the_dim in dsin.dimensions.items():
+        if dname == dim_name:
+            dsout.createDimension(dname, None)
         else:
-            dsout.createDimension(dname, len(the_dim) \
-                  if not the_dim.isunlimited() else None)
+            dsout.createDimension(dname, len(the_dim))
 
     # Copy variables
-    for v_name, varin in dsin.variables.iteritems():
-        if '_qc' in v_name:
+    for v_name, varin in dsin.variables.items():
+        if v_name == profile_name:
             continue
-        # copies across all vars, but leaves interp variables space undefined.
-        if varin.dimensions and \
-                 len(dsin.dimensions[varin.dimensions[0]]) == len(old_dim):
-            outVar = dsout.createVariable(v_name, varin.datatype, dim_name)
-        else:
-            outVar = dsout.createVariable(v_name, varin.datatype,\
-                                          varin.dimensions)
+        if interp_vars is not None and '_qc' in v_name:
+            continue
+        on_record = varin.dimensions and varin.dimensions[0] == dim_name
+        attrs = dict((k, varin.getncattr(k)) for k in varin.ncattrs())
+        outVar = dsout.createVariable(v_name, varin.datatype,\
+                                      varin.dimensions,\
+                                      fill_value=attrs.pop('_FillValue', None))
+        outVar.setncatts(attrs)
+
+        if interp_vars is not None and on_record:
+            # leaves interp variables space undefined unless binned
+            if v_name in interp_vars:
+                outVar.set_auto_maskandscale(True)
+                outVar[:] = np.ma.masked_invalid(interp_vars[v_name])
+        elif varin.dimensions:
             outVar[:] = varin[:]
+        else:
+            outVar.assignValue(varin.getValue())
 
-        # Copy variable attributes
-        outVar.setncatts({k: varin.getncattr(k) for k in varin.ncattrs()})
+    # add profile number
+    ncprof_num = dsout.createVariable(profile_name, np.float64, (dim_name))
+    ncprof_num[:] = np.ones(record_len)*prof_number
 
     # close the output file    
     dsout.close()
 
 def get_profile_number(data_file):
+    # split files end in the profile number; staged files add _st_fin etc.
     parse_name=os.path.basename(data_file).split('.')[0]
-    prof_number = int(parse_name.split('_')[-1])
+    prof_number = int([part for part in parse_name.split('_') \
+                       if part.isdigit()][-1])
     return prof_number
 
+class GliderConfig(Mapping):
+    '''
+     Read-only glider configuration. Indexing gives the raw strings of the
+     .ini file as before; list and numeric fields are also available ready
+     converted as attributes (None/empty if absent or malformed).
+    '''
+    LISTS = ('allowed', 'allowed_vars', 'allowed_heads', 'quench_methods')
+    INTS = ('allowed_exact',)
+    FLOATS = ('depth_min', 'depth_max', 'depth_bin', 'PAR_conversion')
+    SCALAR_INTS = ('sgolay_win', 'sgolay_smooth', 'force_use_EO_par',\
+                   'stateful_segment', 'segment_chunk')
+
+    def __init__(self, raw):
+        raw = dict(raw)
+        # older code reads the allowed variable list as 'allowed'
+        if 'allowed' not in raw and 'allowed_vars' in raw:
+            raw['allowed'] = raw['allowed_vars']
+        fields = {'_raw': raw}
+
+        for key in self.LISTS:
+            fields[key] = tuple([item.strip() for item in \
+                                 raw.get(key, '').split(',') if item.strip()])
+        for key in self.INTS:
+            try:
+                fields[key] = tuple([int(item) for item in \
+                                     raw.get(key, '').split(',') if item.strip()])
+            except:
+                fields[key] = ()
+        for key, convert in [(key, float) for key in self.FLOATS] + \
+                            [(key, int) for key in self.SCALAR_INTS]:
+            try:
+                fields[key] = convert(raw[key])
+            except:
+                fields[key] = None
+
+        try:
+            fields['depth_edges'] = np.arange(fields['depth_min'],\
+                                              fields['depth_max']+\
+                                              fields['depth_bin'],\
+                                              fields['depth_bin'])
+            fields['depth_edges'].flags.writeable = False
+        except:
+            fields['depth_edges'] = None
+
+        for key, val in fields.items():
+            object.__setattr__(self, key, val)
+
+    def __getitem__(self, key):
+        return self._raw[key]
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __setattr__(self, key, val):
+        raise AttributeError('GliderConfig is read-only')
+
+    def __repr__(self):
+        return 'GliderConfig('+repr(self._raw)+')'
+
+# parsed configs by path, with the mtime they were read at
+CONFIG_CACHE = {}
+
 def read_config_file(GLIDER_CONFIG, logging=None, verbose=False):
-    GLIDER_DICT = {}
+    '''
+     Returns the GliderConfig for a glider .ini file, parsing it only when
+     it is first asked for or has changed on disk since.
+    '''
+    config_path = os.path.abspath(GLIDER_CONFIG)
     try:
+        mtime = os.stat(config_path).st_mtime_ns
+        if config_path in CONFIG_CACHE and \
+           CONFIG_CACHE[config_path][0] == mtime:
+            return CONFIG_CACHE[config_path][1]
+
+        GLIDER_DICT = {}
         db.shout("Reading configuration file...", logging=logging,\
                  verbose=verbose)
-        with open(GLIDER_CONFIG) as myfile:
+        with open(config_path) as myfile:
             for line in myfile:
                 if '#' in line:
                     continue
                 else:
                     name, var = line.partition("=")[::2]
                     GLIDER_DICT[name.strip()] = str(var.replace('\n', ''))
+        GLIDER_DICT = GliderConfig(GLIDER_DICT)
     except:
         db.shout("Failed to read configuration file", logging=logging,\
                  verbose=verbose)
         sys.exit()
 
+    CONFIG_CACHE[config_path] = (mtime, GLIDER_DICT)
+
     return GLIDER_DICT
 
 def execute(command, logging=None):
+    mt.count('subprocesses')
     process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, \
                                stderr=subprocess.STDOUT)
 
@@ -354,45 +532,46 @@ def execute(command, logging=None):
 def permit(myfile):
     os.chmod(myfile, 0o777)
 
-def turning_points(array):
-    # https://stackoverflow.com/questions/19936033/finding-turning-points-of-an-array-in-python
-    ''' turning_points(array) -> min_indices, max_indices
-    Finds the turning points within an 1D array and returns the indices of the minimum and 
-    maximum turning points in two separate lists.
+def turning_point_steps(array, offset=0, ps=0, begin=1):
+    '''
+     Vectorised core of turning_points. Returns the minimum and maximum
+     turning point indices plus the (state, begin) pair needed to carry on
+     with the next chunk; array[0] is then the last value of the previous
+     chunk and offset its index in the full record.
+    '''
+    d = np.sign(np.diff(array))
+    d[~np.isfinite(d)] = 0
+    steps = np.flatnonzero(d)
+    s = d[steps]
+    i = steps + 1 + offset
+
+    # a turn sits midway through any neutral run between opposite states
+    prev_s = np.concatenate(([ps], s[:-1]))
+    prev_i = np.concatenate(([begin], i[:-1]))
+    turn = (prev_s != 0) & (prev_s != s)
+    mid = (prev_i[turn] + i[turn] - 1) // 2
+    idx_min = mid[s[turn] > 0].astype(int)
+    idx_max = mid[s[turn] < 0].astype(int)
+
+    if len(s):
+        ps, begin = s[-1], i[-1]
+
+    return idx_min, idx_max, ps, begin
+
+def tidy_turning_points(idx_min, idx_max):
+    '''
+     Applies the turning_points catches to raw turning point indices.
     '''
-    idx_max, idx_min = [], []
-    if (len(array) < 3): 
-        return idx_min, idx_max
-
-    NEUTRAL, RISING, FALLING = range(3)
-    def get_state(a, b):
-        if a < b: return RISING
-        if a > b: return FALLING
-        return NEUTRAL
-
-    ps = get_state(array[0], array[1])
-    begin = 1
-    for i in range(2, len(array)):
-        s = get_state(array[i - 1], array[i])
-        if s != NEUTRAL:
-            if ps != NEUTRAL and ps != s:
-                if s == FALLING: 
-                    idx_max.append((begin + i - 1) // 2)
-                else:
-                    idx_min.append((begin + i - 1) // 2)
-            begin = i
-            ps = s
-
     # catches
-    if not idx_min:
+    if len(idx_min) == 0:
         idx_min = [0]
 
-    if not idx_max:
+    if len(idx_max) == 0:
         idx_min = [0]
 
     # convert to array
-    idx_max = np.asarray(idx_max)
-    idx_min = np.asarray(idx_min)
+    idx_max = np.asarray(idx_max).astype(int)
+    idx_min = np.asarray(idx_min).astype(int)
 
     # stop early misses
     idx_min[idx_min < 10] = 0
@@ -402,6 +581,110 @@ def turning_points(array):
 
     return idx_min, idx_max
 
+def turning_points(array):
+    # https://stackoverflow.com/questions/19936033/finding-turning-points-of-an-array-in-python
+    ''' turning_points(array) -> min_indices, max_indices
+    Finds the turning points within an 1D array and returns the indices of the minimum and 
+    maximum turning points in two separate lists.
+    '''
+    if (len(array) < 3): 
+        return [], []
+
+    idx_min, idx_max, _, _ = turning_point_steps(np.asarray(array, dtype=float))
+
+    return tidy_turning_points(idx_min, idx_max)
+
+def smooth_depth(x_var, nominal_depth_var, depth_pol, sgolay_win, sgolay_smooth,\
+                 last_good=None):
+    '''
+     Clips, gap-fills and smooths a glider depth record. last_good is an
+     optional (x, depth) pair of arrays of good points preceding the record
+     to interpolate and extrapolate from.
+    '''
+    nominal_depth_var = np.ma.filled(np.ma.asarray(nominal_depth_var)\
+                                     .astype(float), np.nan)
+    if depth_pol == 'positive':
+        nominal_depth_var[nominal_depth_var < 0.0] = 0.0
+    else:
+        nominal_depth_var[nominal_depth_var > 0.0] = 0.0
+
+    # fill gaps
+    good = np.isfinite(nominal_depth_var)
+    x_good = x_var[good]
+    y_good = nominal_depth_var[good]
+    if last_good is not None:
+        x_good = np.concatenate((last_good[0], x_good))
+        y_good = np.concatenate((last_good[1], y_good))
+    fn = interp1d(x_good, y_good, fill_value="extrapolate")
+    ndv = fn(x_var)
+
+    # smooth depth field
+    ndv_smooth = savgol_filter(ndv, sgolay_win, sgolay_smooth)
+
+    return ndv, ndv_smooth
+
+def stream_turning_points(depth_var, x_var, depth_pol, sgolay_win,\
+                          sgolay_smooth, chunk_size=1000000):
+    '''
+     Chunked interp1d / savgol_filter / turning_points over a whole record.
+     depth_var and x_var (or None for record indices) may be netCDF
+     variables and are read one overlapping window at a time, so memory is
+     bounded by chunk_size. Windows carry a halo of one smoothing window and
+     are extended past trailing gaps, so results match the whole-record
+     calculation.
+    '''
+    rec_len = len(depth_var)
+    if (rec_len < 3):
+        return [], []
+
+    halo = sgolay_win
+    chunk_size = max(int(chunk_size), halo)
+
+    idx_min, idx_max = [], []
+    ps, begin = 0, 1
+    last_good = None
+    last_smooth = []
+    for start in range(0, rec_len, chunk_size):
+        stop = min(start + chunk_size, rec_len)
+        lo = max(start - halo, 0)
+        hi = min(stop + halo, rec_len)
+
+        depth = np.ma.filled(np.ma.asarray(depth_var[lo:hi]).astype(float),\
+                             np.nan)
+        # read on past trailing gaps so they interpolate as a whole record
+        while hi < rec_len and not np.isfinite(depth[-1]):
+            new_hi = min(hi + chunk_size, rec_len)
+            more = np.ma.asarray(depth_var[hi:new_hi]).astype(float)
+            depth = np.concatenate((depth, np.ma.filled(more, np.nan)))
+            hi = new_hi
+
+        if x_var is None:
+            xs = np.arange(lo, hi).astype(float)
+        else:
+            xs = np.ma.asarray(x_var[lo:hi]).data.astype(float)
+
+        ndv, ndv_smooth = smooth_depth(xs, depth, depth_pol, sgolay_win,\
+                                       sgolay_smooth, last_good=last_good)
+
+        # carry the last two good points before the next window forwards
+        nxt = stop - halo - lo
+        good = np.flatnonzero(np.isfinite(depth[0:max(nxt, 0)]))[-2:]
+        if last_good is None:
+            last_good = ([], [])
+        last_good = (np.concatenate((last_good[0], xs[good]))[-2:],\
+                     np.concatenate((last_good[1], ndv[good]))[-2:])
+
+        core = ndv_smooth[start-lo:stop-lo]
+        mins, maxs, ps, begin = turning_point_steps(\
+                np.concatenate((last_smooth, core)),\
+                offset=start-len(last_smooth), ps=ps, begin=begin)
+        idx_min.append(mins)
+        idx_max.append(maxs)
+        last_smooth = core[-1:]
+
+    return tidy_turning_points(np.concatenate(idx_min),\
+                               np.concatenate(idx_max))
+
 def split_dive_index(data_file, output_file, GLIDER_CONFIG, logging=None, \
                      profiles_nums_exist=False):
     '''
@@ -421,43 +704,20 @@ def split_dive_index(data_file, output_file, GLIDER_CONFIG, logging=None, \
         nc_fid.close()
     else:
         nc_fid = Dataset(data_file)
-        nominal_depth_var = nc_fid.variables[CONFIG_DICT['depth_var']][:]
-        nominal_depth_var = np.ma.filled(nominal_depth_var.astype(float), np.nan)
-
-        try:
-            x_var = nc_fid.variables[CONFIG_DICT['record_var']][:]
-            if 'numpy.ma.core.MaskedArray' in str(type(x_var)):
-                x_var = x_var.data
-                x_var = np.ma.filled(x_var.astype(float), np.nan)
-        except:
-            x_var = np.arange(len(nominal_depth_var))
-
-        nc_fid.close()
-
-        if CONFIG_DICT['depth_pol'] == 'positive':
-            nominal_depth_var[nominal_depth_var < 0.0] = 0.0
+        depth_var = nc_fid.variables[CONFIG_DICT['depth_var']]
+        rec_len = len(depth_var)
+        if CONFIG_DICT['record_var'] in nc_fid.variables:
+            x_var = nc_fid.variables[CONFIG_DICT['record_var']]
         else:
-            nominal_depth_var[nominal_depth_var > 0.0] = 0.0
-
-        # fill gaps
-        print('Interpolating....')
-        fn = interp1d(x_var[np.isfinite(nominal_depth_var)],\
-                  nominal_depth_var[np.isfinite(nominal_depth_var)],
-                  fill_value="extrapolate")
-        ndv = fn(x_var)
-
-        # iterate through file to find inversion points
-        rec_len = len(ndv)
-        xlocs = np.arange(rec_len)
-
-        # smooth depth field
-        print('Smoothing....')
-        ndv_smooth = savgol_filter(ndv,\
-                               int(CONFIG_DICT['sgolay_win']),\
-                               int(CONFIG_DICT['sgolay_smooth']))
-        # find inversion points
+            x_var = None
+
+        # gap fill, smooth and find inversion points a window at a time
         print('Finding turning points....')
-        idx_min, idx_max = turning_points(ndv_smooth)
+        idx_min, idx_max = stream_turning_points(depth_var, x_var,\
+                                   CONFIG_DICT['depth_pol'],\
+                                   CONFIG_DICT.sgolay_win,\
+                                   CONFIG_DICT.sgolay_smooth,\
+                                   chunk_size=CONFIG_DICT.segment_chunk or 1000000)
 
         # reverse polarity if depth values are negative
         if np.nanmean(idx_max) < np.nanmean(idx_min):
@@ -465,25 +725,28 @@ def split_dive_index(data_file, output_file, GLIDER_CONFIG, logging=None, \
             idx_max = idx_min[:]
             idx_min = tmp[:]
 
-        profile_num = np.zeros(rec_len).astype(int)
-
         # first profile
         print('Assigning profile numbers....')
         idx = np.sort(np.concatenate((idx_max,idx_min)))
 
-        count = 0
-        if idx[0] != 0:
-            profile_num[0:idx[0]-1] = 0
-            count = count + 1
-
-        for ii in range(len(idx)-1):
-            profile_num[idx[ii]:idx[ii+1]] = count
-            count = count + 1
-   
-        profile_num[idx[-1]:] = count
+        # each record takes the count of the last turning point at or
+        # before it, offset by one if the record starts mid-profile
+        recs = np.arange(rec_len)
+        count = 1 if idx[0] != 0 else 0
+        profile_num = np.searchsorted(idx, recs, side='right') - 1 + count
+        profile_num[recs < idx[0]] = 0
 
         if debug:
             print('Making debug plots...')
+            if x_var is None:
+                x_var = np.arange(rec_len)
+            else:
+                x_var = np.ma.asarray(x_var[:]).data.astype(float)
+            ndv, ndv_smooth = smooth_depth(x_var, depth_var[:],\
+                                   CONFIG_DICT['depth_pol'],\
+                                   CONFIG_DICT.sgolay_win,\
+                                   CONFIG_DICT.sgolay_smooth)
+            xlocs = np.arange(rec_len)
             partition = 2000
             for ii in range(0,len(xlocs),partition):
                 plt.plot(xlocs[ii:ii+partition-1],ndv[ii:ii+partition-1],'0.5')
@@ -494,16 +757,18 @@ def split_dive_index(data_file, output_file, GLIDER_CONFIG, logging=None, \
                 plt.xlim([xlocs[ii], xlocs[ii+partition-1]])
                 plt.savefig('depth_profile'+str(ii))
 
+        nc_fid.close()
+
     # now split
     print('Splitting....')
     split_files = []
     profile_num = np.asarray(profile_num).astype(int)
-    recs = np.arange(rec_len).astype(int)
-    for ii in np.unique(profile_num):
-        this_rec = recs[profile_num == ii]
+    uprofs, first_rec = np.unique(profile_num, return_index=True)
+    last_rec = rec_len - 1 - np.unique(profile_num[::-1], return_index=True)[1]
+    for ii, rec_0, rec_1 in zip(uprofs, first_rec, last_rec):
         split_file = output_file.replace('.nc','_'+str(ii).zfill(6)+'.nc')
         split_files.append(split_file)
-        bashCommand='ncks -O -d '+CONFIG_DICT['record_var']+','+str(this_rec[0])+','+str(this_rec[-1])\
+        bashCommand='ncks -O -d '+CONFIG_DICT['record_var']+','+str(rec_0)+','+str(rec_1)\
                     +' '+data_file+' '+ split_file
 
         db.shout(bashCommand, logging=logging, verbose=False)
@@ -512,19 +777,216 @@ def split_dive_index(data_file, output_file, GLIDER_CONFIG, logging=None, \
 
     return split_files
 
+def write_record_slices(sources, output_file, record_dim):
+    '''
+     Writes the records [start, stop) of each (file, start, stop) source to
+     a single file along record_dim. Everything off the record dimension is
+     copied from the last source; record variables missing from an earlier
+     source are left as fill values.
+    '''
+    nrec = sum([stop - start for _, start, stop in sources])
+    dsins = [Dataset(source[0], 'r') for source in sources]
+    for dsin in dsins:
+        dsin.set_auto_maskandscale(False)
+        dsin.set_auto_chartostring(False)
+    dsin = dsins[-1]
+
+    dsout = Dataset(output_file, 'w', format=dsin.data_model)
+    dsout.set_auto_maskandscale(False)
+    dsout.set_auto_chartostring(False)
+
+    for dname, the_dim in dsin.dimensions.items():
+        if dname == record_dim:
+            dsout.createDimension(dname, None if the_dim.isunlimited() \
+                                  else nrec)
+        else:
+            dsout.createDimension(dname, None if the_dim.isunlimited() \
+                                  else len(the_dim))
+
+    for v_name, varin in dsin.variables.items():
+        attrs = dict((k, varin.getncattr(k)) for k in varin.ncattrs())
+        outVar = dsout.createVariable(v_name, varin.datatype,\
+                                      varin.dimensions,\
+                                      fill_value=attrs.pop('_FillValue', None))
+        outVar.setncatts(attrs)
+
+        if not varin.dimensions:
+            outVar.assignValue(varin.getValue())
+        elif varin.dimensions[0] != record_dim:
+            outVar[:] = varin[:]
+        else:
+            pos = 0
+            for src_fid, (_, start, stop) in zip(dsins, sources):
+                if v_name in src_fid.variables:
+                    outVar[pos:pos+stop-start] = \
+                          src_fid.variables[v_name][start:stop]
+                pos = pos + stop - start
+
+    dsout.close()
+    for src_fid in dsins:
+        src_fid.close()
+
+def read_segment_state(state_file):
+    '''
+     Reads the NRT segmentation state of a glider, or starts a new one.
+    '''
+    state = {'offset': 0, 'done': 0, 'raw_x': [], 'raw_depth': [],\
+             'good_x': [], 'good_depth': [], 'ps': 0, 'begin': 1,\
+             'last_smooth': [], 'profile': 0, 'open_start': 0,\
+             'sources': [], 'files': {}, 'last_file': ''}
+    if os.path.exists(state_file):
+        with open(state_file) as myfile:
+            state.update(json.load(myfile))
+    return state
+
+def write_segment_state(state, state_file):
+    '''
+     Saves the NRT segmentation state of a glider.
+    '''
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as myfile:
+        json.dump(state, myfile)
+    os.replace(tmp_file, state_file)
+
+def split_dive_stateful(data_file, output_file, GLIDER_CONFIG, state_file,\
+                        logging=None, flush=False):
+    '''
+     Splits successive NRT deliveries of one glider into dives, carrying the
+     smoothing window, turning point state and the open (last, incomplete)
+     profile across calls in state_file. Only profiles completed by this
+     delivery are written; a dive straddling two deliveries is written once
+     both have arrived. flush=True closes the open profile (end of mission).
+     Gaps running off the end of a delivery wait for the next one, so the
+     profile boundaries match those of split_dive_index on the whole mission.
+     A delivery older than the last one segmented is rejected: its profiles
+     would fall before, and take the numbers of, profiles already written.
+    '''
+    # read processing config file
+    CONFIG_DICT = read_config_file(GLIDER_CONFIG,logging=logging)
+    win = CONFIG_DICT.sgolay_win
+
+    state = read_segment_state(state_file)
+    if data_file in state['files']:
+        db.shout(data_file+' already segmented', logging=logging)
+        return state['files'][data_file]
+
+    if os.path.basename(data_file) < os.path.basename(state['last_file']):
+        raise RuntimeError(data_file+' arrived after '+state['last_file']+\
+                           '; re-stage the mission without '+state_file+\
+                           ' to include it')
+
+    nc_fid = Dataset(data_file)
+    depth = nc_fid.variables[CONFIG_DICT['depth_var']][:]
+    depth = np.ma.filled(np.ma.asarray(depth).astype(float), np.nan)
+    record_dim = CONFIG_DICT['record_var']
+    if record_dim not in nc_fid.dimensions:
+        record_dim = nc_fid.variables[CONFIG_DICT['alt_record_var']].dimensions[0]
+    nc_fid.close()
+
+    # mission record indices of the carried window and this delivery
+    offset = state['offset']
+    rec_len = len(depth)
+    end = offset + rec_len
+    state['sources'].append([data_file, offset, rec_len])
+
+    raw_x = np.concatenate((state['raw_x'], np.arange(offset, end))).astype(float)
+    raw_depth = np.concatenate((np.asarray(state['raw_depth'], dtype=float),\
+                                depth))
+    g0 = end - len(raw_x)
+
+    # commit smoothed values that later deliveries can no longer change
+    good = np.flatnonzero(np.isfinite(raw_depth))
+    if flush:
+        commit_end = end
+    elif len(good):
+        commit_end = g0 + good[-1] + 1 - win
+    else:
+        commit_end = g0
+
+    split_files = []
+    if commit_end > state['done'] and len(good) + len(state['good_x']) > 1:
+        last_good = (np.asarray(state['good_x']),\
+                     np.asarray(state['good_depth']))
+        ndv, ndv_smooth = smooth_depth(raw_x, raw_depth,\
+                                       CONFIG_DICT['depth_pol'], win,\
+                                       CONFIG_DICT.sgolay_smooth,\
+                                       last_good=last_good)
+        core = ndv_smooth[state['done']-g0:commit_end-g0]
+        last_smooth = state['last_smooth']
+        mins, maxs, ps, begin = turning_point_steps(\
+                np.concatenate((last_smooth, core)),\
+                offset=state['done']-len(last_smooth),\
+                ps=state['ps'], begin=state['begin'])
+        state['ps'], state['begin'] = float(ps), int(begin)
+        state['last_smooth'] = [float(core[-1])]
+        state['done'] = int(commit_end)
+
+        # stop early misses
+        idx = np.sort(np.concatenate((mins, maxs)))
+        idx[idx < 10] = 0
+        if flush:
+            idx = np.append(idx, end)
+
+        for boundary in idx:
+            if boundary <= state['open_start']:
+                continue
+            # gather the profile from the deliveries holding it
+            sources = []
+            for source, start, length in state['sources']:
+                lo = max(state['open_start'], start) - start
+                hi = min(boundary, start + length) - start
+                if hi > lo:
+                    sources.append((source, int(lo), int(hi)))
+
+            split_file = output_file.replace('.nc','_'+\
+                                   str(state['profile']).zfill(6)+'.nc')
+            write_record_slices(sources, split_file, record_dim)
+            permit(split_file)
+            split_files.append(split_file)
+
+            state['profile'] = state['profile'] + 1
+            state['open_start'] = int(boundary)
+
+        # carry forward a window for smoothing and the last good points
+        keep = max(state['done'] - win - g0, 0)
+        before = good[good < keep]
+        state['good_x'] = np.concatenate((state['good_x'],\
+                                          raw_x[before]))[-2:].tolist()
+        state['good_depth'] = np.concatenate((state['good_depth'],\
+                                              ndv[before]))[-2:].tolist()
+        state['raw_x'] = raw_x[keep:].tolist()
+        state['raw_depth'] = np.where(np.isfinite(raw_depth[keep:]),\
+                                      raw_depth[keep:], None).tolist()
+    else:
+        state['raw_x'] = raw_x.tolist()
+        state['raw_depth'] = np.where(np.isfinite(raw_depth),\
+                                      raw_depth, None).tolist()
+
+    # forget deliveries that no longer hold open records
+    state['sources'] = [source for source in state['sources'] \
+                        if source[1] + source[2] > state['open_start']]
+    state['offset'] = int(end)
+    state['last_file'] = data_file
+    state['files'][data_file] = split_files
+    write_segment_state(state, state_file)
+
+    return split_files
+
 def interpolate_dive(data_file, output_file, GLIDER_CONFIG, CONFIG,\
-                     interp_flag=False, logging=None):
+                     interp_flag=False, logging=None, trajectory=None):
     '''
-     Finds minimum/maximum depth in glide profile to enable it to be split     
+     Bins (if requested) a split profile and writes the final staged
+     _fin/_bad file directly, with an unlimited record dimension and the
+     profile number added. If a trajectory dict is given, the profile's
+     trajectory variables are appended to it (see collect_trajectory).
     '''
     good_flag = True
 
-    if os.path.exists(output_file):
-        os.remove(output_file)
-
-    bad_file = output_file.replace('_int','_bad')
-    if os.path.exists(bad_file):
-        os.remove(bad_file)
+    # remove stale outputs of any earlier staging
+    for old_file in [output_file, output_file.replace('.nc','_fin.nc'),\
+                     output_file.replace('.nc','_bad.nc')]:
+        if os.path.exists(old_file):
+            os.remove(old_file)
 
     # read processing config file
     CONFIG_DICT = read_config_file(GLIDER_CONFIG,logging=logging)
@@ -533,89 +995,385 @@ def interpolate_dive(data_file, output_file, GLIDER_CONFIG, CONFIG,\
     nc_vars = list(data_fid.variables.keys())
     depth = data_fid.variables[CONFIG_DICT['depth_var']][:]
     prof_number = get_profile_number(data_file)
-    
-    if interp_flag:
-        interp_bins = np.arange(float(CONFIG_DICT['depth_min']),\
-                                float(CONFIG_DICT['depth_max'])+\
-                                float(CONFIG_DICT['depth_bin']),\
-                                float(CONFIG_DICT['depth_bin']))
-        interp_depth = interp_bins[0:-1]
 
-        # create a netCDF ready for population with interpolated variables
-        create_interpolated_netcdf_file(data_fid, output_file,\
-                                    depth, interp_depth,\
-                                    CONFIG_DICT['record_var'],prof_number)
+    record_dim = CONFIG_DICT['record_var']
+    if record_dim not in data_fid.dimensions:
+        record_dim = data_fid.variables[CONFIG_DICT['alt_record_var']].dimensions[0]
 
-        # reopen and add profile number
-        nc_fid = Dataset(output_file,'r+')
-        rec_var = nc_fid.variables[CONFIG_DICT['record_var']][:]
-        ncprof_num = nc_fid.createVariable(CONFIG_DICT['profile_var'],np.float64,\
-                       (CONFIG_DICT['record_var']))
-        ncprof_num[:] = np.ones(len(rec_var))*prof_number
-        allowed_vars = list(CONFIG_DICT['allowed'].split(','))
+    interp_vars = None
+    if interp_flag:
+        interp_bins = CONFIG_DICT.depth_edges
+        interp_depth = interp_bins[0:-1]
+        allowed_vars = list(CONFIG_DICT.allowed)
 
+        # gather every allowed record variable, then bin them in one pass
+        interp_vars = {CONFIG_DICT['depth_var'] : interp_depth}
+        bin_vars = []
+        bin_data = []
         for nc_var in nc_vars:
             # only process allowed variables          
-            var_matches = set([nc_var]).intersection(set(allowed_vars))
-
-            if not var_matches:
-                continue
-
-            # special conditions: depth variable
-            if nc_var == CONFIG_DICT['depth_var']:
-                nc_fid.variables[nc_var][:] = interp_depth
+            if nc_var not in allowed_vars or nc_var == CONFIG_DICT['depth_var']:
                 continue
 
-            dims = nc_fid.variables[nc_var].dimensions
-            if dims and dims[0] == CONFIG_DICT['record_var']:
-                # binning approach
-                data = data_fid.variables[nc_var][:]
-
+            dims = data_fid.variables[nc_var].dimensions
+            if dims and dims[0] == record_dim:
                 try:
-                    bin_data, bin_edges, bin_number = \
-                                            stats.binned_statistic(depth,\
-                                            data, statistic=nan_vals,\
-                                            bins=interp_bins,\
-                                            range=[np.nanmin(interp_bins),\
-                                            np.nanmax(interp_bins)])
-                    nc_fid.variables[nc_var][:] = bin_data
+                    data = data_fid.variables[nc_var][:]
+                    bin_data.append(np.ma.filled(data.astype(float), np.nan))
+                    bin_vars.append(nc_var)
                 except:
                     good_flag = False
-                    nc_fid.variables[nc_var][:] = interp_depth*np.nan
-        nc_fid.close()
-        data_fid.close()
-    else:
-        data_fid.close()
-        shutil.copy(data_file, output_file)
-        # reopen and add profile number
-        nc_fid = Dataset(output_file,'r+')
-        try:
-            rec_var = nc_fid.variables[CONFIG_DICT['record_var']][:]
-            ncprof_num = nc_fid.createVariable(CONFIG_DICT['profile_var'],np.float64,\
-                       (CONFIG_DICT['record_var']))
-        except:
-            rec_var = nc_fid.variables[CONFIG_DICT['alt_record_var']][:]
-            ncprof_num = nc_fid.createVariable(CONFIG_DICT['profile_var'],np.float64,\
-                       (CONFIG_DICT['record_var']))
-        ncprof_num[:] = np.ones(len(rec_var))*prof_number
-        nc_fid.close()
+                    interp_vars[nc_var] = interp_depth*np.nan
+
+        # binning approach
+        binned = la_utils.bin_nanmean(depth, interp_bins, *bin_data)
+        interp_vars.update(zip(bin_vars, binned))
 
-    # rename files based on level of success
+    # name files based on level of success
     if good_flag:
         output_file_final = output_file.replace('.nc','_fin.nc')
     else:
         output_file_final = output_file.replace('.nc','_bad.nc')
 
-    # this is evil! needs managing!
-    bashCommand='ncks -O --mk_rec_dim '+CONFIG_DICT['record_var']+' '+ \
-                output_file + ' ' + output_file_final
-
-    execute(bashCommand, logging=logging)
+    # single write of the final staged file
+    create_staged_netcdf_file(data_fid, output_file_final, record_dim,\
+                              CONFIG_DICT['profile_var'], prof_number,\
+                              interp_vars=interp_vars)
+    if trajectory is not None:
+        collect_trajectory(trajectory, data_fid, record_dim, CONFIG_DICT,\
+                           prof_number, interp_vars=interp_vars)
+    data_fid.close()
     permit(output_file_final)
 
     # remove intermediate data files
     os.remove(data_file)
-    os.remove(output_file)
+
+    return output_file_final
+
+@mt.spanned('staging', target='input_file')
+def stage_file(input_file, output_file, GLIDER_CONFIG, module_config,\
+               interp_flag=False, trajectory=None, max_profiles=None,\
+               logging=None):
+    '''
+     Splits a downloaded glider file into profiles and writes each staged
+     profile file. Returns the split file names and the staged files; with
+     max_profiles (a --sample budget) only the first max_profiles split
+     files are staged, so there can be fewer staged files than split ones.
+    '''
+    #check to see if profile numbers exist already
+    profiles_nums_exist = check_for_profile_numbers(input_file,GLIDER_CONFIG)
+
+    # dive splitting; NRT deliveries carry on from the previous one
+    CONFIG_DICT = read_config_file(GLIDER_CONFIG, logging=logging)
+    if CONFIG_DICT.stateful_segment == 1 \
+       and not profiles_nums_exist:
+        state_file = os.path.join(os.path.dirname(output_file),\
+                     'segment_state_'+\
+                     os.path.basename(GLIDER_CONFIG).replace('.ini','.json'))
+        split_files = split_dive_stateful(input_file,\
+                                 output_file, GLIDER_CONFIG, state_file,\
+                                 logging=logging)
+    else:
+        split_files = split_dive_index(input_file,\
+                                 output_file, GLIDER_CONFIG,\
+                                 logging=logging, \
+                                 profiles_nums_exist=profiles_nums_exist)
+
+    if logging:
+        logging.info("Split into: "+str(len(split_files))+" profiles")
+
+    # interpolation onto depth levels (if required) and output
+    staged_files = []
+    for split_file in split_files[:max_profiles]:
+        if interp_flag:
+            staged_file = split_file.replace('.nc','_st_int.nc')
+        else:
+            staged_file = split_file.replace('.nc','_st.nc')
+        done_files = [done_file for done_file in \
+                      [staged_file.replace('.nc','_fin.nc'),\
+                       staged_file.replace('.nc','_bad.nc')] \
+                      if os.path.exists(done_file)]
+        if not os.path.exists(split_file) and done_files:
+            # a re-staged delivery the stateful split has seen: staging
+            # consumed this split file, so keep the profile staged then
+            staged_files.append(done_files[0])
+            if trajectory is not None:
+                read_trajectory_files(GLIDER_CONFIG, done_files[:1],\
+                                      trajectory=trajectory)
+            if logging:
+                logging.info("Already staged: "+staged_files[-1])
+            continue
+        staged_files.append(interpolate_dive(split_file, staged_file,\
+                            GLIDER_CONFIG, module_config,\
+                            interp_flag=interp_flag, logging=logging,\
+                            trajectory=trajectory))
+        if logging:
+            logging.info("Created: "+staged_files[-1])
+
+    return split_files, staged_files
+
+def profile_summaries(GLIDER_CONFIG, split_files, staged_files, trajectory=None):
+    '''
+     Per-profile rows for the profile table of newly staged files: profile
+     number, files, record count, time range, mean position and a
+     signature of the profile's trajectory values, which tells a changed
+     profile from an unchanged re-delivery. Uses the in-memory trajectory
+     of stage_file when given, otherwise reads the staged files.
+    '''
+    GLIDER_DICT = read_config_file(GLIDER_CONFIG)
+    if trajectory is None:
+        trajectory = read_trajectory_files(GLIDER_CONFIG, staged_files)
+    names = [name for name in trajectory_variables(GLIDER_DICT)[:3] \
+             if name in trajectory]
+
+    profiles = []
+    for count, (split_file, staged_file) in enumerate(zip(split_files,\
+                                                          staged_files)):
+        values = dict([(name, np.asarray(trajectory[name][count], dtype=float))\
+                       for name in names])
+        sha = hashlib.sha1()
+        for name in names:
+            sha.update(values[name].tobytes())
+        summary = {'profile_number': get_profile_number(split_file),\
+                   'split_file': split_file, 'staged_file': staged_file,\
+                   'good': int(not staged_file.endswith('_bad.nc')),\
+                   'n_records': len(values[names[0]]) if names else 0,\
+                   'signature': sha.hexdigest()}
+        for key, name, reduce in [('time_start', GLIDER_DICT['t_var'], np.nanmin),\
+                                  ('time_end', GLIDER_DICT['t_var'], np.nanmax),\
+                                  ('lon_mean', GLIDER_DICT['lon_var'], np.nanmean),\
+                                  ('lat_mean', GLIDER_DICT['lat_var'], np.nanmean)]:
+            summary[key] = None
+            if name in values and np.any(np.isfinite(values[name])):
+                summary[key] = float(reduce(values[name]))
+        profiles.append(summary)
+
+    return profiles
+
+def update_trajectory(GLIDER_CONFIG, trajectory_file, trajectory, staged_files,\
+                      logging=None):
+    '''
+     Appends newly staged profiles (see collect_trajectory) to the mission
+     trajectory file, making it from the earlier staged files first if
+     needed. Profiles the file already holds (a re-delivered file staged
+     again) are not appended twice.
+    '''
+    if os.path.exists(trajectory_file):
+        profile_var = read_config_file(GLIDER_CONFIG,\
+                                       logging=logging)['profile_var']
+        nc_fid = Dataset(trajectory_file, 'r')
+        known = set()
+        if profile_var in nc_fid.variables:
+            known = set(np.unique(np.ma.filled(\
+                    nc_fid.variables[profile_var][:].astype(float), np.nan)))
+        nc_fid.close()
+        keep = [ii for ii, values in \
+                enumerate(trajectory.get(profile_var, [])) \
+                if not len(values) or values[0] not in known]
+        if len(keep) < len(trajectory.get(profile_var, [])):
+            trajectory = dict((name, [values[ii] for ii in keep]) \
+                              for name, values in trajectory.items())
+        if keep:
+            write_trajectory_arrays(GLIDER_CONFIG, trajectory,\
+                                    trajectory_file, append=True,\
+                                    logging=logging)
+        return
+
+    old_files = [staged_file for staged_file in \
+                 sorted(glob.glob(os.path.join(os.path.dirname(\
+                 staged_files[0]), '*_st_*.nc'))) \
+                 if staged_file not in staged_files]
+    full_trajectory = read_trajectory_files(GLIDER_CONFIG, old_files)
+    for name, values in trajectory.items():
+        full_trajectory.setdefault(name, []).extend(values)
+    write_trajectory_arrays(GLIDER_CONFIG, full_trajectory, trajectory_file,\
+                            logging=logging)
+
+def fly_profiles(EO_dir, GLIDER_CONFIG, trajectory, MODULE_DICT, TRA_CONFIG,\
+                 variables=None, logging=None, verbose=False):
+    '''
+     Flies a few profiles (an in-memory trajectory) through every EO cube
+     already acquired for the mission (or those of variables) and appends
+     them to its _traj file. Returns the EO values of the profiles
+     (calc_var -> array), their profile numbers and the variables that
+     could not be flown.
+    '''
+    GLIDER_DICT = read_config_file(GLIDER_CONFIG, logging=logging)
+    lon, lat, t, profile = [np.concatenate(trajectory[name]) for name in \
+                            [GLIDER_DICT['lon_var'], GLIDER_DICT['lat_var'],\
+                             GLIDER_DICT['t_var'], GLIDER_DICT['profile_var']]]
+    _, _, lon_average, _, _, lat_average, _, _, time_average, \
+      profile_average = coords_from_arrays(lon, lat, t, profile,\
+                        GLIDER_DICT, logging=logging, verbose=verbose)
+
+    eo_values = {}
+    missing = []
+    if variables is None:
+        variables = MODULE_DICT['EO_ACQUIRE']['variables'].split(',')
+    for variable in variables:
+        if not TRA_CONFIG[variable]['include']:
+            continue
+        nc_concat_file = os.path.join(EO_dir, variable + '_' +\
+                                      TRA_CONFIG[variable]['source']+'.nc')
+        if not os.path.exists(nc_concat_file):
+            missing.append(variable)
+            continue
+
+        part_file = nc_concat_file.replace('.nc','_traj_part.nc')
+        adapted_time = convert_time(time_average,\
+                                    TRA_CONFIG[variable]['t_ref'],\
+                                    TRA_CONFIG[variable]['t_base'])
+        success = fly_cube(variable, TRA_CONFIG, GLIDER_CONFIG,\
+                           MODULE_DICT, nc_concat_file, part_file,\
+                           adapted_time, time_average, lon_average,\
+                           lat_average, profile_average,\
+                           clim=TRA_CONFIG[variable]['NRT_clim'],\
+                           logging=logging, verbose=verbose)
+        if not success or not os.path.exists(part_file):
+            # typically the cube does not reach the new dive yet
+            if os.path.exists(part_file):
+                os.remove(part_file)
+            missing.append(variable)
+            continue
+
+        nc_fid = Dataset(part_file, 'r')
+        for calc_var in TRA_CONFIG[variable]['calc_vars']:
+            values = np.ma.filled(nc_fid.variables[calc_var][:].astype(float),\
+                                  np.nan)
+            values[values == -9999] = np.nan
+            eo_values[calc_var] = values
+        nc_fid.close()
+        append_netcdf_traj(part_file, nc_concat_file.replace('.nc','_traj.nc'),\
+                           GLIDER_DICT['profile_var'])
+
+    return eo_values, profile_average, missing
+
+def hemsley_stats_file(EO_dir, glider_tag):
+    '''
+     Persisted Hemsley regression statistics of a glider mission
+    '''
+    return os.path.join(EO_dir, glider_tag+'_hemsley_stats.npz')
+
+# preproc_state of a day profile waiting for its mission to have a
+# Hemsley regression
+HEMSLEY_PENDING = 'hemsley pending'
+
+def hemsley_profile(preproc_file, GLIDER_CONFIG, stats_file, is_no_DCM_night,\
+                    is_day, logging=None, verbose=False):
+    '''
+     Streams one preprocessed profile through the mission Hemsley
+     regression: a night profile without DCM joins the statistics in
+     stats_file and a day profile is corrected by them. Returns
+     HEMSLEY_PENDING for a day profile while the mission has no regression
+     yet (see correct_hemsley_pending), else None.
+    '''
+    chl_var = fcorr.hemsley_chl_var(GLIDER_CONFIG, logging=logging)
+    if is_no_DCM_night:
+        fcorr.hemsley_add_files(stats_file, [preproc_file], chl_var)
+    if not is_day:
+        return None
+
+    regression = fcorr.hemsley_file_regression(stats_file)
+    if regression is None:
+        return HEMSLEY_PENDING
+    _, corrected = fcorr.hemsley_correct_file((preproc_file, chl_var,\
+                                               regression[0], regression[1]))
+    if not corrected:
+        db.shout(f"Failed Hemsley correction of {preproc_file}",\
+                 logging=logging, verbose=verbose)
+    return None
+
+def correct_hemsley_pending(GLIDER_CONFIG, stats_file, preproc_files,\
+                            n_workers=4, logging=None, verbose=False):
+    '''
+     Corrects the day profiles left HEMSLEY_PENDING once the mission has a
+     Hemsley regression. Returns the files corrected, none while there is
+     still no regression.
+    '''
+    regression = fcorr.hemsley_file_regression(stats_file)
+    if regression is None or not preproc_files:
+        return []
+    results = fcorr.hemsley_correct_files(preproc_files,\
+                  fcorr.hemsley_chl_var(GLIDER_CONFIG, logging=logging),\
+                  regression[0], regression[1], n_workers=n_workers)
+    corrected = []
+    for preproc_file, success in results:
+        if success:
+            corrected.append(preproc_file)
+        else:
+            db.shout(f"Failed Hemsley correction of {preproc_file}",\
+                     logging=logging, verbose=verbose)
+    db.shout(f"Hemsley corrected {len(corrected)} profiles preprocessed "\
+             "before the mission regression", logging=logging,\
+             verbose=verbose)
+    return corrected
+
+def plot_hemsley_regressions(EO_root, plot_dir, logging=None, verbose=False):
+    '''
+     Plots the Hemsley regression of every mission with statistics under
+     EO_root to plot_dir
+    '''
+    for stats_file in sorted(glob.glob(os.path.join(EO_root, '*',\
+                                                    '*_hemsley_stats.npz'))):
+        stats = fcorr.read_hemsley_stats(stats_file)
+        regression = fcorr.hemsley_regression(stats)
+        if regression is None:
+            continue
+        fcorr.plot_hemsley_regression(stats, regression,\
+            os.path.basename(stats_file).replace('_hemsley_stats.npz', ''),\
+            plot_dir, logging=logging, verbose=verbose)
+
+def preprocess_profile(staged_file, preproc_file, GLIDER_CONFIG, eo_values,\
+                       last_MLD=np.nan, last_ZEU=np.nan, hydro_file=None,\
+                       stats_file=None, logging=None, verbose=False):
+    '''
+     Copies a staged profile to preproc_file and preprocesses it with its
+     EO values (calc_var -> value) and, if hydro_file holds it, its slice
+     of the mission hydrography. With Hemsley quenching and a stats_file
+     (see hemsley_stats_file), the profile goes through hemsley_profile.
+     Returns success, the MLD/ZEU to carry to the next dive and the
+     preproc_state of the profile (HEMSLEY_PENDING or None).
+    '''
+    if not os.path.exists(os.path.dirname(preproc_file)):
+        os.makedirs(os.path.dirname(preproc_file), exist_ok=True)
+    shutil.copy(staged_file, preproc_file)
+
+    hydro = None
+    if hydro_file and os.path.exists(hydro_file):
+        try:
+            hydro = read_mission_hydrography(hydro_file,\
+                                             get_profile_number(staged_file))
+        except:
+            db.shout(f"Failed to read {hydro_file}; deriving the hydrography"\
+                     f" of {staged_file} on its own", logging=logging,\
+                     verbose=verbose)
+
+    try:
+        results = preprocess_dive(preproc_file, GLIDER_CONFIG,\
+                      eo_values.get('PAR', np.nan),\
+                      eo_values.get('KD490', np.nan),\
+                      eo_values.get('CHL', np.nan), np.nan,\
+                      eo_values.get('WSPD', np.nan), last_MLD, last_ZEU,\
+                      logging=logging, verbose=verbose, hydro=hydro)
+    except:
+        db.shout(f"Failed to preprocess {preproc_file}", logging=logging,\
+                 verbose=verbose)
+        os.remove(preproc_file)
+        return False, last_MLD, last_ZEU, None
+
+    success, is_night, is_day, _, _, is_no_DCM_night, _, _, \
+      quench_method_used, _, _ = results
+    state = None
+    if success and stats_file and 'Hemsley' in quench_method_used.split(','):
+        try:
+            state = hemsley_profile(preproc_file, GLIDER_CONFIG, stats_file,\
+                                    is_no_DCM_night, is_day, logging=logging,\
+                                    verbose=verbose)
+        except:
+            db.shout(f"Failed Hemsley correction of {preproc_file}",\
+                     logging=logging, verbose=verbose)
+
+    return success, results[-2], results[-1], state
 
 def glider_average_values(concat_file, GLIDER_CONFIG, COORDS_LIST,\
                           logging=None, verbose=False, use_backups=False):
@@ -709,6 +1467,7 @@ def convert_time(surf_time,T0,tstep):
                 adapted_time[ii] = adapted_time[ii]/3600
     return adapted_time
 
+@mt.spanned('cube_flight', target='variable')
 def fly_cube(variable, TRA_CONFIG, GLIDER_CONFIG, MODULE_DICT, nc_concat_file,\
              nc_outfile, adapted_time, t_ave, lon_ave, lat_ave, prof_ave, \
              clim=False, logging=None, verbose=False):
@@ -898,7 +1657,7 @@ def fly_cube(variable, TRA_CONFIG, GLIDER_CONFIG, MODULE_DICT, nc_concat_file,\
                           np.isfinite(lat_year[tt]) &\
                           np.isfinite(lon_year[tt]):
                             interp_var_year[tt] = fn([adapted_time_year[tt],\
-                                                  lat_year[tt],lon_year[tt]])
+                                                  lat_year[tt],lon_year[tt]])[0]
 
                     interp_var_year[np.isnan(interp_var_year)]=float(-9999)
                     interp_var.append(interp_var_year)
@@ -919,7 +1678,7 @@ def fly_cube(variable, TRA_CONFIG, GLIDER_CONFIG, MODULE_DICT, nc_concat_file,\
                       np.isfinite(lat_ave[tt]) & \
                       np.isfinite(lon_ave[tt]):
                         interp_var[tt] = fn([adapted_time[tt],\
-                                         lat_ave[tt],lon_ave[tt]])
+                                         lat_ave[tt],lon_ave[tt]])[0]
 
                         if 'PAR' in variable:
                             # special condition to derive PAR from daily average
@@ -971,8 +1730,217 @@ def fly_cube(variable, TRA_CONFIG, GLIDER_CONFIG, MODULE_DICT, nc_concat_file,\
 
     return success
 
+def fill_by_time(TIME, var):
+    '''
+     Linearly fills the gaps in var against TIME (np.interp; ends are held).
+    '''
+    ok = np.isfinite(TIME) & np.isfinite(var)
+    if not np.any(ok):
+        return var.copy()
+    order = np.argsort(TIME[ok])
+    return np.interp(TIME, TIME[ok][order], var[ok][order])
+
+def derive_hydrography(TIME, PRES, LATITUDE, LONGITUDE, profile_index,\
+                       TEMP=None, CNDC=None, SAL=None):
+    '''
+     Gap fills position and pressure against time and derives depth,
+     absolute salinity and conservative temperature for a whole record in
+     one vectorised pass, with per-record positions. Pressure from profiles
+     (profile_index) peaking under 10 is taken as bar and made decibar.
+    '''
+    hydro = {}
+    hydro['LATITUDE_CORRECTED'] = fill_by_time(TIME, LATITUDE)
+    hydro['LONGITUDE_CORRECTED'] = fill_by_time(TIME, LONGITUDE)
+
+    # BODC mess up with bar -> decibar
+    PRES_int = fill_by_time(TIME, PRES)
+    prof_max = np.full(np.max(profile_index)+1, -np.inf)
+    np.fmax.at(prof_max, profile_index, PRES)
+    CORR_PRES = np.where(prof_max[profile_index] < 10, PRES_int*10, PRES_int)
+    hydro['PRES_CORRECTED'] = CORR_PRES
+
+    CORR_DEPTH = gsw.z_from_p(CORR_PRES, hydro['LATITUDE_CORRECTED'])*-1
+    CORR_DEPTH[CORR_DEPTH<0] = 0.0
+    hydro['DEPTH_CORRECTED'] = CORR_DEPTH
+
+    # calculate absolute salinity
+    ASAL = None
+    if CNDC is not None and TEMP is not None:
+        # convert from mhos/m to mS/cm
+        PSAL = gsw.SP_from_C(CNDC * 1000 / 100, TEMP, CORR_PRES)
+        ASAL = gsw.SA_from_SP(PSAL, CORR_PRES, hydro['LONGITUDE_CORRECTED'],\
+                              hydro['LATITUDE_CORRECTED'])
+    elif SAL is not None:
+        ASAL = gsw.SA_from_SP(SAL, CORR_PRES, hydro['LONGITUDE_CORRECTED'],\
+                              hydro['LATITUDE_CORRECTED'])
+    if ASAL is not None:
+        hydro['ABSOLUTE_SALINITY'] = ASAL
+
+        # calculate conservative temperature
+        if TEMP is not None:
+            hydro['CONSERVATIVE_TEMPERATURE'] = gsw.CT_from_t(ASAL, TEMP,\
+                                                              CORR_PRES)
+
+    return hydro
+
+def write_mission_hydrography(nc_files, GLIDER_CONFIG, hydro_file,\
+                              append=False, logging=None, verbose=False):
+    '''
+     Mission-level TEOS-10 stage: reads time, position, pressure and the
+     temperature/salinity inputs of every staged profile, derives the
+     corrected hydrography for the concatenated record in one pass and
+     stores it in hydro_file for the per-profile stages to read back with
+     read_mission_hydrography. With append=True the profiles of nc_files
+     (gap filled among themselves) are added to an existing hydro_file.
+    '''
+    CONFIG_DICT = read_config_file(GLIDER_CONFIG,logging=logging)
+    limits = {'TIME': (-np.inf, 1e20), 'PRES': (-1e5, 1e5),\
+              'LATITUDE': (-90, 90), 'LONGITUDE': (-360, 360),\
+              'TEMP': (0.0, 1e5), 'CNDC': (0.0, 1e5), 'SAL': (0.0, 1e5)}
+
+    record = dict((head, []) for head in limits)
+    found = set()
+    profile_numbers = []
+    counts = []
+    for nc_file in nc_files:
+        try:
+            nc_fid = Dataset(nc_file,'r')
+            var_plan = dict(variable_mapping_plan(CONFIG_DICT,\
+                            list(nc_fid.variables.keys()))[0])
+            if 'TIME' not in var_plan and 'time' in var_plan:
+                var_plan['TIME'] = var_plan['time']
+            rec_len = len(nc_fid.variables[var_plan['TIME']])
+            data = {}
+            for head in limits:
+                if head in var_plan:
+                    var = np.ma.filled(np.ma.asarray(\
+                          nc_fid.variables[var_plan[head]][:]).astype(float),\
+                          np.nan)
+                    var[(var > limits[head][1]) | (var < limits[head][0])] = np.nan
+                    data[head] = var
+                    found.add(head)
+                else:
+                    data[head] = np.ones(rec_len)*np.nan
+            nc_fid.close()
+        except:
+            db.shout('*** FAILURE reading '+nc_file, logging=logging,\
+                     verbose=verbose, level='error')
+            continue
+
+        try:
+            profile_numbers.append(get_profile_number(nc_file))
+        except:
+            db.shout('*** No profile number in '+nc_file, logging=logging,\
+                     verbose=verbose, level='error')
+            continue
+        for head in limits:
+            record[head].append(data[head])
+        counts.append(rec_len)
+
+    if not counts:
+        return False
+
+    record = dict((head, np.concatenate(record[head])) for head in record)
+    profile_index = np.repeat(np.arange(len(counts)), counts)
+    hydro = derive_hydrography(record['TIME'], record['PRES'],\
+                               record['LATITUDE'], record['LONGITUDE'],\
+                               profile_index,\
+                               TEMP=record['TEMP'] if 'TEMP' in found else None,\
+                               CNDC=record['CNDC'] if 'CNDC' in found else None,\
+                               SAL=record['SAL'] if 'SAL' in found else None)
+
+    hydro['TIME'] = record['TIME']
+    profile_vars = {'PROFILE_NUMBER': np.asarray(profile_numbers),\
+                    'RECORD_START': np.cumsum(counts) - np.asarray(counts),\
+                    'RECORD_COUNT': np.asarray(counts)}
+
+    if append and os.path.exists(hydro_file):
+        # later rows of a profile number supersede earlier ones
+        hydro_fid = Dataset(hydro_file, 'a')
+        start = len(hydro_fid.dimensions['record'])
+        first = len(hydro_fid.dimensions['profile'])
+        profile_vars['RECORD_START'] = profile_vars['RECORD_START'] + start
+        for name, vals in profile_vars.items():
+            hydro_fid.variables[name][first:first+len(counts)] = vals
+        for name, vals in hydro.items():
+            if name in hydro_fid.variables:
+                hydro_fid.variables[name][start:start+len(vals)] = vals
+        hydro_fid.close()
+    else:
+        if os.path.exists(hydro_file):
+            os.remove(hydro_file)
+        hydro_fid = Dataset(hydro_file, 'w', format='NETCDF4')
+        hydro_fid.createDimension('record', None)
+        hydro_fid.createDimension('profile', None)
+        for name, vals in profile_vars.items():
+            ncvar = hydro_fid.createVariable(name, 'i4', ('profile',))
+            ncvar[:] = vals.astype(int)
+        for name, vals in hydro.items():
+            ncvar = hydro_fid.createVariable(name, 'f8', ('record',), zlib=True,\
+                                             fill_value=np.nan)
+            ncvar[:] = vals
+        hydro_fid.close()
+        permit(hydro_file)
+
+    db.shout('Derived hydrography for '+str(len(counts))+' profiles into '+\
+             hydro_file, logging=logging, verbose=verbose)
+
+    return True
+
+def read_mission_hydrography(hydro_file, prof_number):
+    '''
+     Returns the write_mission_hydrography record of one profile as a dict
+     of arrays, or None if the profile is not in hydro_file.
+    '''
+    hydro_fid = Dataset(hydro_file, 'r')
+    ii = np.flatnonzero(hydro_fid.variables['PROFILE_NUMBER'][:] == prof_number)
+    if len(ii) == 0:
+        hydro_fid.close()
+        return None
+    start = int(hydro_fid.variables['RECORD_START'][ii[-1]])
+    stop = start + int(hydro_fid.variables['RECORD_COUNT'][ii[-1]])
+    hydro = {}
+    for name, ncvar in hydro_fid.variables.items():
+        if ncvar.dimensions == ('record',):
+            hydro[name] = np.ma.filled(ncvar[start:stop].astype(float), np.nan)
+    hydro_fid.close()
+    return hydro
+
+# variable mapping plans by config lists and file variable names
+MAPPING_PLANS = {}
+
+def variable_mapping_plan(CONFIG_DICT, nc_vars):
+    '''
+     Resolves each allowed head (TEMP, PRES, CHLA, ...) of a glider config to
+     the file variable it is read from, as the last variable in nc_vars to
+     match it (exactly or by substring, per allowed_exact). Returns the
+     head -> variable plan and the heads left unmatched. Plans are cached,
+     so files sharing a schema are only matched once.
+    '''
+    key = (CONFIG_DICT.allowed_vars, CONFIG_DICT.allowed_exact,\
+           CONFIG_DICT.allowed_heads, tuple(nc_vars))
+    if key in MAPPING_PLANS:
+        return MAPPING_PLANS[key]
+
+    var_plan = {}
+    for varname in nc_vars:
+        for allowed, exact, head in zip(CONFIG_DICT.allowed_vars,\
+                                        CONFIG_DICT.allowed_exact,\
+                                        CONFIG_DICT.allowed_heads):
+            if (exact == 0 and allowed in varname) or allowed == varname:
+                var_plan[head] = varname
+
+    miss_heads = [head for head in CONFIG_DICT.allowed_heads \
+                  if head not in var_plan]
+
+    MAPPING_PLANS[key] = (var_plan, miss_heads)
+
+    return var_plan, miss_heads
+
+@mt.spanned('preproc', target='nc_file')
 def preprocess_dive(nc_file, GLIDER_CONFIG, traj_PAR, traj_KD490, traj_CHLA, glider_bathy, traj_WSPD,\
-                    last_MLD, last_ZEU, logging=logging, verbose=False, correct_time=True):
+                    last_MLD, last_ZEU, logging=logging, verbose=False, correct_time=True,\
+                    hydro=None):
 
     print('Preprocessing')
 
@@ -1000,48 +1968,29 @@ def preprocess_dive(nc_file, GLIDER_CONFIG, traj_PAR, traj_KD490, traj_CHLA, gli
     CONFIG_DICT = read_config_file(GLIDER_CONFIG,logging=logging)
    
     quench_method_used = 'None'
-    use_Xing = False
-    use_Biermann = False
-    use_Swart = False
     use_Hemsley = False
 
-    if 'Xing' in CONFIG_DICT['quench_methods'].split(','):
-        use_Xing = True
-    if 'Biermann' in CONFIG_DICT['quench_methods'].split(','):
-        use_Biermann = True
-    if 'Swart' in CONFIG_DICT['quench_methods'].split(','):
-        use_Swart = True
-    if 'Hemsley' in CONFIG_DICT['quench_methods'].split(','):
+    if 'Hemsley' in CONFIG_DICT.quench_methods:
         use_Hemsley = True
 
     # -get the variable names for comparison to config list
     nc_fid  = Dataset(nc_file, 'r')
-    nc_vars = list(data_fid.variables.keys())
+    nc_vars = list(nc_fid.variables.keys())
+
+    # REMOVE
+    # Dolomite has empty PAR record, but variable is there...
+    if 'Dolomite_499_' in nc_file and any(['_PAR' in varname for varname in nc_vars]):
+        print('PAR variable is empty....skipping')
+        nc_vars = [varname for varname in nc_vars if '_PAR' not in varname]
 
     # -get the vars-----------------------------------------------------------
+    # not all variables, esp. scatterings, present in each file
+    var_plan, miss_heads = variable_mapping_plan(CONFIG_DICT, nc_vars)
     var_dict = {}
-    for varname in nc_vars:
-        # REMOVE
-        # Dolomite has empty PAR record, but variable is there...
-        if 'Dolomite_499_' in nc_file and '_PAR' in varname:
-            print('PAR variable is empty....skipping')
-            continue
-        # not all variables, esp. scatterings, present in each file
-        for ii in np.arange(len(CONFIG_DICT['allowed_vars'].split(','))):
-            if int(CONFIG_DICT['allowed_exact'].split(',')[ii]) == 0:
-                if CONFIG_DICT['allowed_vars'].split(',')[ii] in varname:
-                    if verbose:
-                        print('Found: '+varname)
-                    # re-write using library...
-                    storename = CONFIG_DICT['allowed_heads'].split(',')[ii]
-                    var_dict[storename] = nc_fid.variables[varname][:]
-            else:
-                if CONFIG_DICT['allowed_vars'].split(',')[ii] == varname:
-                    if verbose:
-                        print('Found: '+varname)
-                    # re-write using library...
-                    storename = CONFIG_DICT['allowed_heads'].split(',')[ii]
-                    var_dict[storename] = nc_fid.variables[varname][:]
+    for storename, varname in var_plan.items():
+        if verbose:
+            print('Found: '+varname)
+        var_dict[storename] = nc_fid.variables[varname][:]
     nc_fid.close()
 
     if 'TIME' not in var_dict.keys() and 'time' in var_dict.keys():
@@ -1050,13 +1999,10 @@ def preprocess_dive(nc_file, GLIDER_CONFIG, traj_PAR, traj_KD490, traj_CHLA, gli
     tref = CONFIG_DICT['t_ref']
 
     # check for missing vars
-    miss_vars = np.ones(len(CONFIG_DICT['allowed_heads'].split(',')))
-    for ii in np.arange(len(CONFIG_DICT['allowed_heads'].split(','))):
-        if CONFIG_DICT['allowed_heads'].split(',')[ii] not in var_dict.keys():          
-            print('Missing: ' + CONFIG_DICT['allowed_heads'].split(',')[ii])
-            miss_vars[ii] = 0.0
+    for storename in miss_heads:
+        print('Missing: ' + storename)
 
-    if sum(miss_vars) == len(miss_vars):
+    if not miss_heads:
         if verbose:
             print('All required variables present')
 
@@ -1090,85 +2036,101 @@ def preprocess_dive(nc_file, GLIDER_CONFIG, traj_PAR, traj_KD490, traj_CHLA, gli
     if 'LONGITUDE' in var_dict.keys():
         LONGITUDE = ct.check_remask_var(var_dict['LONGITUDE'],-360,360)
 
-    # correct LAT:
-    if 'LATITUDE' in var_dict.keys():
-        CORR_LATITUDE = LATITUDE.copy()
-        CORR_BLANK = np.ones(np.shape(LATITUDE))*np.nan
-        try:
-            print('Interpolating latitude')
-            fn = interp1d(TIME[np.isfinite(LATITUDE)],LATITUDE[np.isfinite(LATITUDE)],\
-                 fill_value="extrapolate")
-            CORR_LATITUDE = fn(TIME)
-        except:
-            pass
+    if hydro is not None and len(hydro['DEPTH_CORRECTED']) != len(TIME):
+        print('Mission hydrography does not match the profile; deriving it here')
+        hydro = None
 
-    # correct LON:
-    if 'LONGITUDE' in var_dict.keys():
-        CORR_BLANK = np.ones(np.shape(LONGITUDE))*np.nan
-        CORR_LONGITUDE = LONGITUDE.copy()
-        try:
-            print('Interpolating longitude')
-            fn = interp1d(TIME[np.isfinite(LONGITUDE)],LONGITUDE[np.isfinite(LONGITUDE)],\
-                 fill_value="extrapolate")
-            CORR_LONGITUDE = fn(TIME)
-        except:
-            pass
+    if hydro is None:
+        # correct LAT:
+        if 'LATITUDE' in var_dict.keys():
+            CORR_LATITUDE = LATITUDE.copy()
+            CORR_BLANK = np.ones(np.shape(LATITUDE))*np.nan
+            try:
+                print('Interpolating latitude')
+                fn = interp1d(TIME[np.isfinite(LATITUDE)],LATITUDE[np.isfinite(LATITUDE)],\
+                     fill_value="extrapolate")
+                CORR_LATITUDE = fn(TIME)
+            except:
+                pass
+
+        # correct LON:
+        if 'LONGITUDE' in var_dict.keys():
+            CORR_BLANK = np.ones(np.shape(LONGITUDE))*np.nan
+            CORR_LONGITUDE = LONGITUDE.copy()
+            try:
+                print('Interpolating longitude')
+                fn = interp1d(TIME[np.isfinite(LONGITUDE)],LONGITUDE[np.isfinite(LONGITUDE)],\
+                     fill_value="extrapolate")
+                CORR_LONGITUDE = fn(TIME)
+            except:
+                pass
     
-    # correct PRES & DEPTH:
-    if 'PRES' in var_dict.keys():
-        CORR_PRES = PRES.copy()
-        CORR_DEPTH = PRES.copy()
-        try:
-            print('Interpolating pressure & depth')
-            fn = interp1d(TIME[np.isfinite(PRES)],PRES[np.isfinite(PRES)],\
-                 fill_value="extrapolate")
-            PRES_int = fn(TIME)
-            if np.nanmax(PRES) < 10:
-                print('Correcting pressure')
-                CORR_PRES = PRES_int*10 # BODC mess up with bar -> decibar
-            else:
-                CORR_PRES = PRES_int.copy()
-            DEPTH = gsw.z_from_p(CORR_PRES,np.nanmean(CORR_LATITUDE))       
-            CORR_DEPTH = DEPTH*-1
-        except:
-            pass
+        # correct PRES & DEPTH:
+        if 'PRES' in var_dict.keys():
+            CORR_PRES = PRES.copy()
+            CORR_DEPTH = PRES.copy()
+            try:
+                print('Interpolating pressure & depth')
+                fn = interp1d(TIME[np.isfinite(PRES)],PRES[np.isfinite(PRES)],\
+                     fill_value="extrapolate")
+                PRES_int = fn(TIME)
+                if np.nanmax(PRES) < 10:
+                    print('Correcting pressure')
+                    CORR_PRES = PRES_int*10 # BODC mess up with bar -> decibar
+                else:
+                    CORR_PRES = PRES_int.copy()
+                DEPTH = gsw.z_from_p(CORR_PRES,np.nanmean(CORR_LATITUDE))       
+                CORR_DEPTH = DEPTH*-1
+            except:
+                pass
 
-    CORR_DEPTH[CORR_DEPTH<0] = 0.0
+        CORR_DEPTH[CORR_DEPTH<0] = 0.0
 
-    glider_HOUR = (datetime.datetime.strptime(CONFIG_DICT['t_ref'],'%Y-%m-%d %H:%M:%S') \
-                      + datetime.timedelta(seconds=int(np.nanmean(TIME)))).hour
+        # calculate absolute salinity
 
-    # calculate absolute salinity
+        if 'CNDC' in locals() and 'TEMP' in locals() and 'CORR_PRES' in locals():
+            ASAL = CNDC.copy()
+            try:
+                # convert from mhos/m to mS/cm
+                CNDC = CNDC * 1000 / 100
+                PSAL = gsw.SP_from_C(CNDC,TEMP,CORR_PRES)
+                ASAL = gsw.SA_from_SP(PSAL,CORR_PRES,np.nanmean(CORR_LONGITUDE),np.nanmean(CORR_LATITUDE))
+                print('Calculated ASAL')
+            except:
+                pass
 
-    if 'CNDC' in locals() and 'TEMP' in locals() and 'CORR_PRES' in locals():
-        ASAL = CNDC.copy()
-        try:
-            # convert from mhos/m to mS/cm
-            CNDC = CNDC * 1000 / 100
-            PSAL = gsw.SP_from_C(CNDC,TEMP,CORR_PRES)
-            ASAL = gsw.SA_from_SP(PSAL,CORR_PRES,np.nanmean(CORR_LONGITUDE),np.nanmean(CORR_LATITUDE))
-            print('Calculated ASAL')
-        except:
-            pass
+        elif 'SAL' in locals() and 'CORR_PRES' in locals():
+            ASAL = SAL.copy()
+            try:
+                ASAL = gsw.SA_from_SP(SAL,CORR_PRES,np.nanmean(CORR_LONGITUDE),np.nanmean(CORR_LATITUDE))
+                print('Calculated ASAL')
+            except:
+                pass
 
-    elif 'SAL' in locals() and 'CORR_PRES' in locals():
-        ASAL = SAL.copy()
-        try:
-            ASAL = gsw.SA_from_SP(SAL,CORR_PRES,np.nanmean(CORR_LONGITUDE),np.nanmean(CORR_LATITUDE))
-            print('Calculated ASAL')
-        except:
+        # calculate conservative temperature
+        if 'CTEMP' in locals():
             pass
+        elif 'TEMP' in locals() and 'CORR_PRES' in locals() and 'ASAL' in locals():
+            CTEMP = TEMP.copy()
+            try:
+                CTEMP = gsw.CT_from_t(ASAL,TEMP,CORR_PRES)
+                print('Calculated CTEMP')
+            except:
+                pass
+    else:
+        # mission-level hydrography (write_mission_hydrography)
+        CORR_LATITUDE = hydro['LATITUDE_CORRECTED']
+        CORR_LONGITUDE = hydro['LONGITUDE_CORRECTED']
+        CORR_PRES = hydro['PRES_CORRECTED']
+        CORR_DEPTH = hydro['DEPTH_CORRECTED']
+        CORR_BLANK = np.ones(np.shape(CORR_DEPTH))*np.nan
+        if 'ABSOLUTE_SALINITY' in hydro:
+            ASAL = hydro['ABSOLUTE_SALINITY']
+        if 'CONSERVATIVE_TEMPERATURE' in hydro and 'CTEMP' not in var_dict.keys():
+            CTEMP = hydro['CONSERVATIVE_TEMPERATURE']
 
-    # calculate conservative temperature
-    if 'CTEMP' in locals():
-        pass
-    elif 'TEMP' in locals() and 'CORR_PRES' in locals() and 'ASAL' in locals():
-        CTEMP = TEMP.copy()
-        try:
-            CTEMP = gsw.CT_from_t(ASAL,TEMP,CORR_PRES)
-            print('Calculated CTEMP')
-        except:
-            pass
+    glider_HOUR = (datetime.datetime.strptime(CONFIG_DICT['t_ref'],'%Y-%m-%d %H:%M:%S') \
+                      + datetime.timedelta(seconds=int(np.nanmean(TIME)))).hour
 
     # calculate MLD
     MLD = np.nan
@@ -1203,7 +2165,7 @@ def preprocess_dive(nc_file, GLIDER_CONFIG, traj_PAR, traj_KD490, traj_CHLA, gli
         if 'PAR' in locals():
             use_insitu_par = True
             # convert to W/m2
-            PAR = PAR*float(CONFIG_DICT['PAR_conversion'])
+            PAR = PAR*CONFIG_DICT.PAR_conversion
 
             dd = np.where((CORR_DEPTH> 50.0))
             try:
@@ -1211,7 +2173,7 @@ def preprocess_dive(nc_file, GLIDER_CONFIG, traj_PAR, traj_KD490, traj_CHLA, gli
             except:
                 pass
 
-        if int(CONFIG_DICT['force_use_EO_par'])==1:
+        if CONFIG_DICT.force_use_EO_par==1:
             print('Forcing to use EO PAR')
             use_insitu_par = False
 
@@ -1279,7 +2241,7 @@ def preprocess_dive(nc_file, GLIDER_CONFIG, traj_PAR, traj_KD490, traj_CHLA, gli
             # get above surface (E0) irradiance: Hemsley et al., 2015
             E_0_plus = E_0_minus
             try:
-                E_0_plus = ct.get_E0(E_0_minus,r_tot)[0]
+                E_0_plus = ct.get_E0(E_0_minus,r_tot)
             except:
                 pass
 
@@ -1418,48 +2380,31 @@ def preprocess_dive(nc_file, GLIDER_CONFIG, traj_PAR, traj_KD490, traj_CHLA, gli
     CORR_CHLA[CORR_CHLA <= 0.0] = 0.0
     CORR_SCATTER[CORR_SCATTER <= 0.0] = 0.0    
 
-    if use_Xing:
-        if 'CHLA' in var_dict.keys() and 'CORR_DEPTH' in var_dict.keys():
-            print('Correcting CHLA with Xing quenching')
-            #  Xing et al., 2012:
-            if is_day:
-                print('Daytime correcting...')
-                CORR_CHLA, method_success = fcorr.fluor_correction_Xin(PROFILE_NUMBER,TIME,\
-                                    CORR_CHLA,MLD,CORR_DEPTH,verbose=True,\
-                                    logging=logging,debug=debug)
-            else:
-                print('Nighttime; no correction')
-                method_success = True  
-            quench_method_used = 'Xing'
-
-    if use_Biermann:
-        if 'CHLA' in var_dict.keys() and 'CORR_DEPTH' in var_dict.keys():
-            print('Correcting CHLA with Biermann quenching')
-            #  Biermann et al., 2015:
-            if is_day:
-                print('Daytime correcting...')
-                CORR_CHLA, method_success = fcorr.fluor_correction_Bie(PROFILE_NUMBER,TIME,\
-                                    CORR_CHLA,ZEU,CORR_DEPTH,verbose=True,\
-                                    logging=logging,debug=debug)
-            else:
-                print('Nighttime; no correction')
-                method_success = True
-            quench_method_used = 'Biermann'
-
-    if use_Swart:
-        if 'CHLA' in var_dict.keys() and 'SCATTER' in var_dict.keys() \
-          and 'DEPTH' in var_dict.keys():
-            print('Correcting CHLA with Swart quenching')        
-            #  Swart et al., 2015:
-            if is_day:
-                 print('Daytime correcting...')
-                 CORR_CHLA, method_success = fcorr.fluor_correction_Swa(PROFILE_NUMBER,TIME,\
-                                      CORR_CHLA,ZEU,CORR_DEPTH,CORR_SCATTER,verbose=True,\
-                                      logging=logging,debug=debug)
-            else:
-                print('Nighttime; no correction')
-                method_success = True
-            quench_method_used = 'Swart'
+    # profile-level quenching methods are applied together so they share
+    # masks and maxima; each is written out as its own variable
+    quench_methods = []
+    if 'CHLA' in var_dict.keys():
+        quench_methods = [method for method in fcorr.QUENCH_METHODS \
+                          if method in CONFIG_DICT.quench_methods]
+        if 'SCATTER' not in var_dict.keys() and 'Swart' in quench_methods:
+            quench_methods.remove('Swart')
+
+    quench_results = {}
+    if quench_methods:
+        print('Correcting CHLA with quenching methods: '+', '.join(quench_methods))
+        if is_day:
+            print('Daytime correcting...')
+            quench_results = fcorr.quench_corrections(quench_methods,\
+                                 CORR_CHLA,CORR_DEPTH,MLD=MLD,ZEU=ZEU,\
+                                 SCATTER=CORR_SCATTER,verbose=True,\
+                                 logging=logging)
+        else:
+            print('Nighttime; no correction')
+            for method in quench_methods:
+                quench_results[method] = (CORR_CHLA.copy(), True)
+        # Xing, Biermann, Swart precedence is kept for CHLA_CORRECTED
+        CORR_CHLA = quench_results[quench_methods[-1]][0]
+        quench_method_used = ','.join(quench_methods)
 
     if use_Hemsley:
         if 'CHLA' in var_dict.keys() and 'SCATTER' in var_dict.keys() \
@@ -1471,7 +2416,10 @@ def preprocess_dive(nc_file, GLIDER_CONFIG, traj_PAR, traj_KD490, traj_CHLA, gli
               np.nanmean(CORR_LATITUDE),np.nanmean(CORR_LONGITUDE),\
               CORR_DEPTH,glider_bathy,CORR_CHLA,CORR_PAR,\
               correct_time=correct_time,to_UTC=0)
-            quench_method_used = 'Hemsley'
+            if quench_methods:
+                quench_method_used = quench_method_used+',Hemsley'
+            else:
+                quench_method_used = 'Hemsley'
 
     print('Writing out corrected data to: ' + nc_file)
     nct.write_corrected_to_file(nc_file,CORR_LATITUDE,'LATITUDE_CORRECTED','TIME')
@@ -1490,6 +2438,9 @@ def preprocess_dive(nc_file, GLIDER_CONFIG, traj_PAR, traj_KD490, traj_CHLA, gli
     nct.write_corrected_to_file(nc_file,np.ones(len(TIME))*ZEU_FLAG,'EUPHOTIC_DEPTH_FLAG','TIME')
     nct.write_corrected_to_file(nc_file,np.ones(len(TIME))*PAR_FLAG,'DOWNWELLING_PAR_CORRECTED_FLAG','TIME')
     nct.write_corrected_to_file(nc_file,CORR_CHLA,'CHLA_CORRECTED','TIME')
+    for method in quench_methods:
+        nct.write_corrected_to_file(nc_file,quench_results[method][0],\
+                                    'CHLA_CORRECTED_'+method.upper(),'TIME')
 
     if debug:
         fig = plt.figure()
@@ -1763,22 +2714,61 @@ def write_netcdf_traj(VAR,var_name,profile_name,\
         db.shout('*** FAILURE writing output netcdf file ' + out_file, \
                  logging=logging, verbose=verbose, level='error')
 
-def define_concat_file(concat_file, nfiles, GLIDER_CONFIG,\
-                       logging=None, verbose=False):
+def append_netcdf_traj(part_file, out_file, profile_name):
+    '''
+     Appends the profiles of a fly_cube output to an existing one (or
+     makes it the output)
+    '''
+    if not os.path.exists(out_file):
+        os.replace(part_file, out_file)
+        return
+
+    old_fid = Dataset(out_file, 'r')
+    part_fid = Dataset(part_file, 'r')
+    old_fid.set_auto_mask(False)
+    part_fid.set_auto_mask(False)
+
+    names = [name for name in part_fid.variables \
+             if name in old_fid.variables]
+    tmp_file = out_file+'.tmp'
+    nc_file = Dataset(tmp_file, 'w', format='NETCDF4_CLASSIC')
+    nc_file.createDimension(profile_name, \
+                            len(old_fid.dimensions[profile_name]) + \
+                            len(part_fid.dimensions[profile_name]))
+    for name in names:
+        varin = part_fid.variables[name]
+        attrs = dict((k, varin.getncattr(k)) for k in varin.ncattrs())
+        ncvar = nc_file.createVariable(name, varin.datatype, (profile_name),\
+                                       fill_value=attrs.pop('_FillValue', None))
+        ncvar.set_auto_mask(False)
+        ncvar[:] = np.concatenate((old_fid.variables[name][:], varin[:]))
+    nc_file.close()
+    old_fid.close()
+    part_fid.close()
+
+    os.replace(tmp_file, out_file)
+    os.chmod(out_file, 0o777)
+    os.remove(part_file)
 
+def define_concat_file(concat_file, nfiles, GLIDER_CONFIG,\
+                       logging=None, verbose=False, complevel=4):
+    '''
+     Defines the (profile x depth) binned mission file. Variables are
+     compressed and chunked in tiles spanning many profiles and part of the
+     depth grid, so that both single profiles and single depth levels across
+     the mission can be read without touching the whole file.
+    '''
     success = True
     # read processing config file
     CONFIG_DICT = read_config_file(GLIDER_CONFIG,logging=logging)
 
-    interp_bins = np.arange(float(CONFIG_DICT['depth_min']),\
-                            float(CONFIG_DICT['depth_max'])+\
-                            float(CONFIG_DICT['depth_bin']),\
-                            float(CONFIG_DICT['depth_bin']))
+    interp_bins = CONFIG_DICT.depth_edges
 
     interp_depth = interp_bins[0:-1]
     profile_name = 'profile'
     depth_name   = 'depth'
-    allowed_vars = list(CONFIG_DICT['allowed'].split(','))
+    allowed_vars = list(CONFIG_DICT.allowed)
+    chunks       = (max(1, min(int(nfiles), 256)), min(len(interp_depth), 32))
 
     if os.path.exists(concat_file):
         os.remove(concat_file)
@@ -1794,11 +2784,15 @@ def define_concat_file(concat_file, nfiles, GLIDER_CONFIG,\
         #define variables
         for nc_var in allowed_vars:
             cv = nc_file.createVariable(nc_var,\
-                                        np.float32,(profile_name,depth_name))
+                                        np.float32,(profile_name,depth_name),\
+                                        zlib=True, complevel=complevel,\
+                                        shuffle=True, chunksizes=chunks)
 
         # make soace for profile number
         cv = nc_file.createVariable('profile_number',\
-                 np.float32,(profile_name,depth_name))
+                 np.float32,(profile_name,depth_name),\
+                 zlib=True, complevel=complevel,\
+                 shuffle=True, chunksizes=chunks)
 
         # Close the file
         nc_file.close()
@@ -1812,34 +2806,98 @@ def define_concat_file(concat_file, nfiles, GLIDER_CONFIG,\
 
     return success
 
-def fill_concat_file(concat_file, nc_file, count, GLIDER_CONFIG,\
-                       logging=None, verbose=False):
+def fill_concat_block(concat_fid, start, profile_numbers, binned_vars):
+    '''
+     Writes a block of binned profiles into an open concat file, starting at
+     profile row start. binned_vars maps variable name to (profile x depth).
+    '''
+    rows = slice(start, start + len(profile_numbers))
+    var_len = len(concat_fid.dimensions['depth'])
+    concat_fid.variables['profile_number'][rows,:] = \
+            np.repeat(np.asarray(profile_numbers)[:,None], var_len, axis=1)
+    for variable, grid in binned_vars.items():
+        concat_fid.variables[variable][rows,:] = grid
+
+def write_gridded_mission(concat_file, nc_files, GLIDER_CONFIG, block_size=500,\
+                          logging=None, verbose=False):
+    '''
+     Bins staged profile files onto the config depth grid and writes every
+     allowed variable into a single (profile x depth) file. Profiles are read,
+     binned and written in blocks of block_size, so the mission is built in
+     one streaming pass with bounded memory.
+    '''
     success = True
-    # read processing config file
     CONFIG_DICT = read_config_file(GLIDER_CONFIG,logging=logging)
-    allowed_vars = list(CONFIG_DICT['allowed'].split(','))
+
+    interp_bins = CONFIG_DICT.depth_edges
+    allowed_vars = list(CONFIG_DICT.allowed)
+
+    if not define_concat_file(concat_file, min(len(nc_files), block_size),\
+                              GLIDER_CONFIG, logging=logging, verbose=verbose):
+        return False
 
     concat_fid = Dataset(concat_file,'r+')
-    nc_fid     = Dataset(nc_file,'r')
+    start = 0
+    for ii in range(0, len(nc_files), block_size):
+        block_files = nc_files[ii:ii+block_size]
+        keys = []
+        depths = []
+        profile_numbers = []
+        block_data = dict((variable, []) for variable in allowed_vars)
+        for count, nc_file in enumerate(block_files):
+            try:
+                nc_fid = Dataset(nc_file,'r')
+                depth = np.ma.filled(nc_fid.variables[CONFIG_DICT['depth_var']]\
+                                     [:].astype(float), np.nan)
+                if len(depth) == 0:
+                    # no records, so no row: bin_mission rows follow keys
+                    nc_fid.close()
+                    db.shout('No records in '+nc_file+'; skipping',\
+                             logging=logging, verbose=verbose)
+                    continue
+                try:
+                    prof_number = np.nanmean(np.ma.filled(nc_fid.variables\
+                                  [CONFIG_DICT['profile_var']][:].astype(float),\
+                                  np.nan))
+                except:
+                    prof_number = get_profile_number(nc_file)
+
+                for variable in allowed_vars:
+                    try:
+                        data = np.ma.filled(nc_fid.variables[variable][:]\
+                                            .astype(float), np.nan)
+                        if np.shape(data) != np.shape(depth):
+                            raise ValueError(variable)
+                    except:
+                        data = depth*np.nan
+                    block_data[variable].append(data)
+                nc_fid.close()
+            except:
+                success = False
+                db.shout('*** FAILURE reading '+nc_file, logging=logging,\
+                         verbose=verbose, level='error')
+                continue
 
-    var_len = len(concat_fid.dimensions['depth'])
-    concat_fid.variables['profile_number'][count,:] = \
-                         np.ones(var_len)*nc_fid.variables['profile_number'][:]
+            keys.append(np.ones(len(depth))*count)
+            depths.append(depth)
+            profile_numbers.append(prof_number)
 
-    for variable in allowed_vars:
-        try:
-            concat_fid.variables[variable][count,:] = \
-                                       nc_fid.variables[variable][:]
-            db.shout('SUCCESS  writing '+nc_file +':'+variable+\
-                     ' profile to netcdf file ' + concat_file, \
-                     logging=logging, verbose=verbose)
-        except:
-            db.shout('*** FAILURE writing '+nc_file +':'+variable+\
-                     ' profile to netcdf file ' + concat_file, \
-                     logging=logging, verbose=verbose, level='error')
+        if not keys:
+            continue
+
+        binned = la_utils.bin_mission(np.concatenate(keys),\
+                                      np.concatenate(depths), interp_bins,\
+                                      *[np.concatenate(block_data[variable])\
+                                        for variable in allowed_vars])
+        fill_concat_block(concat_fid, start, profile_numbers,\
+                          dict(zip(allowed_vars, binned[1:])))
+        start = start + len(profile_numbers)
+        db.shout('Binned '+str(start)+' profiles into '+concat_file,\
+                 logging=logging, verbose=verbose)
 
     concat_fid.close()
-    nc_fid.close()
+    permit(concat_file)
+    return success
 
 def check_for_profile_numbers(input_file,GLIDER_CONFIG):
     profile_num_exists = False
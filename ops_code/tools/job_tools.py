@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+'''
+Purpose:    Job queue for parallel processing. Jobs (stage, target) live in
+            a table of the processing database, which is switched to WAL
+            mode; workers claim them under a lease, renew the lease while
+            they work and complete them in the same transaction that
+            updates the processing table and queues the next stage, so that
+            no two workers process the same target. A small HTTP server
+            exposes the queue to workers on other machines.
+
+License:    See LICENCE.txt
+'''
+import os, json, time
+import sqlite3
+import socket
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import database_tools as db
+
+JOB_TABLE = 'jobs'
+
+#-------------------------------------------------------------------------------
+def connect_jobs(database):
+    '''
+    Autocommit connection in WAL mode, so that readers do not block the
+    workers and transactions are opened explicitly
+    '''
+    conn = sqlite3.connect(database, timeout=60, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+def create_job_table(database):
+    '''
+    Creates the job table if the database does not have it yet.
+    job_group serialises jobs that must run in order (e.g. the dives of
+    one glider): a job is only claimed once the earlier jobs of its group
+    are finished.
+    '''
+    conn = connect_jobs(database)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {JOB_TABLE} ("
+                 "job_id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                 " stage TEXT NOT NULL, target TEXT NOT NULL, job_group TEXT,"
+                 " payload TEXT, status TEXT NOT NULL DEFAULT 'pending',"
+                 " lease_owner TEXT, lease_expiry REAL,"
+                 " attempts INTEGER NOT NULL DEFAULT 0, message TEXT,"
+                 " created REAL, updated REAL, UNIQUE(stage, target))")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {JOB_TABLE}_claim ON "
+                 f"{JOB_TABLE} (stage, status, lease_expiry)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {JOB_TABLE}_group ON "
+                 f"{JOB_TABLE} (job_group, status)")
+    conn.close()
+
+def insert_jobs(conn, jobs, reset=False):
+    '''
+    Queues (stage, target, group, payload) jobs on an open connection. A
+    target already queued for the stage is left alone, unless reset is
+    set and it has finished, in which case it is queued again.
+    '''
+    now = time.time()
+    added = 0
+    for stage, target, group, payload in jobs:
+        cursor = conn.execute(f"INSERT OR IGNORE INTO {JOB_TABLE} (stage,"
+                              " target, job_group, payload, created, updated)"
+                              " VALUES (?, ?, ?, ?, ?, ?)", (stage, target,\
+                              group, json.dumps(payload), now, now))
+        if not cursor.rowcount and reset:
+            cursor = conn.execute(f"UPDATE {JOB_TABLE} SET status = 'pending',"
+                                  " attempts = 0, message = NULL, payload = ?,"
+                                  " job_group = ?, updated = ? WHERE stage = ?"
+                                  " AND target = ? AND status IN ('done',"
+                                  " 'failed')", (json.dumps(payload), group,\
+                                  now, stage, target))
+        added = added + cursor.rowcount
+    return added
+
+def add_jobs(database, jobs, reset=False):
+    '''
+    Queues a list of (stage, target, group, payload) jobs; returns how
+    many were added
+    '''
+    conn = connect_jobs(database)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        added = insert_jobs(conn, jobs, reset=reset)
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    return added
+
+def claim_job(database, stages, owner, lease_seconds=600, max_attempts=3):
+    '''
+    Atomically leases the oldest claimable job of the given stages to
+    owner. Jobs whose lease expired are claimable again, or failed once
+    they have used up max_attempts. Returns the job as a dict, or None.
+    '''
+    now = time.time()
+    marks = ','.join('?'*len(stages))
+    conn = connect_jobs(database)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(f"UPDATE {JOB_TABLE} SET status = 'failed', lease_owner ="
+                     " NULL, message = 'lease expired', updated = ? WHERE"
+                     " status = 'leased' AND lease_expiry < ? AND attempts >= ?",
+                     (now, now, max_attempts))
+        row = conn.execute(f"SELECT job_id, stage, target, job_group, payload,"
+                           f" attempts FROM {JOB_TABLE} AS job WHERE stage IN"
+                           f" ({marks}) AND (status = 'pending' OR (status ="
+                           " 'leased' AND lease_expiry < ?)) AND (job_group IS"
+                           f" NULL OR NOT EXISTS (SELECT 1 FROM {JOB_TABLE} AS"
+                           " other WHERE other.job_group = job.job_group AND"
+                           " other.job_id != job.job_id AND ((other.status ="
+                           " 'leased' AND other.lease_expiry >= ?) OR"
+                           " (other.status IN ('pending', 'leased') AND"
+                           " other.job_id < job.job_id)))) ORDER BY job_id"
+                           " LIMIT 1", list(stages)+[now, now]).fetchone()
+        if row is None:
+            conn.execute('COMMIT')
+            return None
+        conn.execute(f"UPDATE {JOB_TABLE} SET status = 'leased', lease_owner"
+                     " = ?, lease_expiry = ?, attempts = attempts + 1,"
+                     " updated = ? WHERE job_id = ?",
+                     (owner, now+lease_seconds, now, row[0]))
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+    return {'job_id': row[0], 'stage': row[1], 'target': row[2],\
+            'group': row[3], 'payload': json.loads(row[4] or 'null'),\
+            'attempts': row[5]+1}
+
+def renew_lease(database, job_id, owner, lease_seconds=600):
+    '''
+    Extends a lease; False if owner no longer holds it
+    '''
+    conn = connect_jobs(database)
+    cursor = conn.execute(f"UPDATE {JOB_TABLE} SET lease_expiry = ?, updated"
+                          " = ? WHERE job_id = ? AND status = 'leased' AND"
+                          " lease_owner = ?", (time.time()+lease_seconds,\
+                          time.time(), job_id, owner))
+    conn.close()
+    return cursor.rowcount == 1
+
+def update_rows(conn, table_name, updates, profile_table=None):
+    '''
+    Applies processing table updates, each a dict with the downloaded
+    file name ('file'), columns to set ('set') and comma separated list
+    columns to extend ('append', with values not in the list yet, so
+    that retried and re-staged jobs do not repeat them). Updates with 'table': 'profiles' apply
+    to the profile rows matching 'where' instead, and ones with
+    'profiles' record newly staged profiles of 'glider_tag'.
+    '''
+    today = time.strftime('%Y%m%d_%H%M')
+    for update in updates:
+        if 'profiles' in update:
+            db.upsert_profiles(conn.cursor(), profile_table,\
+                               update['glider_tag'], update['file'],\
+                               update['profiles'], today)
+            continue
+
+        if update.get('table') == 'profiles':
+            target_table = profile_table
+            where = update['where']
+        else:
+            target_table = table_name
+            where = {'file_downloaded': update['file']}
+        columns = [row[1] for row in \
+                   conn.execute(f"PRAGMA table_info({target_table})")]
+        names = list(update.get('set', {}))+list(update.get('append', {}))+\
+                list(where)
+        for name in names:
+            if name not in columns:
+                raise ValueError(f"No column {name} in {target_table}")
+        assignments = [f"{name} = ?" for name in update.get('set', {})]+\
+                      [f"{name} = CASE WHEN {name} IS NULL OR {name} = ''"
+                       f" THEN ? WHEN instr(',' || {name} || ',', ',' || ?"
+                       f" || ',') > 0 THEN {name} ELSE {name} || ',' || ? END"\
+                       for name in update.get('append', {})]
+        values = list(update.get('set', {}).values())
+        for value in update.get('append', {}).values():
+            values.extend([value, value, value])
+        conn.execute(f"UPDATE {target_table} SET {', '.join(assignments)}"
+                     f" WHERE {' AND '.join([name+' = ?' for name in where])}",
+                     values+list(where.values()))
+
+def complete_job(database, job_id, owner, success, message=None,\
+                 table_name=None, updates=None, next_jobs=None,\
+                 max_attempts=3, profile_table=None):
+    '''
+    Finishes a leased job. In one transaction, and only if owner still
+    holds the lease, the job is marked done (or back to pending, or
+    failed after max_attempts), the processing table updates are applied
+    and the next jobs are queued. Returns False if the lease was lost, in
+    which case nothing is written.
+    '''
+    now = time.time()
+    conn = connect_jobs(database)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        cursor = conn.execute(f"UPDATE {JOB_TABLE} SET status = CASE WHEN ?"
+                              " THEN 'done' WHEN attempts >= ? THEN 'failed'"
+                              " ELSE 'pending' END, lease_owner = NULL,"
+                              " lease_expiry = NULL, message = ?, updated = ?"
+                              " WHERE job_id = ? AND status = 'leased' AND"
+                              " lease_owner = ?", (int(bool(success)),\
+                              max_attempts, message, now, job_id, owner))
+        if cursor.rowcount != 1:
+            conn.execute('ROLLBACK')
+            return False
+        if success and updates:
+            update_rows(conn, table_name, updates, profile_table)
+        if success and next_jobs:
+            insert_jobs(conn, next_jobs, reset=True)
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    return True
+
+def job_summary(database):
+    '''
+    Number of jobs per stage and status
+    '''
+    conn = connect_jobs(database)
+    rows = conn.execute(f"SELECT stage, status, count(*) FROM {JOB_TABLE}"
+                        " GROUP BY stage, status").fetchall()
+    conn.close()
+    summary = {}
+    for stage, status, count in rows:
+        summary.setdefault(stage, {})[status] = count
+    return summary
+
+def job_owner():
+    '''
+    Lease owner name of this process
+    '''
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class LocalJobs:
+    '''
+     Job queue in a database file on this machine (or a shared disk)
+    '''
+    def __init__(self, database, table_name, max_attempts=3,\
+                 profile_table=None):
+        self.database = database
+        self.table_name = table_name
+        self.profile_table = profile_table
+        self.max_attempts = max_attempts
+        create_job_table(database)
+
+    def add(self, jobs, reset=False):
+        return add_jobs(self.database, jobs, reset=reset)
+
+    def claim(self, stages, owner, lease_seconds):
+        return claim_job(self.database, stages, owner, lease_seconds,\
+                         self.max_attempts)
+
+    def renew(self, job_id, owner, lease_seconds):
+        return renew_lease(self.database, job_id, owner, lease_seconds)
+
+    def complete(self, job_id, owner, success, message=None, updates=None,\
+                 next_jobs=None):
+        return complete_job(self.database, job_id, owner, success, message,\
+                            self.table_name, updates, next_jobs,\
+                            self.max_attempts, self.profile_table)
+
+    def summary(self):
+        return job_summary(self.database)
+
+    def previous_profile(self, glider_tag, profile_number):
+        return db.previous_profile(self.database, self.profile_table,\
+                                   glider_tag, profile_number)
+
+    def profiles_in_state(self, glider_tag, stage, state):
+        return db.profiles_in_state(self.database, self.profile_table,\
+                                    stage, state, glider_tag)
+
+class RemoteJobs:
+    '''
+     Job queue served by serve_jobs on another machine
+    '''
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def call(self, action, **request):
+        http_request = urllib.request.Request(self.url+'/'+action,\
+                       data=json.dumps(request).encode(),\
+                       headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(http_request, timeout=self.timeout) as reply:
+            return json.loads(reply.read().decode())['result']
+
+    def add(self, jobs, reset=False):
+        return self.call('add', jobs=jobs, reset=reset)
+
+    def claim(self, stages, owner, lease_seconds):
+        return self.call('claim', stages=stages, owner=owner,\
+                         lease_seconds=lease_seconds)
+
+    def renew(self, job_id, owner, lease_seconds):
+        return self.call('renew', job_id=job_id, owner=owner,\
+                         lease_seconds=lease_seconds)
+
+    def complete(self, job_id, owner, success, message=None, updates=None,\
+                 next_jobs=None):
+        return self.call('complete', job_id=job_id, owner=owner,\
+                         success=success, message=message, updates=updates,\
+                         next_jobs=next_jobs)
+
+    def summary(self):
+        return self.call('summary')
+
+    def previous_profile(self, glider_tag, profile_number):
+        return self.call('previous_profile', glider_tag=glider_tag,\
+                         profile_number=profile_number)
+
+    def profiles_in_state(self, glider_tag, stage, state):
+        return self.call('profiles_in_state', glider_tag=glider_tag,\
+                         stage=stage, state=state)
+
+def job_queue(location, table_name=None, max_attempts=3, profile_table=None):
+    '''
+    Job queue at a database path or a job server URL
+    '''
+    if location.startswith('http://') or location.startswith('https://'):
+        return RemoteJobs(location)
+    return LocalJobs(location, table_name, max_attempts=max_attempts,\
+                     profile_table=profile_table)
+
+def serve_jobs(jobs, host='127.0.0.1', port=8765, logging=None, verbose=False):
+    '''
+    Serves a LocalJobs queue over HTTP (POST /add, /claim, /renew,
+    /complete, /summary, /previous_profile and /profiles_in_state with
+    JSON bodies) until interrupted
+    '''
+    actions = {'add': jobs.add, 'claim': jobs.claim, 'renew': jobs.renew,\
+               'complete': jobs.complete, 'summary': jobs.summary,\
+               'previous_profile': jobs.previous_profile,\
+               'profiles_in_state': jobs.profiles_in_state}
+
+    class JobHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            action = self.path.strip('/')
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length) or b'{}')
+                reply = {'result': actions[action](**request)}
+                code = 200
+            except KeyError:
+                reply, code = {'error': 'unknown action '+action}, 404
+            except Exception as error:
+                reply, code = {'error': str(error)}, 500
+                db.shout(f"Job server {action} failed: {error}",\
+                         logging=logging, verbose=verbose, level='error')
+            body = json.dumps(reply).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            db.shout(format % args, logging=logging, verbose=False,\
+                     level='debug')
+
+    server = ThreadingHTTPServer((host, port), JobHandler)
+    db.shout(f"Serving jobs from {jobs.database} on {host}:{port}",\
+             logging=logging, verbose=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def lease_keeper(jobs, job_id, owner, lease_seconds, done_event):
+    '''
+    Renews a lease every third of its length until done_event is set;
+    run in a thread next to long jobs
+    '''
+    while not done_event.wait(lease_seconds/3.):
+        try:
+            if not jobs.renew(job_id, owner, lease_seconds):
+                return
+        except:
+            pass
+
+def start_lease_keeper(jobs, job_id, owner, lease_seconds):
+    done_event = threading.Event()
+    keeper = threading.Thread(target=lease_keeper, args=(jobs, job_id, owner,\
+                              lease_seconds, done_event), daemon=True)
+    keeper.start()
+    return done_event
+
+#--EOF
@@ -45,3 +45,65 @@ def movingaverage(interval, window_size):
     # called from here
     window = np.ones(int(window_size))/float(window_size)
     return np.convolve(interval, window,'same')
+
+def _bincount_nanmean(index, nbins, vals):
+   '''
+      mean of vals per integer index in [0, nbins), ignoring nans and any
+      index outside that range; nan where a bin has no finite values.
+   '''
+   vals = np.ma.filled(np.ma.asarray(vals).astype(float), np.nan).ravel()
+   good = np.isfinite(vals) & (index >= 0) & (index < nbins)
+   sums = np.bincount(index[good], weights=vals[good], minlength=nbins)
+   counts = np.bincount(index[good], minlength=nbins)
+   mean = np.ones(nbins)*np.nan
+   mean[counts > 0] = sums[counts > 0]/counts[counts > 0]
+   return mean
+
+def group_nanmean(keys, *values):
+   '''
+      returns the unique keys and, for each values array, the mean per key
+      ignoring nans (nan where a key has no finite values). Uses a single
+      np.unique/np.bincount pass rather than a boolean mask per key.
+   '''
+   ukeys, inverse = np.unique(np.asarray(keys), return_inverse=True)
+   inverse = inverse.ravel()
+   means = [_bincount_nanmean(inverse, len(ukeys), vals) for vals in values]
+   return (ukeys,) + tuple(means)
+
+def bin_index(coord, edges):
+   '''
+      returns the bin number of each coord value for the given bin edges,
+      following scipy.stats.binned_statistic: bins are closed on the left,
+      the last bin is also closed on the right, and values outside the edges
+      (or nan) get -1.
+   '''
+   coord = np.ma.filled(np.ma.asarray(coord).astype(float), np.nan).ravel()
+   nbins = len(edges) - 1
+   index = np.digitize(coord, edges) - 1
+   index[coord == edges[-1]] = nbins - 1
+   index[(index < 0) | (index >= nbins) | ~np.isfinite(coord)] = -1
+   return index
+
+def bin_nanmean(coord, edges, *values):
+   '''
+      nan-aware mean of each values array within the bins defined by edges
+      (e.g. a depth grid); digitizes coord once and bins every variable with
+      np.bincount. Returns one array of len(edges)-1 per values array.
+   '''
+   index = bin_index(coord, edges)
+   return tuple(_bincount_nanmean(index, len(edges) - 1, vals) \
+                for vals in values)
+
+def bin_mission(profile, coord, edges, *values):
+   '''
+      bins a whole mission at once: returns the unique profile numbers and,
+      for each values array, a (profile x bin) array of nan-aware means.
+   '''
+   uprofiles, inverse = np.unique(np.asarray(profile), return_inverse=True)
+   inverse = inverse.ravel()
+   nbins = len(edges) - 1
+   index = bin_index(coord, edges)
+   index = np.where(index >= 0, inverse*nbins + index, -1)
+   grids = [_bincount_nanmean(index, len(uprofiles)*nbins, vals).\
+            reshape(len(uprofiles), nbins) for vals in values]
+   return (uprofiles,) + tuple(grids)
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+'''
+Purpose:    Lightweight instrumentation of the processing stages. A span
+            measures one piece of work (a staged file, a cube flight, a
+            preprocessed profile...) and records its wall time, CPU time,
+            bytes read/written, subprocesses started and peak RSS during
+            the span to a metrics table of the processing database;
+            counters add named counts to the spans open at the time.
+
+License:    See LICENCE.txt
+'''
+import os, time, json, datetime
+import functools
+import inspect
+import resource
+import sqlite3
+import threading
+
+from . import database_tools as db
+
+METRICS_TABLE = 'metrics'
+METRICS = {'database': None, 'script': None, 'run_id': None, 'logging': None}
+OPEN_SPANS = threading.local()
+# spans open in any thread, which share the process peak RSS
+RSS_SPANS = []
+RSS_LOCK = threading.Lock()
+# functions called with the record of every finished span
+SPAN_HOOKS = []
+
+#-------------------------------------------------------------------------------
+def configure(database, script, logging=None):
+    '''
+    Sends the spans of this run to the metrics table of database; until
+    this is called spans are only logged
+    '''
+    METRICS['database'] = database
+    METRICS['script'] = script
+    METRICS['run_id'] = script+'_'+datetime.datetime.now().\
+                        strftime('%Y%m%d_%H%M%S')+'_'+str(os.getpid())
+    METRICS['logging'] = logging
+    try:
+        create_metrics_table(database)
+    except:
+        METRICS['database'] = None
+        db.shout("Cannot write metrics to "+str(database), logging=logging,\
+                 level='warning')
+
+def create_metrics_table(database):
+    conn, c = db.connectDB(database)
+    c.execute(f"CREATE TABLE IF NOT EXISTS {METRICS_TABLE} ("
+              "run_id TEXT, script TEXT, stage TEXT, glider TEXT, target TEXT,"
+              " parent TEXT, status TEXT, started REAL, wall REAL, cpu REAL,"
+              " bytes_read INTEGER, bytes_written INTEGER,"
+              " subprocesses INTEGER, peak_rss_kb INTEGER, counters TEXT)")
+    c.execute(f"CREATE INDEX IF NOT EXISTS {METRICS_TABLE}_stage ON"
+              f" {METRICS_TABLE} (stage, started)")
+    c.execute(f"CREATE INDEX IF NOT EXISTS {METRICS_TABLE}_run ON"
+              f" {METRICS_TABLE} (run_id)")
+    conn.commit()
+    conn.close()
+
+def io_bytes():
+    '''
+    Bytes read and written by this process so far (including cached
+    reads); from the block counts when /proc is not available
+    '''
+    try:
+        with open('/proc/self/io', 'r') as io_fid:
+            fields = dict([line.split(':') for line in io_fid])
+        return int(fields['rchar']), int(fields['wchar'])
+    except:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_inblock*512, usage.ru_oublock*512
+
+def resource_usage():
+    '''
+    CPU seconds of this process and its finished children, bytes read and
+    written, and the lifetime peak RSS (kB) of this process and of its
+    largest finished child
+    '''
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    bytes_read, bytes_written = io_bytes()
+    return {'cpu': own.ru_utime+own.ru_stime+children.ru_utime+\
+                   children.ru_stime,
+            'bytes_read': bytes_read,
+            'bytes_written': bytes_written,
+            'peak_rss_kb': own.ru_maxrss,
+            'children_peak_rss_kb': children.ru_maxrss}
+
+def proc_status_kb(field):
+    '''
+    A kB field (VmRSS, VmHWM...) of /proc/self/status, or the lifetime
+    peak RSS where /proc is not available
+    '''
+    try:
+        with open('/proc/self/status', 'r') as status_fid:
+            for line in status_fid:
+                if line.startswith(field+':'):
+                    return int(line.split()[1])
+    except:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def reset_peak_rss():
+    '''
+    Resets the peak RSS (VmHWM) of this process (Linux); False if not
+    possible
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as refs_fid:
+            refs_fid.write('5')
+        return True
+    except:
+        return False
+
+def note_peak_rss():
+    '''
+    Folds the peak RSS since the last reset into every open span; call
+    with RSS_LOCK held
+    '''
+    peak_rss = proc_status_kb('VmHWM')
+    for open_span in RSS_SPANS:
+        open_span.peak_rss = max(open_span.peak_rss, peak_rss)
+
+def open_spans():
+    if not hasattr(OPEN_SPANS, 'stack'):
+        OPEN_SPANS.stack = []
+    return OPEN_SPANS.stack
+
+def count(name, n=1):
+    '''
+    Adds n to counter name of every open span of this thread
+    '''
+    for span in open_spans():
+        span.counters[name] = span.counters.get(name, 0)+n
+
+def glider_from_config(GLIDER_CONFIG):
+    '''
+    Glider tag of a config_<tag>.ini file
+    '''
+    name = os.path.basename(str(GLIDER_CONFIG))
+    if name.startswith('config_') and name.endswith('.ini'):
+        return name[len('config_'):-len('.ini')]
+    return None
+
+class Span:
+    '''
+     Measures one piece of work of a stage. Use as a context manager, or
+     call start() and stop() around code that cannot be indented.
+
+     The peak RSS is the high-water mark (VmHWM) since the span started:
+     each span resets it, first folding the peak so far into the spans
+     already open. Where it cannot be reset, it is the lifetime peak if
+     that rose during the span, and unknown (None) otherwise.
+    '''
+    def __init__(self, stage, glider=None, target=None):
+        self.stage = stage
+        self.glider = glider
+        self.target = target
+        self.counters = {}
+        self.record = None
+
+    def start(self):
+        stack = open_spans()
+        self.parent = stack[-1].stage if stack else None
+        stack.append(self)
+        self.started = time.time()
+        with RSS_LOCK:
+            note_peak_rss()
+            self.rss_reset = reset_peak_rss()
+            self.peak_rss = proc_status_kb('VmHWM')
+            RSS_SPANS.append(self)
+        self.t0 = time.perf_counter()
+        self.usage = resource_usage()
+        return self
+
+    def peak_rss_kb(self, usage):
+        '''
+        Peak RSS (kB) of the process, or of a child that finished, during
+        the span
+        '''
+        peak_rss = None
+        if self.rss_reset:
+            peak_rss = self.peak_rss
+        elif usage['peak_rss_kb'] > self.usage['peak_rss_kb']:
+            peak_rss = usage['peak_rss_kb']
+        if usage['children_peak_rss_kb'] > self.usage['children_peak_rss_kb']:
+            peak_rss = max(peak_rss or 0, usage['children_peak_rss_kb'])
+        return peak_rss
+
+    def stop(self, status='ok'):
+        usage = resource_usage()
+        with RSS_LOCK:
+            note_peak_rss()
+            if self in RSS_SPANS:
+                RSS_SPANS.remove(self)
+        stack = open_spans()
+        if self in stack:
+            stack.remove(self)
+        self.record = {'run_id': METRICS['run_id'], 'script': METRICS['script'],
+                       'stage': self.stage, 'glider': self.glider,
+                       'target': None if self.target is None else str(self.target),
+                       'parent': self.parent, 'status': status,
+                       'started': self.started,
+                       'wall': time.perf_counter()-self.t0,
+                       'cpu': usage['cpu']-self.usage['cpu'],
+                       'bytes_read': usage['bytes_read']-self.usage['bytes_read'],
+                       'bytes_written': usage['bytes_written']-\
+                                        self.usage['bytes_written'],
+                       'subprocesses': self.counters.pop('subprocesses', 0),
+                       'peak_rss_kb': self.peak_rss_kb(usage),
+                       'counters': json.dumps(self.counters)}
+        record_span(self.record)
+        for hook in SPAN_HOOKS:
+            try:
+                hook(self.record)
+            except:
+                db.shout("Span hook failed for "+self.stage,\
+                         logging=METRICS['logging'], level='warning')
+        return self.record
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, error_type, error, trace):
+        self.stop('ok' if error_type is None else 'failed')
+        return False
+
+def span(stage, glider=None, target=None):
+    return Span(stage, glider=glider, target=target)
+
+def record_span(record):
+    '''
+    Logs a finished span and writes it to the metrics table
+    '''
+    db.shout(f"METRICS {record['stage']} {record['glider'] or ''} "
+             f"{record['target'] or ''}: {record['status']}, "
+             f"{record['wall']:.3f} s wall, {record['cpu']:.3f} s CPU",
+             logging=METRICS['logging'], level='debug')
+    if METRICS['database'] is None:
+        return
+    names = list(record.keys())
+    try:
+        conn = sqlite3.connect(METRICS['database'], timeout=60)
+        conn.execute(f"INSERT INTO {METRICS_TABLE} ({', '.join(names)}) VALUES"
+                     f" ({', '.join('?'*len(names))})",
+                     [record[name] for name in names])
+        conn.commit()
+        conn.close()
+    except:
+        # instrumentation must never stop the processing
+        db.shout("Failed to record metrics for "+record['stage'],\
+                 logging=METRICS['logging'], level='warning')
+
+def spanned(stage, target=None):
+    '''
+    Decorator running a function in a span of stage; the glider comes
+    from its GLIDER_CONFIG argument and the target from the argument
+    named target
+    '''
+    def decorate(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            arguments = signature.bind_partial(*args, **kwargs).arguments
+            with Span(stage, glider=glider_from_config(\
+                      arguments.get('GLIDER_CONFIG')),\
+                      target=arguments.get(target)):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def slowest_stages(database, runs=10, stage=None, glider=None, limit=10):
+    '''
+    Stages (per glider) of the last runs ordered by total wall time, with
+    span count, mean/max wall time, CPU, bytes, subprocesses and peak RSS
+    '''
+    conn, c = db.connectDB(database)
+    query = f"SELECT stage, glider, count(*), sum(wall), avg(wall), max(wall)," \
+            " sum(cpu), sum(bytes_read), sum(bytes_written), sum(subprocesses)," \
+            " max(peak_rss_kb), sum(status != 'ok') FROM" \
+            f" {METRICS_TABLE} WHERE run_id IN (SELECT run_id FROM" \
+            f" {METRICS_TABLE} GROUP BY run_id ORDER BY min(started) DESC" \
+            " LIMIT ?)"
+    values = [runs]
+    if stage is not None:
+        query = query+" AND stage = ?"
+        values.append(stage)
+    if glider is not None:
+        query = query+" AND glider = ?"
+        values.append(glider)
+    c.execute(query+" GROUP BY stage, glider ORDER BY sum(wall) DESC LIMIT ?",\
+              values+[limit])
+    names = ['stage', 'glider', 'spans', 'total_wall', 'mean_wall', 'max_wall',\
+             'cpu', 'bytes_read', 'bytes_written', 'subprocesses',\
+             'peak_rss_kb', 'failed']
+    rows = [dict(zip(names, row)) for row in c.fetchall()]
+    conn.close()
+    return rows
+
+def stage_trends(database, runs=10, stage=None, glider=None):
+    '''
+    Per run and stage: when the run started, spans, total and mean wall
+    time, oldest run first
+    '''
+    conn, c = db.connectDB(database)
+    query = f"SELECT run_id, script, min(started), stage, count(*), sum(wall)," \
+            f" avg(wall), sum(cpu) FROM {METRICS_TABLE} WHERE run_id IN" \
+            f" (SELECT run_id FROM {METRICS_TABLE} GROUP BY run_id ORDER BY" \
+            " min(started) DESC LIMIT ?)"
+    values = [runs]
+    if stage is not None:
+        query = query+" AND stage = ?"
+        values.append(stage)
+    if glider is not None:
+        query = query+" AND glider = ?"
+        values.append(glider)
+    c.execute(query+" GROUP BY run_id, stage ORDER BY min(started), stage",\
+              values)
+    names = ['run_id', 'script', 'started', 'stage', 'spans', 'total_wall',\
+             'mean_wall', 'cpu']
+    rows = [dict(zip(names, row)) for row in c.fetchall()]
+    conn.close()
+    return rows
+
+#--EOF
@@ -13,6 +13,46 @@ import numpy.ma as ma
 import matplotlib.pyplot as plt
 from . import list_array_utils as la_utils
 
+def linefit_errors(x, y):
+   '''
+   Squared error of a straight-line least-squares fit to x[0:k+1], y[0:k+1]
+   for every k, evaluated in a single pass from running sums rather than by
+   refitting each segment with np.polyfit.
+
+   inputs:
+
+      x: independent variable (e.g. pressure), finite and not all equal
+      y: dependent variable (e.g. temperature)
+
+   outputs:
+      err: array of len(x); err[k] is the residual sum of squares of the fit
+           over the first k+1 points (err[0] and err[1] are exactly 0)
+   '''
+   x = np.asarray(x, dtype=float)
+   y = np.asarray(y, dtype=float)
+   err = np.zeros(np.shape(x))
+   if len(x) < 3:
+      return err
+
+   # shift to the first point to limit cancellation in the centred sums
+   x = x - x[0]
+   y = y - y[0]
+
+   n   = np.arange(1, len(x)+1, dtype=float)
+   sx  = np.cumsum(x)
+   sy  = np.cumsum(y)
+   sxx = np.cumsum(x*x) - sx*sx/n
+   syy = np.cumsum(y*y) - sy*sy/n
+   sxy = np.cumsum(x*y) - sx*sy/n
+
+   with np.errstate(divide='ignore', invalid='ignore'):
+      err = np.where(sxx > 0, syy - sxy*sxy/sxx, syy)
+
+   # two points are always fitted exactly; guard rounding below zero
+   err[0:2] = 0.0
+   err[err < 0] = 0.0
+   return err
+
 def findmld(pres, temp, sal, floatnumber, yesplot=False, rec_cut=10, pmax=20, \
             verbose=False, logging=None):
    '''
@@ -154,16 +194,7 @@ def findmld(pres, temp, sal, floatnumber, yesplot=False, rec_cut=10, pmax=20, \
       return mld_var  
 
    # check no identitical pressures: will cause /diff to fail
-   _pres = np.unique(pres)
-   utemp = np.zeros(np.shape(_pres))*np.nan
-   usal  = np.zeros(np.shape(_pres))*np.nan
-   upres = np.zeros(np.shape(_pres))*np.nan
-   count = 0
-   for val in _pres:
-      utemp[count]=np.mean(temp[pres==val])
-      usal[count] =np.mean(sal[pres==val])
-      upres[count]=np.mean(pres[pres==val])
-      count = count+1
+   upres, utemp, usal = la_utils.group_nanmean(pres, temp, sal)
 
    pres = np.copy(upres)
    sal  = np.copy(usal)
@@ -285,30 +316,11 @@ def findmld(pres, temp, sal, floatnumber, yesplot=False, rec_cut=10, pmax=20, \
       # This step aims to accurately capture the slope of the mixed layer, and
       # not its depth.  
 
-      errort = list([0])
-      errors = list([0])
-      errord = list([0])
-      for j in range(starti+2, m+1):
-         # Fit line to temperature and calculate error
-         P = np.polyfit(pres[starti:j], temp[starti:j], 1)
-         ltempfit = np.polyval(P, pres[starti:j])
-         errort.append(np.dot((temp[starti:j] - ltempfit).T, (temp[starti:j] - ltempfit)))
-
-         # Fit line to salinity and calculate error
-         P = np.polyfit(pres[starti:j], sal[starti:j], 1)
-         lsalfit = np.polyval(P, pres[starti:j])
-         # print "%+2.40f\n" % lsalfit[0]
-      
-         errors.append(np.dot((sal[starti:j] - lsalfit).T, (sal[starti:j] - lsalfit)))
-
-         # Fit line to potential density and calculate error
-         P = np.polyfit(pres[starti:j], pd[starti:j], 1)
-         ldenfit = np.polyval(P, pres[starti:j])
-         errord.append(np.dot((pd[starti:j] - ldenfit).T, (pd[starti:j] - ldenfit)))
-
-      errort = np.asarray(errort)
-      errors = np.asarray(errors)
-      errord = np.asarray(errord)
+      # The fits are evaluated for every depth at once from running sums,
+      # see linefit_errors.
+      errort = linefit_errors(pres[starti:m], temp[starti:m])
+      errors = linefit_errors(pres[starti:m], sal[starti:m])
+      errord = linefit_errors(pres[starti:m], pd[starti:m])
 
       #########################################################################
 
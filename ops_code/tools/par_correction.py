@@ -45,7 +45,8 @@ def par_correction(PROFILE,TIME,LAT,LON,DEPTH,CHL,SCATTER,PAR,TEMP,SALT,WS,\
                    glider_bathy,foutdir,gtag,to_UTC=0.0,Zthresh=-60,\
                    twilight_offset=1.0,verbose=False,logging=None,\
                    surface_depth=-20,N_smooth=2,debug=0,fsz=12,\
-                   WL=np.arange(450,701),correct_time=True):
+                   WL=np.arange(450,701),correct_time=True,\
+                   tref='1970-01-01 00:00:00'):
    '''
     Corrects broadband PAR to provide corrected spectral PAR
     Method ref: Hemsley et al., 2015
@@ -61,24 +62,21 @@ def par_correction(PROFILE,TIME,LAT,LON,DEPTH,CHL,SCATTER,PAR,TEMP,SALT,WS,\
    lat1d         = np.nanmean(LAT,axis=0)
    lon1d         = np.nanmean(LON,axis=0)
    
-   # find necessary profile indices
-   nights, days, bad, good, no_DCM_nights, day_good_PAR, shallows, deeps = \
-               ct.profile_specifics(time1d,lat1d,lon1d,DEPTH[:,0],glider_bathy,\
-                                    CHL,PAR,SCATTER,N_smooth,to_UTC,\
-                                    twilight_offset,surface_depth,\
-                                    correct_time=correct_time)
+   # find good PAR (daytime) profiles
+   day_good_PAR = ct.solar_geometry(lat1d,lon1d,time1d,tref,to_UTC=to_UTC,\
+                                    correct_time=correct_time)['is_day']
 
    SST = TEMP[0,:]
    SSS = SALT[0,:]
 
-   # get Fresnel reflectances: Hemsley et al., 2015
-   r_tot,solzen = ct.fresnel_refl(lat1d,lon1d,time1d,DEPTH[:,0],PAR,day_good_PAR,WS,\
-                           SST,SSS,to_UTC,correct_time=correct_time)
-
    # take PAR from first sub-surface depth level if not available for surface
    E_0_minus = PAR[0,:]
    E_0_minus[np.isnan(E_0_minus)] = PAR[1,np.isnan(E_0_minus)]
-   # get above surface (E0) irradiance: Hemsley et al., 2015
-   E_0_plus = ct.get_E0(E_0_minus,r_tot)
+
+   # get Fresnel reflectances and above surface (E0) irradiance for all
+   # profiles: Hemsley et al., 2015
+   r_tot,solzen,E_0_plus = ct.surface_irradiance(lat1d,lon1d,time1d,tref,\
+                                    E_0_minus,day_good_PAR,WS,SST,SSS,\
+                                    to_UTC=to_UTC,correct_time=correct_time)
 
    return E_0_plus
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+'''
+Purpose:    Runs processing stages as a dependency graph in one process.
+            Stages share an in-memory context; only their checkpoint values
+            and output files persist, so a stage whose inputs are unchanged
+            since the last run is skipped and its checkpoint restored.
+
+License:    See LICENCE.txt
+'''
+import os, json, time
+import hashlib
+
+from . import database_tools as db
+from . import metrics_tools as mt
+
+#-------------------------------------------------------------------------------
+def file_signature(paths):
+    '''
+    Cheap content signature of a list of files from their names, sizes
+    and modification times; missing files are part of the signature.
+    '''
+    sha = hashlib.sha1()
+    for path in sorted(set(paths)):
+        try:
+            stat = os.stat(path)
+            sha.update(f"{path}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+        except OSError:
+            sha.update(f"{path}|missing\n".encode())
+    return sha.hexdigest()
+
+def read_pipeline_state(state_file):
+    '''
+    Reads the per-stage signatures and checkpoints of the last run
+    '''
+    if not os.path.exists(state_file):
+        return {}
+    try:
+        with open(state_file, 'r') as state_fid:
+            return json.load(state_fid)
+    except:
+        return {}
+
+def write_pipeline_state(state, state_file):
+    '''
+    Writes the pipeline state atomically
+    '''
+    tmp_file = state_file+'.tmp'
+    with open(tmp_file, 'w') as state_fid:
+        json.dump(state, state_fid, indent=1)
+    os.replace(tmp_file, state_file)
+
+def stage_order(stages):
+    '''
+    Orders stages so that each runs after the stages it requires;
+    otherwise keeps the order given.
+    '''
+    names = [stage['name'] for stage in stages]
+    by_name = dict(zip(names, stages))
+    ordered = []
+    visiting = set()
+
+    def visit(name):
+        if name in ordered:
+            return
+        if name in visiting:
+            raise ValueError('Pipeline stages have a cycle at '+name)
+        if name not in by_name:
+            raise ValueError('Unknown pipeline stage '+name)
+        visiting.add(name)
+        for required in by_name[name].get('requires', []):
+            visit(required)
+        visiting.discard(name)
+        ordered.append(name)
+
+    for name in names:
+        visit(name)
+    return [by_name[name] for name in ordered]
+
+def run_pipeline(stages, context, state_file, force=False, logging=None,\
+                 verbose=False):
+    '''
+    Runs the stages in dependency order. Each stage is a dict with
+
+     name:     stage name
+     requires: names of stages it depends on
+     inputs:   callable(context) -> files the stage reads
+     run:      callable(context, inputs, last) -> (checkpoint, outputs);
+               the checkpoint is a JSON-able dict merged into the context,
+               outputs the files the stage wrote and last the checkpoint
+               of its previous run (for incremental stages).
+     always:   run even when unchanged (cheap, idempotent stages); this
+               does not make the stages that require it rerun.
+
+    A stage is skipped when neither its inputs nor any required stage
+    changed since the last run, its outputs are still in place and its
+    checkpoint has no 'pending' items (work it left undone, e.g. files
+    that failed, which are retried on every run); its checkpoint is then
+    restored into the context. Returns stage -> status.
+    '''
+    state = read_pipeline_state(state_file)
+    statuses = {}
+    signatures = {}
+
+    for stage in stage_order(stages):
+        name = stage['name']
+        inputs = stage['inputs'](context) if 'inputs' in stage else []
+        sha = hashlib.sha1(file_signature(inputs).encode())
+        for required in stage.get('requires', []):
+            sha.update(signatures[required].encode())
+        signature = sha.hexdigest()
+        signatures[name] = signature
+
+        last = state.get(name, {})
+        if not force and not stage.get('always') and \
+           last.get('signature') == signature and \
+           not last.get('checkpoint', {}).get('pending') and \
+           last.get('output_signature') == file_signature(last.get('outputs', [])):
+            context.update(last.get('checkpoint', {}))
+            statuses[name] = 'skipped'
+            db.shout(f"Pipeline stage {name}: inputs unchanged; skipping",\
+                     logging=logging, verbose=verbose)
+            continue
+
+        db.shout(f"Pipeline stage {name}: running", logging=logging,\
+                 verbose=verbose)
+        t0 = time.time()
+        try:
+            with mt.span('pipeline_'+name):
+                checkpoint, outputs = stage['run'](context, inputs,\
+                                                   last.get('checkpoint', {}))
+        except:
+            # forget the stage so that it and its dependants rerun next time
+            state.pop(name, None)
+            write_pipeline_state(state, state_file)
+            statuses[name] = 'failed'
+            db.shout(f"Pipeline stage {name} failed; stopping", \
+                     logging=logging, verbose=True, level='error')
+            break
+
+        context.update(checkpoint)
+        state[name] = {'signature': signature,
+                       'checkpoint': checkpoint,
+                       'outputs': sorted(set(outputs)),
+                       'output_signature': file_signature(outputs),
+                       'elapsed': round(time.time()-t0, 3)}
+        write_pipeline_state(state, state_file)
+        statuses[name] = 'ran'
+        db.shout(f"Pipeline stage {name}: done in "
+                 f"{state[name]['elapsed']} s", logging=logging,\
+                 verbose=verbose)
+
+    return statuses
+
+#--EOF
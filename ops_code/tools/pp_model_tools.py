@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+'''
+Purpose:    Tools to run the PAR and Morel91 primary production models on
+            the station files written by common_tools.output_text
+
+License:    See LICENCE.txt
+'''
+import os, glob, datetime
+import subprocess
+import multiprocessing
+import numpy as np
+from netCDF4 import Dataset
+
+from . import database_tools as db
+
+MODELS_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(\
+              os.path.realpath(__file__)))), 'models')
+
+# defaults for the [PP_MODELS] section of the main config; these mirror
+# models/par/common
+PP_MODEL_DEFAULTS = {'models_dir': MODELS_ROOT,
+                     'bin_dir': 'bin/linux',
+                     'lib_dir': 'lib',
+                     'data_dir': 'data',
+                     'output_dir': './pp_output',
+                     'n_workers': '0',
+                     'chl_name': 'chl',
+                     'time_step': '30',
+                     'depth_step': '5',
+                     'wavelength_step': '5',
+                     'euphotic_ratio': '0.001',
+                     'morel91_data': 'Achl,aw,bw,kc,kw'}
+
+# telemetry keys passed to the PAR model (when finite), in run_par order
+PAR_TELEMETRY_ARGS = [('cloud', '--C'), ('rh', '--RH'), ('tcwv', '--WV'),
+                      ('mslp', '--P'), ('wspd', '--W'), ('wspd', '--WM')]
+
+#-------------------------------------------------------------------------------
+def read_model_config(module_config):
+    '''
+    Returns the [PP_MODELS] settings with defaults filled in; model
+    directories are resolved against models_dir.
+    '''
+    MODEL_DICT = dict(PP_MODEL_DEFAULTS)
+    if module_config is not None and module_config.has_section('PP_MODELS'):
+        MODEL_DICT.update(dict(module_config['PP_MODELS']))
+
+    models_dir = os.path.abspath(MODEL_DICT['models_dir'])
+    for key in ['bin_dir', 'lib_dir', 'data_dir']:
+        MODEL_DICT[key] = os.path.join(models_dir, MODEL_DICT[key])
+    MODEL_DICT['output_dir'] = os.path.abspath(MODEL_DICT['output_dir'])
+
+    MODEL_DICT['n_workers'] = int(MODEL_DICT['n_workers'])
+    if MODEL_DICT['n_workers'] < 1:
+        MODEL_DICT['n_workers'] = multiprocessing.cpu_count()
+    MODEL_DICT['morel91_data'] = [item.strip() for item in \
+                                  MODEL_DICT['morel91_data'].split(',') if item]
+    return MODEL_DICT
+
+def read_telemetry(telemetry_file):
+    '''
+    Reads an output_text telemetry file into a dictionary of strings.
+    '''
+    telemetry = {}
+    with open(telemetry_file, 'r') as fid:
+        for line in fid:
+            parts = line.split()
+            if len(parts) == 2:
+                telemetry[parts[0]] = parts[1]
+    return telemetry
+
+def station_files(station_dir, chl_name='chl', suffix='.txt'):
+    '''
+    Returns (station number, chl file, telemetry file) for every station in
+    station_dir that has both files.
+    '''
+    stations = []
+    for telemetry_file in sorted(glob.glob(os.path.join(station_dir,\
+                                 'telemetry_station_*'+suffix))):
+        station = os.path.basename(telemetry_file)[len('telemetry_station_'):\
+                                                   -len(suffix)]
+        chl_file = os.path.join(station_dir, chl_name+'_station_'+station+suffix)
+        if os.path.exists(chl_file):
+            stations.append((int(station), chl_file, telemetry_file))
+    return stations
+
+def finite_value(telemetry, key):
+    '''
+    Returns a telemetry value if it is a finite number, else None.
+    '''
+    try:
+        value = float(telemetry[key])
+    except:
+        return None
+    if np.isfinite(value):
+        return telemetry[key]
+    return None
+
+def par_command(MODEL_DICT, telemetry, ed_file):
+    '''
+    PAR model command line for one station (missing met values are left
+    to the model defaults, as in models/par/run_par).
+    '''
+    command = [os.path.join(MODEL_DICT['bin_dir'], 'par'),\
+               '--atmo_read', os.path.join(MODEL_DICT['data_dir'], 'gcirrad.dat')]
+    for key, flag in PAR_TELEMETRY_ARGS:
+        value = finite_value(telemetry, key)
+        if value is not None:
+            command += [flag, value]
+    command += ['--D', str(int(telemetry['jday']))]
+    value = finite_value(telemetry, 'o3')
+    if value is not None:
+        command += ['--O_3', value]
+    command += ['--lat', telemetry['latitude'], '--lon', telemetry['longitude'],\
+                '--wave_step', MODEL_DICT['wavelength_step'],\
+                '--time_step', MODEL_DICT['time_step'], '--par', ed_file]
+    return command
+
+def morel91_command(MODEL_DICT, telemetry, chl_file, ed_file, profile_file):
+    '''
+    Morel91 model command line for one station.
+    '''
+    command = [os.path.join(MODEL_DICT['bin_dir'], 'morel91')]
+    for data_name in MODEL_DICT['morel91_data']:
+        command += ['--'+data_name+'_read',\
+                    os.path.join(MODEL_DICT['data_dir'], data_name)]
+    value = finite_value(telemetry, 'temp')
+    if value is not None:
+        command += ['--T', value]
+    command += ['--ed_read', ed_file, '--chl_read', chl_file,\
+                '--time_step', MODEL_DICT['time_step'],\
+                '--depth_step', MODEL_DICT['depth_step'],\
+                '--euphotic_ratio', MODEL_DICT['euphotic_ratio'],\
+                '--profile_write', profile_file]
+    return command
+
+def model_environment(MODEL_DICT):
+    '''
+    Environment for the model binaries, with the models library directory
+    on the library path.
+    '''
+    env = dict(os.environ)
+    env['LD_LIBRARY_PATH'] = os.pathsep.join([path for path in \
+        [MODEL_DICT['lib_dir'], env.get('LD_LIBRARY_PATH', '')] if path])
+    return env
+
+def reported_value(stdout, tag):
+    '''
+    Parses the number following tag in model standard output.
+    '''
+    for line in stdout.splitlines():
+        if tag in line:
+            try:
+                return float(line.split(tag)[-1].strip())
+            except:
+                return np.nan
+    return np.nan
+
+def run_station(job):
+    '''
+    Runs PAR then Morel91 for one station; a worker for run_pp_models.
+    '''
+    station, chl_file, telemetry_file, MODEL_DICT, env = job
+    tag = str(station).zfill(6)
+    ed_file = os.path.join(MODEL_DICT['output_dir'], 'ed_station_'+tag+'.txt')
+    profile_file = os.path.join(MODEL_DICT['output_dir'],\
+                                'm91_station_'+tag+'.profile.txt')
+    result = {'station': station, 'status': 'ok', 'daily_par': np.nan,\
+              'pp': np.nan, 'ed_file': ed_file, 'profile_file': profile_file,\
+              'telemetry_file': telemetry_file}
+
+    try:
+        telemetry = read_telemetry(telemetry_file)
+        result['latitude'] = float(telemetry['latitude'])
+        result['longitude'] = float(telemetry['longitude'])
+        result['year'] = int(telemetry['year'])
+        result['jday'] = int(telemetry['jday'])
+        result['time'] = telemetry['time']
+
+        output = subprocess.run(par_command(MODEL_DICT, telemetry, ed_file),\
+                     stdout=subprocess.PIPE, stderr=subprocess.PIPE,\
+                     universal_newlines=True, env=env)
+        if output.returncode != 0:
+            result['status'] = 'par failed: '+output.stderr.strip()
+            return result
+        result['daily_par'] = reported_value(output.stdout, 'Daily PAR, in Em-2d-1:')
+
+        output = subprocess.run(morel91_command(MODEL_DICT, telemetry,\
+                     chl_file, ed_file, profile_file),\
+                     stdout=subprocess.PIPE, stderr=subprocess.PIPE,\
+                     universal_newlines=True, env=env)
+        if output.returncode != 0:
+            result['status'] = 'morel91 failed: '+output.stderr.strip()
+            return result
+        result['pp'] = reported_value(output.stdout, 'Calculated prime production is')
+    except Exception as error:
+        result['status'] = 'failed: '+str(error)
+
+    return result
+
+def run_pp_models(station_dir, MODEL_DICT, max_stations=None, logging=None,\
+                  verbose=False):
+    '''
+    Runs the PAR and Morel91 models for every station in station_dir (or
+    the first max_stations) across a process pool. Returns the
+    per-station results, sorted by station number.
+    '''
+    if not os.path.exists(MODEL_DICT['output_dir']):
+        os.makedirs(MODEL_DICT['output_dir'])
+
+    env = model_environment(MODEL_DICT)
+    jobs = [(station, chl_file, telemetry_file, MODEL_DICT, env) for \
+            station, chl_file, telemetry_file in \
+            station_files(station_dir, chl_name=MODEL_DICT['chl_name'])]
+    if max_stations is not None:
+        jobs = jobs[:max_stations]
+    db.shout('Running PP models for '+str(len(jobs))+' stations on '\
+             +str(MODEL_DICT['n_workers'])+' workers', logging=logging,\
+             verbose=verbose)
+
+    if MODEL_DICT['n_workers'] > 1 and len(jobs) > 1:
+        chunksize = max(1, len(jobs)//(4*MODEL_DICT['n_workers']))
+        pool = multiprocessing.Pool(min(MODEL_DICT['n_workers'], len(jobs)))
+        try:
+            results = list(pool.imap_unordered(run_station, jobs, chunksize))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run_station(job) for job in jobs]
+
+    results = sorted(results, key=lambda result: result['station'])
+    for result in results:
+        if result['status'] != 'ok':
+            db.shout('Station '+str(result['station'])+': '+result['status'],\
+                     logging=logging, verbose=verbose, level='warning')
+    return results
+
+def write_pp_netcdf(results, output_file, logging=None, verbose=False):
+    '''
+    Writes the per-station model results of a mission to one netCDF file.
+    '''
+    def result_array(key, dtype=float, fill=np.nan):
+        return np.asarray([result.get(key, fill) for result in results], dtype=dtype)
+
+    tmp_file = output_file + '.tmp'
+    nc_fid = Dataset(tmp_file, 'w', format='NETCDF4_CLASSIC')
+    nc_fid.createDimension('station', len(results))
+    nc_fid.history = 'Created ' + datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')\
+                     + ' from PAR and Morel91 model runs'
+
+    variables = [('STATION_NUMBER', 'i4', result_array('station', int, -1),\
+                  'Station number', None),\
+                 ('LATITUDE', 'f8', result_array('latitude'),\
+                  'Station latitude', 'degrees_north'),\
+                 ('LONGITUDE', 'f8', result_array('longitude'),\
+                  'Station longitude', 'degrees_east'),\
+                 ('YEAR', 'i4', result_array('year', int, -1), 'Station year', None),\
+                 ('JDAY', 'i4', result_array('jday', int, -1), 'Station day of year', None),\
+                 ('DAILY_PAR', 'f4', result_array('daily_par'),\
+                  'Daily surface PAR from the PAR model', 'E m-2 d-1'),\
+                 ('PRIMARY_PRODUCTION', 'f4', result_array('pp'),\
+                  'Daily depth-integrated primary production from the Morel91 model', None),\
+                 ('MODEL_STATUS', 'i1',\
+                  np.asarray([result['status'] != 'ok' for result in results], dtype=int),\
+                  'Model run status (0: ok, 1: failed)', None)]
+
+    for var_name, dtype, values, long_name, units in variables:
+        if dtype[0] == 'f':
+            fill_value = 1e36
+            values = np.ma.masked_invalid(values)
+        else:
+            fill_value = -1
+        ncV = nc_fid.createVariable(var_name, dtype, ('station',),\
+                                    fill_value=fill_value)
+        ncV.long_name = long_name
+        if units:
+            ncV.units = units
+        ncV[:] = values
+    nc_fid.close()
+
+    os.replace(tmp_file, output_file)
+    db.shout('Written PP model results to: '+output_file, logging=logging,\
+             verbose=verbose)
+    return output_file
+
+# morel91 --profile_write columns: (header, variable, long name, units)
+M91_PROFILE_COLUMNS = [('Z', 'DEPTH', 'Depth', 'm'),
+                       ('PP', 'PRIMARY_PRODUCTION', 'Primary production', None),
+                       ('Achl_max', 'ACHL_MAX', 'Maximum chlorophyll-specific absorption', 'm2 mg-1'),
+                       ('Chl', 'CHLA', 'Chlorophyll-a', 'mg m-3'),
+                       ('Phi_mu_max', 'PHI_MU_MAX', 'Maximum quantum yield', 'mol C E-1'),
+                       ('PUR_total', 'PUR', 'Photosynthetically usable radiation', None),
+                       ('PAR_total/uE', 'PAR', 'Photosynthetically available radiation', 'uE m-2 s-1'),
+                       ('PAR_total/W', 'PAR_WATTS', 'Photosynthetically available radiation', 'W m-2'),
+                       ('Ed(400nm)', 'ED_400', 'Downwelling irradiance at 400 nm', 'W m-2 nm-1'),
+                       ('Beta', 'BETA', 'Beta', None),
+                       ('KPUR', 'KPUR', 'KPUR', None)]
+
+# output_text telemetry fields carried into the mission product
+TELEMETRY_FIELDS = [('longitude', 'LONGITUDE', 'degrees_east'),
+                    ('latitude', 'LATITUDE', 'degrees_north'),
+                    ('year', 'YEAR', None), ('month', 'MONTH', None),
+                    ('day', 'DAY', None), ('jday', 'JDAY', None),
+                    ('temp', 'TEMP', 'degree_Celsius'), ('wspd', 'WSPD', 'm s-1'),
+                    ('rh', 'RH', 'percent'), ('tcwv', 'TCWV', 'cm'),
+                    ('o3', 'O3', 'DU'), ('mslp', 'MSLP', 'hPa'),
+                    ('cloud', 'CLOUD', '1'), ('E0p', 'E0_PLUS', None),
+                    ('MLD', 'MIXED_LAYER_DEPTH', 'm'), ('ZEU', 'EUPHOTIC_DEPTH', 'm'),
+                    ('CHL_traj', 'CHLA_TRAJECTORY', 'mg m-3'),
+                    ('ZEU_traj', 'EUPHOTIC_DEPTH_TRAJECTORY', 'm'),
+                    ('is_day', 'IS_DAY', None), ('time', 'TIME_OF_DAY', 'minutes')]
+
+def read_profile_file(profile_file):
+    '''
+    Parses a morel91 --profile_write file into a (depth x column) array.
+    '''
+    with open(profile_file, 'r') as fid:
+        fid.readline()
+        values = np.array(fid.read().split(), dtype=float)
+    return values.reshape(-1, len(M91_PROFILE_COLUMNS))
+
+def telemetry_values(telemetry_file):
+    '''
+    Returns the TELEMETRY_FIELDS of one station as floats (NaN if absent).
+    '''
+    telemetry = read_telemetry(telemetry_file)
+    values = np.full(len(TELEMETRY_FIELDS), np.nan)
+    for ii, (key, var_name, units) in enumerate(TELEMETRY_FIELDS):
+        if key not in telemetry:
+            continue
+        value = telemetry[key]
+        try:
+            if key == 'time':
+                hours, minutes = value.split(':')
+                values[ii] = int(hours)*60 + int(minutes)
+            elif key == 'is_day':
+                values[ii] = float(value in ['True', '1', '1.0'])
+            else:
+                values[ii] = float(value)
+        except:
+            pass
+    return values
+
+def parse_station_outputs(jobs):
+    '''
+    Parses the profile and telemetry files of a chunk of stations; a worker
+    for aggregate_model_outputs.
+    '''
+    parsed = []
+    for profile_file, telemetry_file in jobs:
+        try:
+            profile = read_profile_file(profile_file)
+        except:
+            profile = np.zeros((0, len(M91_PROFILE_COLUMNS)))
+        try:
+            telemetry = telemetry_values(telemetry_file)
+        except:
+            telemetry = np.full(len(TELEMETRY_FIELDS), np.nan)
+        parsed.append((profile, telemetry))
+    return parsed
+
+def model_output_files(output_dir, station_dir):
+    '''
+    Returns (station number, profile file, telemetry file) for every
+    morel91 profile file in output_dir with a telemetry file in
+    station_dir.
+    '''
+    stations = []
+    for profile_file in sorted(glob.glob(os.path.join(output_dir,\
+                               'm91_station_*.profile.txt'))):
+        station = os.path.basename(profile_file)[len('m91_station_'):\
+                                                 -len('.profile.txt')]
+        telemetry_file = os.path.join(station_dir, 'telemetry_station_'+station+'.txt')
+        if os.path.exists(telemetry_file):
+            stations.append((int(station), profile_file, telemetry_file))
+    return stations
+
+def aggregate_model_outputs(stations, output_file, n_workers=1, complevel=4,\
+                            logging=None, verbose=False):
+    '''
+    Assembles morel91 profile outputs and output_text telemetry of many
+    stations into one (station x depth) netCDF product, written once with
+    compression. stations is a sequence of (station number, profile file,
+    telemetry file); files are parsed in chunks across a process pool.
+    '''
+    stations = sorted(stations)
+    jobs = [(profile_file, telemetry_file) for station, profile_file, \
+            telemetry_file in stations]
+    n_chunks = max(1, min(len(jobs), 4*n_workers))
+    chunks = [jobs[ii::n_chunks] for ii in range(n_chunks)]
+
+    if n_workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(n_workers, len(chunks)))
+        try:
+            parsed_chunks = pool.map(parse_station_outputs, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        parsed_chunks = [parse_station_outputs(chunk) for chunk in chunks]
+
+    # undo the interleaved chunking
+    parsed = [None]*len(jobs)
+    for ii, parsed_chunk in enumerate(parsed_chunks):
+        parsed[ii::n_chunks] = parsed_chunk
+
+    profiles = [profile for profile, telemetry in parsed]
+    lengths = np.asarray([len(profile) for profile in profiles], dtype=int)
+    all_rows = np.concatenate(profiles + [np.zeros((0, len(M91_PROFILE_COLUMNS)))])
+    depths = np.unique(all_rows[:, 0])
+
+    # scatter all rows into the preallocated (station x depth x var) block
+    PROFILE_DATA = np.full((len(jobs), len(depths), len(M91_PROFILE_COLUMNS)-1), np.nan)
+    station_index = np.repeat(np.arange(len(jobs)), lengths)
+    depth_index = np.searchsorted(depths, all_rows[:, 0])
+    PROFILE_DATA[station_index, depth_index, :] = all_rows[:, 1:]
+
+    TELEMETRY_DATA = np.asarray([telemetry for profile, telemetry in parsed])\
+                     .reshape(len(jobs), len(TELEMETRY_FIELDS))
+
+    tmp_file = output_file + '.tmp'
+    nc_fid = Dataset(tmp_file, 'w', format='NETCDF4')
+    nc_fid.createDimension('station', len(jobs))
+    nc_fid.createDimension('depth', len(depths))
+    nc_fid.history = 'Created ' + datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')\
+                     + ' from '+str(len(jobs))+' Morel91 station profiles'
+
+    ncV = nc_fid.createVariable('STATION_NUMBER', 'i4', ('station',))
+    ncV.long_name = 'Station number'
+    ncV[:] = np.asarray([station for station, profile_file, telemetry_file \
+                         in stations], dtype=int)
+
+    header, var_name, long_name, units = M91_PROFILE_COLUMNS[0]
+    ncV = nc_fid.createVariable(var_name, 'f4', ('depth',))
+    ncV.long_name = long_name
+    ncV.units = units
+    ncV[:] = depths
+
+    for ii, (header, var_name, long_name, units) in enumerate(M91_PROFILE_COLUMNS[1:]):
+        ncV = nc_fid.createVariable(var_name, 'f4', ('station', 'depth'),\
+                  fill_value=1e36, zlib=True, complevel=complevel)
+        ncV.long_name = long_name
+        if units:
+            ncV.units = units
+        ncV[:] = np.ma.masked_invalid(PROFILE_DATA[:, :, ii])
+
+    for ii, (key, var_name, units) in enumerate(TELEMETRY_FIELDS):
+        ncV = nc_fid.createVariable(var_name, 'f8', ('station',),\
+                  fill_value=1e36, zlib=True, complevel=complevel)
+        ncV.long_name = 'Station telemetry: '+key
+        if units:
+            ncV.units = units
+        ncV[:] = np.ma.masked_invalid(TELEMETRY_DATA[:, ii])
+    nc_fid.close()
+
+    os.replace(tmp_file, output_file)
+    db.shout('Aggregated '+str(len(jobs))+' station outputs to: '+output_file,\
+             logging=logging, verbose=verbose)
+    return output_file
+
+#-EOF
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+'''
+Purpose:    Opt-in profiling for the ppglider_* entry points: a cProfile
+            dump of the run (--profile), tracemalloc snapshots at stage
+            boundaries (--trace-memory) and a limit on the number of
+            profiles processed (--sample N). Outputs are written next to
+            the run log.
+
+License:    See LICENCE.txt
+'''
+import os, io, time
+import atexit
+import multiprocessing
+import cProfile
+import pstats
+import tracemalloc
+
+from . import database_tools as db
+from . import metrics_tools as mt
+
+PROFILING = {'base': None, 'profiler': None, 'trace_memory': False,\
+             'snapshot': None, 'logging': None, 'sample': None, 'sampled': 0,\
+             'shared': None, 'reserved': 0, 'shared_reserved': None,\
+             'stopped': False}
+
+#-------------------------------------------------------------------------------
+def add_profiling_arguments(parser):
+    '''
+    Adds --profile, --trace-memory and --sample to an entry point parser
+    '''
+    parser.add_argument('--profile', action='store_true',\
+                        help='Write a cProfile dump (.prof) and a report by'\
+                             ' cumulative time (.prof.txt) next to the log')
+    parser.add_argument('--trace-memory', action='store_true',\
+                        help='Write tracemalloc top allocators at each stage'\
+                             ' boundary (.mem.txt) next to the log')
+    parser.add_argument('--sample', type=int, default=None, metavar='N',\
+                        help='Process only N profiles')
+
+def start_profiling(ARGS, LOGFILE, logging=None):
+    '''
+    Starts whatever profiling the entry point arguments ask for; outputs
+    share the name of LOGFILE. Profiling stops when the script exits.
+    '''
+    PROFILING['base'] = os.path.splitext(LOGFILE)[0]
+    PROFILING['logging'] = logging
+    PROFILING['sample'] = getattr(ARGS, 'sample', None)
+
+    if getattr(ARGS, 'trace_memory', False):
+        tracemalloc.start()
+        PROFILING['trace_memory'] = True
+        mt.SPAN_HOOKS.append(span_snapshot)
+        db.shout("Tracing memory to "+PROFILING['base']+'.mem.txt',\
+                 logging=logging, verbose=True)
+    if getattr(ARGS, 'profile', False):
+        PROFILING['profiler'] = cProfile.Profile()
+        PROFILING['profiler'].enable()
+        db.shout("Profiling to "+PROFILING['base']+'.prof', logging=logging,\
+                 verbose=True)
+    if PROFILING['sample'] is not None:
+        db.shout(f"Sampling {PROFILING['sample']} profiles", logging=logging,\
+                 verbose=True)
+    atexit.register(stop_profiling)
+
+def restart_profiling(suffix):
+    '''
+    Gives a forked worker process its own profile and memory outputs;
+    the worker must call stop_profiling itself
+    '''
+    if PROFILING['base'] is None:
+        return
+    PROFILING['base'] = PROFILING['base']+suffix
+    PROFILING['stopped'] = False
+    PROFILING['snapshot'] = None
+    if PROFILING['profiler'] is not None:
+        # the profiler inherited from the parent is still enabled
+        PROFILING['profiler'].disable()
+        PROFILING['profiler'] = cProfile.Profile()
+        PROFILING['profiler'].enable()
+
+def stop_profiling():
+    '''
+    Writes the profile dump and report and the final memory snapshot
+    '''
+    if PROFILING['base'] is None or PROFILING['stopped']:
+        return
+    PROFILING['stopped'] = True
+
+    if PROFILING['profiler'] is not None:
+        PROFILING['profiler'].disable()
+        PROFILING['profiler'].dump_stats(PROFILING['base']+'.prof')
+        report = io.StringIO()
+        stats = pstats.Stats(PROFILING['profiler'], stream=report)
+        stats.sort_stats('cumulative').print_stats(60)
+        with open(PROFILING['base']+'.prof.txt', 'w') as report_fid:
+            report_fid.write(report.getvalue())
+        db.shout("Profile written to "+PROFILING['base']+'.prof (sort with'\
+                 " pstats or snakeviz)", logging=PROFILING['logging'],\
+                 verbose=True)
+
+    if PROFILING['trace_memory'] and tracemalloc.is_tracing():
+        memory_snapshot('end of run')
+
+def memory_snapshot(label, top=10):
+    '''
+    Appends the current/peak traced memory, the top allocators and the
+    biggest changes since the last snapshot to the .mem.txt file
+    '''
+    if not PROFILING['trace_memory'] or not tracemalloc.is_tracing():
+        return
+    snapshot = tracemalloc.take_snapshot().filter_traces([\
+               tracemalloc.Filter(False, tracemalloc.__file__),\
+               tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),\
+               tracemalloc.Filter(False, '<unknown>')])
+    current, peak = tracemalloc.get_traced_memory()
+
+    lines = [f"== {time.strftime('%Y-%m-%d %H:%M:%S')} {label}: "
+             f"current {current/1048576.:.1f} MB, peak {peak/1048576.:.1f} MB"]
+    lines.append('-- top allocators')
+    for stat in snapshot.statistics('lineno')[:top]:
+        lines.append('   '+str(stat))
+    if PROFILING['snapshot'] is not None:
+        lines.append('-- largest changes since last snapshot')
+        for stat in snapshot.compare_to(PROFILING['snapshot'], 'lineno')[:top]:
+            lines.append('   '+str(stat))
+    PROFILING['snapshot'] = snapshot
+
+    with open(PROFILING['base']+'.mem.txt', 'a') as memory_fid:
+        memory_fid.write('\n'.join(lines)+'\n\n')
+
+def span_snapshot(record):
+    '''
+    Metrics span hook: a snapshot at the end of each outermost span
+    '''
+    if record['parent'] is None:
+        target = f" {os.path.basename(record['target'])}" if record['target'] \
+                 else ''
+        memory_snapshot(f"{record['stage']}{target}")
+
+def share_sample():
+    '''
+    Keeps the --sample count in shared memory, so that worker processes
+    forked after this call draw on one budget
+    '''
+    if PROFILING['sample'] is not None and PROFILING['shared'] is None:
+        PROFILING['shared'] = multiprocessing.Value('i', PROFILING['sampled'])
+        PROFILING['shared_reserved'] = multiprocessing.Value('i',\
+                                       PROFILING['reserved'], lock=False)
+
+def sample_count():
+    '''
+    Profiles counted against the --sample budget so far
+    '''
+    if PROFILING['shared'] is not None:
+        return PROFILING['shared'].value
+    return PROFILING['sampled']
+
+def sample_left():
+    '''
+    Profiles left in the --sample budget; None without --sample
+    '''
+    if PROFILING['sample'] is None:
+        return None
+    return max(PROFILING['sample']-sample_count(), 0)
+
+def sample(items):
+    '''
+    The items still within the --sample budget (all without --sample)
+    '''
+    if PROFILING['sample'] is None:
+        return items
+    return items[:sample_left()]
+
+def sampled(n=1):
+    '''
+    Counts n profiles against the --sample budget (n < 0 gives them back)
+    '''
+    if PROFILING['shared'] is not None:
+        with PROFILING['shared'].get_lock():
+            PROFILING['shared'].value = PROFILING['shared'].value+n
+        return
+    PROFILING['sampled'] = PROFILING['sampled']+n
+
+def reserve_sample():
+    '''
+    Takes all of the --sample budget left, so that processes sharing it
+    cannot overshoot, and returns it (None without --sample); end the
+    reservation with release_sample
+    '''
+    if PROFILING['sample'] is None:
+        return None
+    if PROFILING['shared'] is not None:
+        with PROFILING['shared'].get_lock():
+            left = max(PROFILING['sample']-PROFILING['shared'].value, 0)
+            PROFILING['shared'].value = PROFILING['shared'].value+left
+            PROFILING['shared_reserved'].value = \
+                PROFILING['shared_reserved'].value+left
+        return left
+    left = sample_left()
+    sampled(left)
+    PROFILING['reserved'] = PROFILING['reserved']+left
+    return left
+
+def release_sample(reserved, used):
+    '''
+    Ends a reserve_sample reservation: the used profiles stay counted and
+    the rest go back to the --sample budget
+    '''
+    if reserved is None:
+        return
+    if PROFILING['shared'] is not None:
+        with PROFILING['shared'].get_lock():
+            PROFILING['shared'].value = PROFILING['shared'].value+used-reserved
+            PROFILING['shared_reserved'].value = \
+                PROFILING['shared_reserved'].value-reserved
+        return
+    sampled(used-reserved)
+    PROFILING['reserved'] = PROFILING['reserved']-reserved
+
+def sample_reserved():
+    '''
+    Profiles of the --sample budget reserved but not released yet; while
+    there are any, part of the budget may still come back
+    '''
+    if PROFILING['shared'] is not None:
+        return PROFILING['shared_reserved'].value
+    return PROFILING['reserved']
+
+def sample_full():
+    '''
+    True once --sample profiles have been processed
+    '''
+    return PROFILING['sample'] is not None and \
+           sample_count() >= PROFILING['sample']
+
+#--EOF
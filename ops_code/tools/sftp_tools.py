@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+'''
+Purpose:    Mirrors the glider data sftp source (MARS/NOC/BODC) into the
+            download directory, registering each file in the database.
+            Used by ppglider_autodownload and the pipeline download stage.
+
+License:    See LICENCE.txt
+'''
+import os
+from stat import S_ISDIR
+import paramiko
+
+from . import database_tools as db
+from . import metrics_tools as mt
+from . import profiling_tools as pf
+
+#-------------------------------------------------------------------------------
+def check_files(config, database_name, logging=None, verbose=False):
+    '''
+     Using paramiko as it supports SFTP. Checks for files matching supplied
+     pattern on remote sftp server; and downloads if they differ from what we
+     have locally. Returns the files transferred.
+    '''
+    matches = config['DOWNLOADING']['fmatch'].split(',')
+    excludes = config['DOWNLOADING']['fexclude'].split(',')
+
+    db.shout("Connecting to: " + config['DOWNLOADING']['ftp_host'], logging=logging,
+      verbose=verbose)
+
+    transport = paramiko.Transport((config['DOWNLOADING']['ftp_host'],
+      int(config['DOWNLOADING']['ftp_port'])))
+    transport.connect(username=config['DOWNLOADING']['ftp_user'],\
+                      password=config['DOWNLOADING']['ftp_pwrd'])
+    sftp = paramiko.SFTPClient.from_transport(transport)
+
+    transferred = []
+    mirror_dir(config, os.path.abspath(config['DOWNLOADING']['ftp_path']),\
+                 os.path.abspath(config['DIRECTORIES']['download_dir']), sftp,
+                 matches, excludes, database_name, transferred,\
+                 logging=logging, verbose=verbose)
+
+    sftp.close()
+    transport.close()
+
+    db.shout("Transfers completed", logging=logging, verbose=verbose)
+    return transferred
+
+def register_download(config, database_name, local_path, logging=None,\
+                      verbose=False):
+    timestamp  = os.stat(local_path).st_mtime
+    db.add_new_file_row(database_name,\
+                        "file_downloaded",\
+                        config,\
+                        local_path,\
+                        timestamp,\
+                        logging=logging,\
+                        verbose=verbose)
+
+def mirror_dir(config, remote_dir, local_dir, sftp, matches,\
+                 excludes, database_name, transferred, logging=None,\
+                 verbose=False):
+    '''
+     loops through directories and downloads files on single connection.
+    '''
+
+    local_dir = os.path.abspath(remote_dir.replace(config['DOWNLOADING']['ftp_path'],\
+                                   config['DIRECTORIES']['download_dir']))
+
+    if not os.path.exists(local_dir):
+        os.makedirs(local_dir)
+
+    dir_items = sftp.listdir_attr(remote_dir)
+
+    for item in dir_items:
+        # with --sample, only the first N dive files are transferred
+        if pf.sample_full():
+            return
+        remote_path = os.path.join(remote_dir, item.filename)
+        local_path = os.path.join(local_dir, item.filename)
+        if S_ISDIR(item.st_mode):
+            mirror_dir(config, remote_path, local_path, sftp, matches,\
+                         excludes, database_name, transferred,\
+                         logging=logging, verbose=verbose)
+        else:
+            for match in matches:
+                if str(match) in remote_path:
+                    for exclude in excludes:
+                        if str(exclude) in remote_path:
+                            continue
+
+                    if not os.path.exists(local_path):
+                        # get file if no corresponding local target
+                        # update DB
+                        db.shout("Transferring: "+\
+                                 os.path.basename(remote_path),\
+                                 logging=logging, verbose=verbose)
+
+                        sftp.get(remote_path, local_path)
+                        mt.count('files_transferred')
+                        mt.count('bytes_transferred', item.st_size)
+                        pf.sampled()
+                        transferred.append(local_path)
+                        register_download(config, database_name, local_path,\
+                                          logging=logging, verbose=verbose)
+
+                    else:
+                        # update DB if local path is correct size
+                        # but target is missing from DB
+                        local_file_info = os.stat(local_path)
+                        if local_file_info.st_size == item.st_size:
+                            db.shout("Present, correct size, checking DB(s): "\
+                                     +os.path.basename(local_path),\
+                                     logging=logging, verbose=verbose)
+                            register_download(config, database_name,\
+                                              local_path, logging=logging,\
+                                              verbose=verbose)
+                        else:
+                            # get file if local target is wrong size
+                            # update DB
+                            db.shout("Incorrect size, transferring: "\
+                                     +os.path.basename(remote_path),\
+                                     logging=logging, verbose=verbose)
+                            sftp.get(remote_path, local_path)
+                            mt.count('files_transferred')
+                            mt.count('bytes_transferred', item.st_size)
+                            pf.sampled()
+                            transferred.append(local_path)
+                            register_download(config, database_name,\
+                                              local_path, logging=logging,\
+                                              verbose=verbose)
+
+#--EOF
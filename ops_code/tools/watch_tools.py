@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+'''
+Purpose:    Watches a download directory for newly completed glider files,
+            using inotify where the kernel provides it and polling
+            otherwise, and feeds them to a bounded work queue.
+
+License:    See LICENCE.txt
+'''
+import os, time, fnmatch
+import struct, select, errno
+import ctypes, ctypes.util
+import queue
+
+from . import database_tools as db
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_EVENT = struct.Struct('iIII')
+
+#-------------------------------------------------------------------------------
+def load_inotify():
+    '''
+    Returns libc if it provides inotify, else None
+    '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',\
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+    except:
+        return None
+
+def directory_snapshot(root, pattern):
+    '''
+    Size and modification time of every matching file under root
+    '''
+    snapshot = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in fnmatch.filter(filenames, pattern):
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+                snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                pass
+    return snapshot
+
+class DirectoryWatcher:
+    '''
+     Reports files matching pattern under root once they are complete:
+     closed after writing or moved in (inotify), or unchanged for settle
+     seconds (polling, used when inotify is unavailable or not wanted).
+     Files present when the watcher starts are not reported.
+    '''
+    def __init__(self, root, pattern='*.nc', poll_interval=5.0, settle=2.0,\
+                 use_inotify=True):
+        self.root = os.path.abspath(root)
+        self.pattern = pattern
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.fd = None
+        self.watches = {}
+        if use_inotify:
+            self.start_inotify()
+        self.mode = 'inotify' if self.fd is not None else 'poll'
+        self.known = directory_snapshot(self.root, pattern)
+        self.pending = {}
+
+    def start_inotify(self):
+        libc = load_inotify()
+        if libc is None:
+            return
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return
+        self.libc = libc
+        self.fd = fd
+        for dirpath, _, _ in os.walk(self.root):
+            self.add_watch(dirpath)
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path),\
+                                         IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        if wd >= 0:
+            self.watches[wd] = path
+
+    def poll(self, timeout):
+        '''
+        Waits up to timeout seconds; returns the files completed meanwhile
+        '''
+        if self.mode == 'inotify':
+            return self.read_events(timeout)
+        return self.scan(timeout)
+
+    def read_events(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buffer = os.read(self.fd, 65536)
+        except OSError as error:
+            if error.errno == errno.EAGAIN:
+                return []
+            raise
+
+        files = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = IN_EVENT.unpack_from(buffer, offset)
+            name = buffer[offset+IN_EVENT.size:offset+IN_EVENT.size+length]
+            name = os.fsdecode(name.rstrip(b'\0'))
+            offset = offset + IN_EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # events were lost; report everything and let the caller
+                # drop what it already has
+                for dirpath, _, _ in os.walk(self.root):
+                    if dirpath not in self.watches.values():
+                        self.add_watch(dirpath)
+                return sorted(directory_snapshot(self.root, self.pattern))
+
+            path = os.path.join(self.watches.get(wd, self.root), name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # files may land before the watch is in place
+                    for dirpath, _, _ in os.walk(path):
+                        self.add_watch(dirpath)
+                    files.extend(sorted(directory_snapshot(path,\
+                                                           self.pattern)))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and \
+                 fnmatch.fnmatch(name, self.pattern):
+                files.append(path)
+
+        # one delivery may close several times; report it once
+        return list(dict.fromkeys(files))
+
+    def scan(self, timeout):
+        time.sleep(min(timeout, self.poll_interval))
+        now = time.time()
+        files = []
+        for path, signature in directory_snapshot(self.root,\
+                                                  self.pattern).items():
+            if self.known.get(path) == signature:
+                continue
+            if path not in self.pending or self.pending[path][0] != signature:
+                self.pending[path] = (signature, now)
+            elif now - self.pending[path][1] >= self.settle:
+                files.append(path)
+                self.known[path] = signature
+                del self.pending[path]
+        return sorted(files)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def feed_queue(watcher, work_queue, stop_event, backlog=None, logging=None,\
+               verbose=False):
+    '''
+    Puts the backlog, then every file the watcher reports, on work_queue
+    until stop_event is set. A full queue blocks the watcher (inotify
+    events wait in the kernel meanwhile) rather than dropping files.
+    '''
+    for path in backlog or []:
+        if not watcher_put(work_queue, path, stop_event, logging=logging,\
+                           verbose=verbose):
+            break
+
+    while not stop_event.is_set():
+        for path in watcher.poll(1.0):
+            if not watcher_put(work_queue, path, stop_event, logging=logging,\
+                               verbose=verbose):
+                break
+    watcher.close()
+
+def watcher_put(work_queue, path, stop_event, logging=None, verbose=False):
+    '''
+    Blocking put that gives up when stop_event is set
+    '''
+    waiting = False
+    while not stop_event.is_set():
+        try:
+            work_queue.put((path, time.time()), timeout=1.0)
+            return True
+        except queue.Full:
+            if not waiting:
+                db.shout(f"Work queue full; holding {path}", logging=logging,\
+                         verbose=verbose, level='warning')
+                waiting = True
+    return False
+
+#--EOF